@@ -57,7 +57,7 @@ def get_list_key(func, self, object, **kwargs):
 
 def invalidate_cache(key,  self, object, **kwargs):
     target_ct = ContentType.objects.get_for_model(object)
-    CACHE_DELETER.register_test(Comment, "target_id:%s;target_ct_id:%s" % (object.pk, target_ct.pk) , key)
+    CACHE_DELETER.register_test(Comment, "target_id:%s;target_ct_id:%s" % (object.pk, target_ct.pk) , key, [])
 
 class CommentManager(models.Manager):
     def get_count_for_object(self, object, **kwargs):
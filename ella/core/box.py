@@ -1,5 +1,8 @@
 
-from django.template import loader
+import time
+
+from django.db import models
+from django.template import loader, Context, NodeList, TextNode
 from django.utils.datastructures import MultiValueDict
 from django.utils.encoding import smart_str
 from django.core.cache import cache
@@ -7,11 +10,16 @@ from django.conf import settings
 
 from ella.core.cache.invalidate import CACHE_DELETER
 from ella.core.cache.template_loader import select_template
-from ella.core.cache.utils import normalize_key, get_cached_object
+from ella.core.cache.utils import normalize_key, get_cached_object, is_refreshing
+from ella.core.cache.generations import generation_key, get_generations, note_family, instance_namespace
+from ella.core.cache.stats import STATS
+from ella.core.cache import replication
 
 
 BOX_INFO = 'ella.core.box.BOX_INFO'
 MEDIA_KEY = 'ella.core.box.MEDIA_KEY'
+# key family of rendered boxes in ella.core.cache.stats
+STATS_FAMILY = 'ella.core.box.Box.render'
 
 CACHE_TIMEOUT = getattr(settings, 'CACHE_TIMEOUT', 10*60)
 
@@ -72,6 +80,7 @@ class Box(object):
         self.params = self.resolve_params(context)
         context.pop()
         self._context = context
+        self.__dict__.pop('_cache_key', None)
 
         # override the default template from the parameters
         if 'template_name' in self.params:
@@ -110,15 +119,55 @@ class Box(object):
             if 'SECOND_RENDER' not in self._context:
                 return self.double_render()
         key = self.get_cache_key()
-        rend = cache.get(key)
+        hot = self.is_hot()
+        if hot:
+            generation = self.get_generation()
+        if is_refreshing(key):
+            rend = None
+        else:
+            start = time.time()
+            rend = replication.get(cache, key)
+            STATS.record_get(STATS_FAMILY, int(rend is not None), int(rend is None), time.time() - start)
+            if hot and rend is not None:
+                if rend[0] == generation:
+                    rend = rend[1]
+                else:
+                    # rendered in an older generation the invalidator missed
+                    rend = None
         if rend is None:
             rend = self._render()
-            cache.set(key, rend, CACHE_TIMEOUT)
+            start = time.time()
+            replication.set(cache, key, hot and (generation, rend) or rend, CACHE_TIMEOUT)
+            STATS.record_set(STATS_FAMILY, [rend], time.time() - start)
             for model, test in self.get_cache_tests():
-                CACHE_DELETER.register_test(model, test, key)
-            CACHE_DELETER.register_pk(self.obj, key)
+                CACHE_DELETER.register_test(model, test, key, [])
+            if hot:
+                self.register_refresh(key)
         return rend
 
+    def is_hot(self):
+        """
+        Hot boxes (with the hot parameter) are replicated and regenerated by
+        the cache invalidator instead of deleted, as long as CACHE_DELETER
+        has a transport to it.
+        """
+        return bool(self.params.get('hot')) and CACHE_DELETER.transport is not None
+
+    def get_generation(self):
+        " Generation of the box's object, stored along with hot boxes. "
+        namespaces = [instance_namespace(self.obj.__class__, self.obj.pk)]
+        note_family(namespaces, STATS_FAMILY)
+        return get_generations(namespaces)[0]
+
+    def register_refresh(self, key):
+        " Make the cache invalidator regenerate the box when its object changes, see refresh_box. "
+        CACHE_DELETER.register_pk(self.obj, key)
+        params = '\n'.join('%s:%s' % (k, v) for k, values in self.params.lists() for v in values)
+        CACHE_DELETER.register_refresh(key, 'ella.core.box.refresh_box', (
+                self.obj.__class__._meta.app_label, self.obj.__class__._meta.module_name,
+                self.obj.pk, self.box_type, params
+            ), {})
+
     def double_render(self):
         if self.template_name:
             t_name = self.template_name
@@ -171,12 +220,37 @@ class Box(object):
         return resp
 
     def get_cache_key(self):
-        " Return a cache key constructed from the box's parameters. "
-        if self.params:
-            pars = ','.join(':'.join((smart_str(key), smart_str(self.params[key]))) for key in sorted(self.params.keys()))
-        else:
-            pars = ''
-        return normalize_key('ella.core.box.Box.render:%d:%s:%s:%d:%s' % (
-                    settings.SITE_ID, self.obj.__class__.__name__, str(self.box_type), self.obj.pk, pars
-                ))
+        """
+        Return a cache key constructed from the box's parameters and the
+        generation of the box's object, saving the object starts a new key.
+        Keys of hot boxes are replicated and stay the same, the cache
+        invalidator overwrites them in place (see register_refresh), the
+        generation is stored along with the rendered box instead.
+        """
+        if not hasattr(self, '_cache_key'):
+            if self.params:
+                pars = ','.join(':'.join((smart_str(key), smart_str(self.params[key]))) for key in sorted(self.params.keys()))
+            else:
+                pars = ''
+            key = 'ella.core.box.Box.render:%d:%s:%s:%d:%s' % (
+                        settings.SITE_ID, self.obj.__class__.__name__, str(self.box_type), self.obj.pk, pars
+                    )
+            if self.is_hot():
+                key = replication.replicated_key(normalize_key(key))
+            else:
+                key = normalize_key(generation_key(key, [instance_namespace(self.obj.__class__, self.obj.pk)], STATS_FAMILY))
+            self._cache_key = key
+        return self._cache_key
 
+
+def refresh_box(app_label, module_name, pk, box_type, params):
+    """
+    Render the box anew and store it in the cache, called by the cache
+    invalidator outside of any request, so hot boxes must not depend on the
+    request's context.
+    """
+    model = models.get_model(app_label, module_name)
+    obj = get_cached_object(model, pk=pk)
+    box = getattr(obj, 'box_class', Box)(obj, box_type, NodeList([TextNode(params)]))
+    box.prepare(Context({}))
+    return box.render()
@@ -0,0 +1,76 @@
+"""
+Compact encoding of model instances stored in the cache.
+
+Instead of pickling the whole instance (with class references, every
+attribute set on it and all its related object caches) the instance is stored
+as a tuple of its concrete field values. The tuple carries a format version
+and a hash of the model's fields so that values written by a different
+version of the code are discarded instead of being decoded incorrectly.
+
+Related objects already loaded into the instance's foreign key caches (by
+select_related or CachedForeignKey) are encoded the same way so that reading
+the instance from the cache doesn't cost extra queries.
+"""
+from zlib import crc32
+
+from django.db.models import ForeignKey
+from django.db.models.loading import get_model
+
+
+MARKER = 'ella.core.cache.encoding'
+FORMAT_VERSION = 1
+
+_schemas = {}
+def get_schema_hash(model):
+    " Hash of the model's concrete fields, changes whenever a field is added, removed or changes type. "
+    if model not in _schemas:
+        _schemas[model] = crc32(','.join('%s:%s' % (f.attname, f.get_internal_type()) for f in model._meta.fields))
+    return _schemas[model]
+
+def encode(obj):
+    " Return tuple representing the model instance. "
+    opts = obj._meta
+    related = []
+    for f in opts.fields:
+        if isinstance(f, ForeignKey):
+            rel_obj = obj.__dict__.get(f.get_cache_name())
+            if rel_obj is not None:
+                related.append((f.name, encode(rel_obj)))
+
+    return (
+        MARKER,
+        FORMAT_VERSION,
+        '%s.%s' % (opts.app_label, opts.object_name),
+        get_schema_hash(obj.__class__),
+        tuple(getattr(obj, f.attname) for f in opts.fields),
+        tuple(related),
+    )
+
+def is_encoded(value):
+    return isinstance(value, tuple) and len(value) == 6 and value[0] == MARKER
+
+def decode(value):
+    """
+    Return model instance represented by the encoded value, None if the value
+    was encoded for a different schema (or the model doesn't exist anymore).
+    Anything else than an encoded instance is returned unchanged.
+    """
+    if not is_encoded(value):
+        return value
+
+    marker, version, model_label, schema_hash, values, related = value
+    if version != FORMAT_VERSION:
+        return None
+
+    model = get_model(*model_label.split('.'))
+    if model is None or schema_hash != get_schema_hash(model):
+        return None
+
+    obj = model(*values)
+    for name, rel_value in related:
+        rel_obj = decode(rel_value)
+        if rel_obj is None:
+            # the related object will be fetched again if needed
+            continue
+        setattr(obj, model._meta.get_field(name).get_cache_name(), rel_obj)
+    return obj
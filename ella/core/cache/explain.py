@@ -0,0 +1,118 @@
+"""
+Cache keys a change of an instance invalidates - keys registered for its
+pk, keys with a test matching it and all the keys depending on those - with
+the sizes of their cached values, and the generation namespaces it bumps
+with the key families built on them. Used by the cacheexplain management
+command and the cache_explain view to find out why a fragment stays stale or
+why one save flushes too much.
+"""
+import os
+
+from django.core.cache import cache
+
+from ella.core.cache.invalidate import CACHE_DELETER, describe
+from ella.core.cache.registry import Registry, read_registry
+from ella.core.cache.stats import get_size
+from ella.core.cache import replication, generations
+from ella.core.cache.transports import InProcessTransport, CI_PARTITIONS
+
+
+def get_registry(partitions=CI_PARTITIONS):
+    " Return the in-process invalidator's registry or the one the cache invalidator keeps on disk. "
+    transport = CACHE_DELETER.transport
+    if isinstance(transport, InProcessTransport) and transport.invalidator is not None:
+        return transport.invalidator._register
+
+    from ella.core.management.commands.cacheinvalidator import REGISTRY_DIR, REGISTRY_SHARDS
+    registry = Registry()
+    if partitions <= 1:
+        return read_registry(REGISTRY_DIR, REGISTRY_SHARDS, registry)
+    for partition in range(partitions):
+        read_registry(os.path.join(REGISTRY_DIR, str(partition)), REGISTRY_SHARDS, registry)
+    return registry
+
+def _entry(registry, key, reason, seen):
+    seen.add(key)
+    value = replication.get(cache, key)
+    dependents = []
+    for dst_key in sorted(registry.dependencies.get(key, ())):
+        if dst_key not in seen:
+            dependents.append(_entry(registry, dst_key, 'depends on %s' % key, seen))
+    return {
+        'key': key,
+        'reason': reason,
+        'size': value is not None and get_size(value) or None,
+        'hot': registry.get_refresh(key) is not None,
+        'dependents': dependents,
+    }
+
+def explain(instance, registry=None):
+    """
+    Return list of keys registered against the instance as dicts with key,
+    reason, size (None when not cached), hot and dependents (list of the
+    same dicts).
+    """
+    if registry is None:
+        registry = get_registry()
+    descriptor = describe(instance)
+    reasons = {}
+    model_registry = registry.models.get(descriptor.model)
+    if model_registry is not None:
+        for key in model_registry.pks.get(descriptor.pk, ()):
+            reasons.setdefault(key, []).append('pk')
+        for key, test in model_registry.matching_tests(descriptor):
+            reason = 'test "%s"' % test
+            fields = model_registry.fields.get((key, test))
+            if fields is not None:
+                reason += ' on change of %s' % ','.join(sorted(fields))
+            reasons.setdefault(key, []).append(reason)
+
+    seen = set()
+    return [_entry(registry, key, ', '.join(reasons[key]), seen) for key in sorted(reasons)]
+
+def explain_generations(instance):
+    """
+    Return generation namespaces a change of the instance bumps (of all its
+    foreign keys' values, as if it moved) as dicts with
+    namespace, generation (None when not counted yet) and families - key
+    families built on the namespace, all their keys start anew.
+    """
+    namespaces = generations.get_instance_namespaces(instance.__class__, instance, all_fks=True)
+    current = generations.peek_generations(namespaces)
+    return [{
+            'namespace': ns,
+            'generation': current[ns],
+            'families': sorted(generations.get_families(ns)),
+        } for ns in sorted(namespaces)]
+
+def format_generations(namespaces):
+    " Return lines describing the generation namespaces. "
+    lines = []
+    for entry in namespaces:
+        if entry['generation'] is None:
+            generation = 'not counted'
+        else:
+            generation = 'generation %s' % entry['generation']
+        lines.append('%s (%s): %s' % (entry['namespace'], generation, ', '.join(entry['families']) or 'no keys'))
+    return lines
+
+def format_explanation(entries, level=0):
+    " Return lines describing the entries, dependents indented under their keys. "
+    lines = []
+    for entry in entries:
+        if entry['size'] is None:
+            size = 'not cached'
+        else:
+            size = '%d bytes' % entry['size']
+        lines.append('%s%s (%s, %s%s)' % ('    ' * level, entry['key'], entry['reason'], size, entry['hot'] and ', hot' or ''))
+        lines.extend(format_explanation(entry['dependents'], level + 1))
+    return lines
+
+def get_totals(entries):
+    " Return number of keys and bytes the entries and their dependents hold. "
+    keys, size = 0, 0
+    for entry in entries:
+        k, s = get_totals(entry['dependents'])
+        keys += k + 1
+        size += s + (entry['size'] or 0)
+    return keys, size
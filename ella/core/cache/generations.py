@@ -0,0 +1,251 @@
+"""
+Generation counters for cache namespaces.
+
+Cache keys built for a namespace (a model, a single instance or all instances
+of a model with a given foreign key value) include the namespace's current
+generation. Invalidating every such key then only takes incrementing the
+counter, no key has to be tracked or deleted individually.
+
+Generations are bumped from post_save and post_delete signals for the model,
+its parents and the instance. Namespaces of foreign key values are only
+bumped when the instance joins or leaves them (is created, deleted or its
+foreign key changes - both the old and the new value) or when a field
+ordering or filtering their keys changes - the model's ordering and fields
+given to register_membership_fields.
+
+Counters of namespaces of CACHE_REPLICATED_MODELS are read on almost every
+request and are thus replicated (see ella.core.cache.replication). The
+replicas are seeded and incremented as a unit so that they never diverge.
+
+Key families (see ella.core.cache.stats) built on every kind of namespace are
+noted in the cache, so that ella.core.cache.explain can tell which keys a
+bump starts anew.
+"""
+import re
+import time
+
+from django.core.cache import cache
+from django.db.models import signals, ForeignKey
+from django.db.models.fields import FieldDoesNotExist
+from django.conf import settings
+
+from ella.core.cache import replication
+
+
+GENERATION_KEY = 'ella.core.cache.generations:%s'
+# namespace kind -> set of key families built on it
+FAMILIES_KEY = 'ella.core.cache.generations.families'
+# keep the counters as long as memcached allows
+GENERATION_TIMEOUT = getattr(settings, 'CACHE_GENERATION_TIMEOUT', 30*24*60*60)
+# counters are seeded with the time in 1/CACHE_GENERATION_RESOLUTION seconds,
+# namespaces must not be bumped more often than that many times per second
+GENERATION_RESOLUTION = getattr(settings, 'CACHE_GENERATION_RESOLUTION', 1000000)
+# applications whose models are never used in cached namespaces
+GENERATION_EXCLUDE_APPS = getattr(settings, 'CACHE_GENERATION_EXCLUDE_APPS', ('sessions', 'admin',))
+
+# attribute holding values of tracked fields (by attname) the instance was loaded with
+INITIAL_VALUES = '_ella_generation_values'
+
+
+def model_namespace(model):
+    " Namespace of all instances of the model. "
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+def instance_namespace(model, pk):
+    " Namespace of one instance. "
+    return '%s:%s' % (model_namespace(model), pk)
+
+def field_namespace(model, attname, value):
+    " Namespace of instances having the given value in a foreign key field (identified by its attname). "
+    return '%s.%s:%s' % (model_namespace(model), attname, value)
+
+def namespace_kind(namespace):
+    " Namespace without the instance's pk or the field's value, eg. core.Listing.category_id:* "
+    return re.sub(r':.*$', ':*', namespace)
+
+_namespace_model = re.compile(r'^[^.:]+\.[^.:]+')
+
+def get_counter_key(namespace):
+    " Key of the namespace's generation counter. "
+    key = GENERATION_KEY % namespace
+    match = _namespace_model.match(namespace)
+    if match and match.group(0) in replication.CACHE_REPLICATED_MODELS:
+        key = replication.replicated_key(key)
+    return key
+
+def get_seed():
+    return int(time.time() * GENERATION_RESOLUTION)
+
+def seed_counter(key):
+    """
+    Initialize the counter with the current time and return its value.
+    Replicas of a counter are initialized as a unit: all of them are set to
+    one seed, never lower than the replicas still holding a value.
+    """
+    replicas = replication.get_replicas(key)
+    if len(replicas) == 1:
+        value = get_seed()
+        cache.add(key, value, GENERATION_TIMEOUT)
+        return value
+    value = max(cache.get_many(replicas).values() + [get_seed()])
+    replication.set(cache, key, value, GENERATION_TIMEOUT)
+    return value
+
+def get_generations(namespaces):
+    """
+    Return current generations of namespaces (in the same order). Missing
+    counters are seeded with the current time in 1/GENERATION_RESOLUTION
+    seconds. Every generation a counter has used is at most its seed plus
+    the number of bumps since then, so as long as it is bumped fewer than
+    GENERATION_RESOLUTION times per second, a counter evicted from the cache
+    is re-seeded above all of them.
+    """
+    keys = [get_counter_key(ns) for ns in namespaces]
+    found = replication.get_many(cache, keys)
+    out = []
+    for key in keys:
+        if key not in found:
+            found[key] = seed_counter(key)
+        out.append(found[key])
+    return out
+
+def peek_generations(namespaces):
+    " Return dict of current generations of namespaces, counters are not seeded. "
+    keys = dict((get_counter_key(ns), ns) for ns in namespaces)
+    found = replication.get_many(cache, keys.keys())
+    return dict((ns, found.get(key)) for key, ns in keys.items())
+
+# (kind, family) pairs this process has noted already
+_noted = set()
+
+def note_family(namespaces, family):
+    " Remember that keys of family are built on the namespaces' kinds. "
+    kinds = set(namespace_kind(ns) for ns in namespaces)
+    new = [kind for kind in kinds if (kind, family) not in _noted]
+    if not new:
+        return
+    families = cache.get(FAMILIES_KEY) or {}
+    for kind in new:
+        families.setdefault(kind, set()).add(family)
+        _noted.add((kind, family))
+    cache.set(FAMILIES_KEY, families, GENERATION_TIMEOUT)
+
+def get_families(namespace):
+    " Return key families built on the namespace's kind. "
+    families = cache.get(FAMILIES_KEY) or {}
+    return families.get(namespace_kind(namespace), set())
+
+def generation_key(key, namespaces, family=None):
+    """
+    Return key extended by the current generations of all the namespaces,
+    family is the kind of the key for get_families.
+    """
+    if not namespaces:
+        return key
+    if family is not None:
+        note_family(namespaces, family)
+    return '%s@%s' % (key, ','.join(map(str, get_generations(namespaces))))
+
+def bump(namespaces):
+    " Increment the generations of namespaces, invalidating all keys built for them. "
+    for ns in namespaces:
+        try:
+            replication.incr(cache, get_counter_key(ns))
+        except ValueError:
+            # counter (or some of its replicas) doesn't exist, it will be
+            # seeded with current time on next use
+            pass
+
+
+_fk_fields = {}
+def _get_fk_fields(model):
+    if model not in _fk_fields:
+        _fk_fields[model] = [f.attname for f in model._meta.fields if isinstance(f, ForeignKey)]
+    return _fk_fields[model]
+
+# model -> attnames deciding which instances keys built on its foreign key
+# namespaces hold (besides the foreign keys and the model's ordering)
+_membership_fields = {}
+
+def register_membership_fields(model, attnames):
+    " Bump namespaces of all the foreign keys of model's instance whenever one of the fields changes. "
+    _membership_fields[model] = tuple(attnames)
+    _tracked_fields.clear()
+
+_tracked_fields = {}
+def _get_tracked_fields(model):
+    " Attnames of model (and its parents) whose values a change is detected by. "
+    if model not in _tracked_fields:
+        attnames = set()
+        for m in _get_models(model):
+            attnames.update(_get_fk_fields(m))
+            attnames.update(_membership_fields.get(m, ()))
+            for name in m._meta.ordering:
+                try:
+                    attnames.add(m._meta.get_field(name.lstrip('-')).attname)
+                except FieldDoesNotExist:
+                    # random or spanning relations
+                    pass
+        _tracked_fields[model] = attnames
+    return _tracked_fields[model]
+
+def _get_models(model):
+    " Model and all its parents for multi-table inheritance. "
+    models = [model]
+    for parent in model._meta.parents.keys():
+        models.extend(_get_models(parent))
+    return models
+
+def _is_excluded(model):
+    return model._meta.app_label in GENERATION_EXCLUDE_APPS
+
+def _get_values(instance, model):
+    return dict((attname, getattr(instance, attname, None)) for attname in _get_tracked_fields(model))
+
+def store_initial_values(sender, instance, **kwargs):
+    " Remember the tracked fields' values so that we can tell which foreign key namespaces a change touches. "
+    if _is_excluded(sender):
+        return
+    setattr(instance, INITIAL_VALUES, _get_values(instance, sender))
+
+def get_instance_namespaces(sender, instance, all_fks=False):
+    """
+    Return set of namespaces a change of the instance (of model sender)
+    bumps. all_fks forces the namespaces of all its foreign keys' values, as
+    if the instance was created or deleted.
+    """
+    if _is_excluded(sender):
+        return set()
+
+    initial = getattr(instance, INITIAL_VALUES, None)
+    if initial is None:
+        all_fks = True
+        initial = {}
+    changed = set(attname for attname, value in initial.items() if getattr(instance, attname, None) != value)
+    # a change of ordering or membership fields touches all the instance's
+    # foreign key namespaces, otherwise only those it joins or leaves
+    all_fks = all_fks or bool(changed.difference(_get_fk_fields(sender)))
+
+    namespaces = set()
+    for model in _get_models(sender):
+        namespaces.add(model_namespace(model))
+        namespaces.add(instance_namespace(model, instance.pk))
+        for attname in _get_fk_fields(model):
+            if all_fks or attname in changed:
+                namespaces.add(field_namespace(model, attname, getattr(instance, attname)))
+            if attname in changed:
+                namespaces.add(field_namespace(model, attname, initial[attname]))
+    return namespaces
+
+def bump_instance_generations(sender, instance, created=False, all_fks=False, **kwargs):
+    " Bump the namespaces of the saved or deleted instance. "
+    if _is_excluded(sender):
+        return
+
+    all_fks = all_fks or created or kwargs.get('signal') is signals.post_delete
+    bump(get_instance_namespaces(sender, instance, all_fks))
+    setattr(instance, INITIAL_VALUES, _get_values(instance, sender))
+
+signals.post_init.connect(store_initial_values)
+signals.post_save.connect(bump_instance_generations)
+signals.post_delete.connect(bump_instance_generations)
@@ -3,93 +3,236 @@ try:
 except ImportError:
     import pickle
 
+import time
 import logging
-from django.dispatch import dispatcher
+from threading import local
+
+from django.db import models, transaction
 from django.db.models import signals
-from django.conf import settings
+from django.utils.encoding import smart_str
+
+from ella.core.cache.transports import get_transport
+from ella.core.cache.registry import InstanceDescriptor
 
 
 log = logging.getLogger('cache')
 
-AMQ_DESTINATION = getattr(settings, 'CI_AMQ_DESTINATION', '/topic/ella')
-AMQ_HOST = getattr(settings, 'ACTIVE_MQ_HOST', None)
-AMQ_PORT = getattr(settings, 'ACTIVE_MQ_PORT', 61613)
 
+def get_tested_fields(model):
+    " Fields whose values are sent to the cache invalidator, long texts are never tested. "
+    opts = model._meta
+    if not hasattr(opts, '_cache_tested_fields'):
+        opts._cache_tested_fields = tuple(f.attname for f in opts.fields if not isinstance(f, models.TextField))
+    return opts._cache_tested_fields
 
-class MsgWrapper(object):
-    pass
+def get_values(instance):
+    " Current values of instance's fields, keyed by attname. "
+    d = instance.__dict__
+    return dict((attname, d.get(attname)) for attname in get_tested_fields(instance.__class__))
 
-class CacheDeleter(object):
-    def __init__(self):
-        self.signal_handler = self
-        self.conn = None
+def describe(instance, changed=None):
+    " Return InstanceDescriptor of the instance to send to the cache invalidator. "
+    values = dict((attname, smart_str(value)) for attname, value in get_values(instance).items())
+    return InstanceDescriptor(str(instance.__class__), smart_str(instance._get_pk_val()), values, changed)
 
-    def on_error(self, header, message):
-        " Log AMQ/stomp error message "
-        log.error('AMQ: %s' % header)
 
-    def on_disconnected(self):
-        log.error('AMQ: Connection was lost!')
+class CacheDeleter(object):
+    """
+    Sends registrations of cached keys and changed instances to the cache
+    invalidator through a transport (see ella.core.cache.transports).
+
+    Between start_batch() and send_batch() (done by
+    InvalidationBatchMiddleware around every request) messages sent by a
+    thread are collected and sent as one message at the end.
+
+    Changes saved within a managed transaction are only sent by
+    send_pending() once it is committed and dropped when it is rolled
+    back, the cache invalidator regenerating keys must not read uncommitted
+    data. django.db.transaction's commit, rollback and
+    leave_transaction_management are hooked to do that (see
+    _hook_transaction), whatever manages the transaction.
+    """
+    def __init__(self):
+        self.transport = None
+        # hold changes saved within managed transactions, see send_pending
+        self.send_after_commit = True
+        self.invalidation_listeners = []
+        self._batch = local()
+
+    def on_message(self, headers, message):
+        " Process notification about keys deleted by the cache invalidator "
+        if headers.get('type') == 'invalidated':
+            self.key_invalidated(headers['key'])
+
+    def add_invalidation_listener(self, listener):
+        " Register a callable to be called with every key deleted by the cache invalidator. "
+        self.invalidation_listeners.append(listener)
+
+    def key_invalidated(self, key):
+        for listener in self.invalidation_listeners:
+            listener(key)
+
+    def start_batch(self):
+        self._batch.messages = []
+
+    def pop_batch(self):
+        " Stop collecting messages and return the ones collected since start_batch(). "
+        messages = getattr(self._batch, 'messages', None)
+        self._batch.messages = None
+        return messages or []
+
+    def send_pending(self):
+        " Send changes saved within a transaction, to be called after it is committed. "
+        pending = getattr(self._batch, 'pending', None)
+        self._batch.pending = []
+        for model, msg in pending or []:
+            self._send(msg, 'del', model=model)
+
+    def drop_pending(self):
+        " Forget changes saved within a transaction, to be called after it is rolled back. "
+        self._batch.pending = []
+
+    def send_batch(self):
+        " Send messages collected since start_batch() as one message. "
+        if not transaction.is_managed():
+            self.send_pending()
+        messages = self.pop_batch()
+        if messages and self.transport:
+            try:
+                self.transport.send_batch(messages)
+            except Exception, e:
+                log.error('Can not send message to the cache invalidator (%s).' % e)
 
     def _send(self, msg, type, key=None, model=None):
-        " Send message to AMQ "
-        if self.conn:
-            headers = {'Type': type, 'Key': key, 'Model': model}
-            self.conn.send(msg, headers=headers, destination=AMQ_DESTINATION)
-
-    def register_test(self, model, test, key):
-        self._send(test, 'test', key, model)
+        " Send message to the cache invalidator "
+        self._send_headers({'type': type, 'key': key, 'model': model}, msg)
+
+    def _send_headers(self, headers, msg):
+        # lets the invalidator measure the lag, see ella.core.cache.stats.InvalidatorStats
+        headers['sent'] = '%.6f' % time.time()
+        messages = getattr(self._batch, 'messages', None)
+        if messages is not None:
+            messages.append((headers, msg))
+        elif self.transport:
+            self.transport.send(headers, msg)
+
+    def register_test(self, model, test, key, fields=None):
+        """
+        Invalidate key when an instance of model matching the test changes.
+        Only changes of fields (list of attnames) count, by default those
+        are the test's own attributes. Keys holding the matching instances'
+        data pass an empty list - any change counts.
+        """
+        if fields is None:
+            self._send(test, 'test', key, str(model))
+        else:
+            headers = {'type': 'test', 'key': key, 'model': str(model), 'fields': ','.join(fields)}
+            self._send_headers(headers, test)
 
     def register_pk(self, instance, key):
-        msg = pickle.dumps(instance)
-        self._send(msg, 'pk', key)
+        self._send(smart_str(instance._get_pk_val()), 'pk', key, str(instance.__class__))
 
-    def register_dependency(self, src_key, obj_key):
-        self._send('', 'dep', src_key, obj_key)
+    def register_dependency(self, src_key, dst_key):
+        " Invalidate dst_key whenever src_key gets invalidated. "
+        self._send('', 'dep', src_key, dst_key)
 
-    def propagate_signal(self, sender, instance):
+    def register_refresh(self, key, path, args, kwargs):
+        """
+        Regenerate key by calling the callable at the dotted path with args
+        and kwargs (see ella.core.cache.utils.regenerate) instead of deleting
+        it when it gets invalidated.
         """
-        Trap the pre_save and pre_delete signal and
+        self._send(pickle.dumps((path, args, kwargs)), 'refresh', key)
+
+    def remember_values(self, sender, instance, **kwargs):
+        " Trap the post_init signal and remember the instance's values to find out which fields get changed. "
+        instance._cache_values = get_values(instance)
+
+    def get_changed(self, instance):
+        " Return set of fields changed since the instance was loaded (or saved), None if not known. "
+        old = getattr(instance, '_cache_values', None)
+        if old is None:
+            return None
+        new = get_values(instance)
+        instance._cache_values = new
+        return set(attname for attname, value in new.items() if old.get(attname) != value)
+
+    def propagate_signal(self, sender, instance, **kwargs):
+        """
+        Trap the post_save and post_delete signal and
         invalidate the relative cache entries.
         """
         # log about received signal
         log.debug('Signal from "%s" received.' % sender)
+        changed = None
+        if kwargs.get('signal') is signals.post_save:
+            changed = self.get_changed(instance)
+            if kwargs.get('created'):
+                changed = None
+        self.invalidate_instance(instance, changed)
+
+    def invalidate_instance(self, instance, changed=None):
+        " Invalidate keys registered against the instance as if it changed (all its fields when changed is None). "
         try:
-            # propagate the signal to Cache Invalidator
-            self._send(pickle.dumps(instance), 'del')
+            msg = pickle.dumps(describe(instance, changed), pickle.HIGHEST_PROTOCOL)
+            if self.send_after_commit and transaction.is_managed():
+                # wait for the commit, see send_pending
+                if getattr(self._batch, 'pending', None) is None:
+                    self._batch.pending = []
+                self._batch.pending.append((str(instance.__class__), msg))
+            else:
+                # the transactions saving the pending ones are over
+                self.send_pending()
+                # propagate the signal to Cache Invalidator
+                self._send(msg, 'del', model=str(instance.__class__))
         except:
-            log.error('Can not send message to AMQ.')
-
-    def connect(self, *args, **kwargs):
+            log.error('Can not send message to the cache invalidator.')
 
-        # initialize connection to ActiveMQ
-        self.conn = stomp.Connection(*args, **kwargs)
-        self.conn.start()
-        self.conn.connect()
+    def connect(self, transport):
+        self.transport = transport
+        # listen for keys deleted by the cache invalidator
+        transport.connect(self)
 
     def disconnect(self):
-        self.conn.stop()
+        self.transport.disconnect()
+        self.transport = None
 
 CACHE_DELETER = CacheDeleter()
 
 
-if AMQ_HOST:
+def _hook_transaction(name, after):
+    " Make django.db.transaction's function name call after() once it returns. "
+    func = getattr(transaction, name)
+    if getattr(func, '_ella_hooked', False):
+        return
+    def wrapped(*args, **kwargs):
+        result = func(*args, **kwargs)
+        after()
+        return result
+    wrapped.__name__ = func.__name__
+    wrapped.__doc__ = func.__doc__
+    wrapped._ella_hooked = True
+    setattr(transaction, name, wrapped)
+
+def _transaction_left():
+    " Changes left pending after the outermost managed block were committed already. "
+    if not transaction.is_managed():
+        CACHE_DELETER.send_pending()
+
+_hook_transaction('commit', CACHE_DELETER.send_pending)
+_hook_transaction('rollback', CACHE_DELETER.drop_pending)
+_hook_transaction('leave_transaction_management', _transaction_left)
+
+
+transport = get_transport()
+if transport:
     try:
-        import stomp
-        import socket
-
-        # check connection to defined AMQ
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((AMQ_HOST, AMQ_PORT))
-        s.close()
-
-        # connection checked, connect CACHE_DELETER
-        CACHE_DELETER.connect([(AMQ_HOST, AMQ_PORT)])
+        CACHE_DELETER.connect(transport)
 
         # start listening for any model
-        dispatcher.connect(CACHE_DELETER.propagate_signal, signal=signals.post_save)
-        dispatcher.connect(CACHE_DELETER.propagate_signal, signal=signals.post_delete)
+        signals.post_init.connect(CACHE_DELETER.remember_values)
+        signals.post_save.connect(CACHE_DELETER.propagate_signal)
+        signals.post_delete.connect(CACHE_DELETER.propagate_signal)
         log.debug('Start listening for any model')
-    except:
-        log.warning('ActiveMQ not running')
-
+    except Exception, e:
+        log.warning('Cache invalidation transport not available (%s).' % e)
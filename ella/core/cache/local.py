@@ -0,0 +1,205 @@
+"""
+In-process cache tiers sitting in front of the cache backend.
+
+LocalCache is shared by the whole process, values are kept pickled so that
+every caller gets its own copy of the object, exactly as if it came from
+memcached, only without the network round trip.
+
+IdentityMap lives only for the duration of one request and hands out the very
+same instance every time it is asked for the same key.
+"""
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import time
+from threading import Lock, local
+
+from django.conf import settings
+
+
+CACHE_LOCAL_MAX_ENTRIES = getattr(settings, 'CACHE_LOCAL_MAX_ENTRIES', 0)
+CACHE_LOCAL_TIMEOUT = getattr(settings, 'CACHE_LOCAL_TIMEOUT', 60)
+
+# indexes into the linked list items
+PREV, NEXT, KEY, VALUE, EXPIRES = 0, 1, 2, 3, 4
+
+
+class LocalCache(object):
+    """
+    Bounded LRU cache with per-entry TTL shared by all threads of the process.
+
+    Entries are kept in a circular doubly linked list ordered by the time of
+    last access, the least recently used entry is dropped when the cache is
+    full. Setting max_entries to 0 disables the cache completely.
+    """
+    def __init__(self, max_entries=CACHE_LOCAL_MAX_ENTRIES, timeout=CACHE_LOCAL_TIMEOUT):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._lock = Lock()
+        self.clear()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data = {}
+            self._root = []
+            self._root[:] = [self._root, self._root, None, None, None]
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def _append(self, link):
+        " Put the link at the end of the list as the most recently used one. "
+        root = self._root
+        last = root[PREV]
+        link[PREV], link[NEXT] = last, root
+        last[NEXT] = root[PREV] = link
+
+    def _get(self, key, now):
+        " Return pickled value for key or None, must be called with the lock held. "
+        link = self._data.get(key)
+        if link is None:
+            self.misses += 1
+            return None
+        if link[EXPIRES] < now:
+            self._unlink(link)
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._unlink(link)
+        self._append(link)
+        self.hits += 1
+        return link[VALUE]
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            return default
+        self._lock.acquire()
+        try:
+            value = self._get(key, time.time())
+        finally:
+            self._lock.release()
+        if value is None:
+            return default
+        return pickle.loads(value)
+
+    def get_many(self, keys):
+        if not self.enabled:
+            return {}
+        now = time.time()
+        out = {}
+        self._lock.acquire()
+        try:
+            for key in keys:
+                value = self._get(key, now)
+                if value is not None:
+                    out[key] = value
+        finally:
+            self._lock.release()
+        for key, value in out.items():
+            out[key] = pickle.loads(value)
+        return out
+
+    def set(self, key, value, timeout=None):
+        if not self.enabled or value is None:
+            return
+        if timeout is None or timeout > self.timeout:
+            timeout = self.timeout
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        self._lock.acquire()
+        try:
+            link = self._data.get(key)
+            if link is not None:
+                self._unlink(link)
+            elif len(self._data) >= self.max_entries:
+                # drop the least recently used entry
+                oldest = self._root[NEXT]
+                self._unlink(oldest)
+                del self._data[oldest[KEY]]
+            link = [None, None, key, value, time.time() + timeout]
+            self._append(link)
+            self._data[key] = link
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        if not self.enabled:
+            return
+        self._lock.acquire()
+        try:
+            link = self._data.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+        finally:
+            self._lock.release()
+
+LOCAL_CACHE = LocalCache()
+
+
+def _instance_models(model):
+    " The model and its parents, an instance is stale in the map under any of them. "
+    return [model] + list(model._meta.get_parent_list())
+
+class IdentityMap(local):
+    """
+    Per-thread map of cache keys to object instances. It only works between
+    activate() and deactivate() calls (done by IdentityMapMiddleware around
+    every request) so that long-lived processes never serve stale instances.
+    """
+    active = False
+
+    def activate(self):
+        self.active = True
+        self.clear()
+
+    def deactivate(self):
+        self.active = False
+        self._data = {}
+        self._instances = {}
+
+    def clear(self):
+        if self.active:
+            self._data = {}
+            # (model, pk) -> keys holding the instance, see delete_instance
+            self._instances = {}
+
+    def get(self, key, default=None):
+        if not self.active:
+            return default
+        return self._data.get(key, default)
+
+    def get_many(self, keys):
+        if not self.active:
+            return {}
+        return dict((key, self._data[key]) for key in keys if key in self._data)
+
+    def set(self, key, value):
+        if self.active and value is not None:
+            self._data[key] = value
+            for model in _instance_models(value.__class__):
+                self._instances.setdefault((model, value.pk), []).append(key)
+
+    def delete_instance(self, model, pk):
+        " Forget the instance of model (or of its parents or children) under all its keys. "
+        if not self.active:
+            return
+        for m in _instance_models(model):
+            for key in self._instances.pop((m, pk), ()):
+                self._data.pop(key, None)
+
+IDENTITY_MAP = IdentityMap()
@@ -0,0 +1,460 @@
+"""
+Registry of cache keys the cache invalidator deletes when objects change.
+
+Keys are registered either for a primary key of a model or for a test - a
+string like ``"attr:value;attr:value"`` that an instance of the model has to
+match (all the attributes must be equal) for the key to be invalidated.
+
+Tests are indexed by the model and by their first (attribute, value) pair, so
+that a changed instance only evaluates the tests that could match it instead
+of every test registered for its model. A test also names the fields the key
+depends on - the test's own attributes unless given otherwise - and is
+skipped when none of them changed.
+
+Changed instances arrive as InstanceDescriptor - the model, pk, attribute
+values and names of the changed fields - rather than pickled instances.
+"""
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import os
+import logging
+from zlib import crc32
+
+from django.utils.encoding import smart_str
+
+
+log = logging.getLogger('cache')
+
+
+def parse_test(test):
+    " Return list of (attribute, value) pairs of the test string. "
+    if not test:
+        return []
+    out = []
+    for subtest in test.split(';'):
+        attr, value = subtest.split(':', 1)
+        out.append((attr.strip(), value.strip()))
+    return out
+
+class InstanceDescriptor(object):
+    """
+    Compact stand-in for a changed model instance: model (str(model_class)),
+    pk, attribute values (as strings) and the set of changed field names or
+    None when unknown (new or deleted instances).
+    """
+    def __init__(self, model, pk, values, changed=None):
+        self.model = model
+        self.pk = pk
+        self.values = values
+        self.changed = changed
+
+    def _get_pk_val(self):
+        return self.pk
+
+    def __getattr__(self, name):
+        values = self.__dict__.get('values', {})
+        if name in values:
+            return values[name]
+        raise AttributeError(name)
+
+    def __repr__(self):
+        return '<InstanceDescriptor %s:%s changed=%s>' % (self.model, self.pk, self.changed)
+
+def check_test(instance, conditions):
+    " Check that instance matches all the parsed conditions. "
+    for attr, value in conditions:
+        if smart_str(getattr(instance, attr, None)) != value:
+            return False
+    return True
+
+
+class ModelRegistry(object):
+    " Keys registered for one model. "
+    def __init__(self):
+        # pk -> set of keys
+        self.pks = {}
+        # key -> set of tests
+        self.tests = {}
+        # attr -> value -> set of (key, test)
+        self.index = {}
+        # tests without conditions matching every instance
+        self.unconditional = set()
+        # (key, test) -> fields the key depends on, all of them if missing
+        self.fields = {}
+
+    def add_pk(self, pk, key):
+        self.pks.setdefault(pk, set()).add(key)
+
+    def pop_pk(self, pk):
+        " Remove and return keys registered for pk. "
+        return self.pks.pop(pk, set())
+
+    def add_test(self, test, key, fields=None):
+        """
+        Register test for key. fields are the attributes whose change can
+        affect the key, the test's own attributes by default, empty for any
+        field.
+        """
+        tests = self.tests.setdefault(key, set())
+        if test in tests:
+            return
+        tests.add(test)
+
+        conditions = parse_test(test)
+        if fields is None:
+            fields = [attr for attr, value in conditions]
+        if fields:
+            self.fields[(key, test)] = frozenset(fields)
+
+        if conditions:
+            attr, value = conditions[0]
+            self.index.setdefault(attr, {}).setdefault(value, set()).add((key, test))
+        else:
+            self.unconditional.add((key, test))
+
+    def remove_key(self, key):
+        " Remove all tests registered for key. "
+        for test in self.tests.pop(key, ()):
+            self.fields.pop((key, test), None)
+            conditions = parse_test(test)
+            if not conditions:
+                self.unconditional.discard((key, test))
+                continue
+
+            attr, value = conditions[0]
+            values = self.index[attr]
+            values[value].discard((key, test))
+            if not values[value]:
+                del values[value]
+                if not values:
+                    del self.index[attr]
+
+    def candidates(self, instance):
+        " Return (key, test) pairs that might match the instance. "
+        out = set(self.unconditional)
+        for attr, values in self.index.items():
+            try:
+                value = getattr(instance, attr)
+            except AttributeError:
+                continue
+            out.update(values.get(smart_str(value), ()))
+        return out
+
+    def matching_tests(self, instance):
+        " Return (key, test) pairs matching the instance, nothing is unregistered. "
+        return set((key, test) for key, test in self.candidates(instance) if check_test(instance, parse_test(test)))
+
+    def match_tests(self, instance, changed=None):
+        """
+        Return keys with a test matching the instance and unregister their
+        tests, with changed (set of field names) given tests whose fields
+        did not change are skipped.
+        """
+        keys = set()
+        for key, test in self.candidates(instance):
+            if key in keys:
+                continue
+            if changed is not None:
+                fields = self.fields.get((key, test))
+                if fields is not None and not fields & changed:
+                    continue
+            if check_test(instance, parse_test(test)):
+                keys.add(key)
+        for key in keys:
+            self.remove_key(key)
+        return keys
+
+    def __len__(self):
+        return len(self.tests) + len(self.pks)
+
+
+class Registry(object):
+    """
+    Keys registered for all the models, models are identified by
+    str(model_class). Also holds dependencies between keys - keys to
+    invalidate together with another key - and specifications of calls
+    regenerating hot keys.
+    """
+    def __init__(self):
+        self.models = {}
+        # src key -> set of dst keys
+        self.dependencies = {}
+        # key -> (path, args, kwargs)
+        self.refreshes = {}
+
+    def get_model(self, model):
+        if model not in self.models:
+            self.models[model] = ModelRegistry()
+        return self.models[model]
+
+    def add_pk(self, model, pk, key):
+        self.get_model(model).add_pk(pk, key)
+
+    def add_test(self, model, test, key, fields=None):
+        self.get_model(model).add_test(test, key, fields)
+
+    def match(self, model, instance, changed=None):
+        """
+        Return keys to invalidate for the changed instance, the keys are
+        unregistered for the instance's pk and all their tests are removed.
+        changed is the set of changed fields if known (see
+        ModelRegistry.match_tests).
+        """
+        if model not in self.models:
+            return set()
+        registry = self.models[model]
+        keys = registry.pop_pk(instance._get_pk_val())
+        keys.update(registry.match_tests(instance, changed))
+        # the keys are gone, their other tests are of no use
+        for key in keys:
+            registry.remove_key(key)
+        return keys
+
+    def add_dependency(self, src_key, dst_key):
+        " Make dst_key invalid whenever src_key is. "
+        if src_key != dst_key:
+            self.dependencies.setdefault(src_key, set()).add(dst_key)
+
+    def pop_dependencies(self, src_key):
+        " Remove and return keys directly depending on src_key. "
+        return self.dependencies.pop(src_key, set())
+
+    def pop_dependents(self, keys, is_local=None):
+        """
+        Return keys together with all the keys depending on them, directly or
+        through other keys, and remove their dependencies. Every key is visited
+        once so cycles in the graph do no harm.
+
+        When is_local is given, dependencies of keys it returns False for are
+        not followed (they are kept by some other registry).
+        """
+        out = set(keys)
+        to_visit = list(out)
+        while to_visit:
+            key = to_visit.pop()
+            if is_local is not None and not is_local(key):
+                continue
+            for dst_key in self.pop_dependencies(key):
+                if dst_key not in out:
+                    out.add(dst_key)
+                    to_visit.append(dst_key)
+        return out
+
+    def add_refresh(self, key, spec):
+        " Regenerate key using spec - (path, args, kwargs) - instead of deleting it. "
+        self.refreshes[key] = spec
+
+    def get_refresh(self, key):
+        return self.refreshes.get(key)
+
+    def pop_refresh(self, key):
+        return self.refreshes.pop(key, None)
+
+
+def read_records(filename):
+    " Return records stored in the file and a flag whether the file was read completely. "
+    records = []
+    if not os.path.exists(filename):
+        return records, True
+    size = os.path.getsize(filename)
+    f = open(filename, 'rb')
+    try:
+        while True:
+            position = f.tell()
+            try:
+                records.append(pickle.load(f))
+            except Exception, e:
+                if isinstance(e, EOFError) and position == size:
+                    return records, True
+                log.warning('CI: Broken record in %s (%s), ignoring the rest of the file.' % (filename, e))
+                return records, False
+    finally:
+        f.close()
+
+def apply_record(registry, record):
+    " Apply record to the in-memory state of the registry without journaling it. "
+    op, args = record[0], record[1:]
+    if op == 'pk':
+        Registry.add_pk(registry, *args)
+    elif op == 'test':
+        Registry.add_test(registry, *args)
+    elif op == 'dep':
+        Registry.add_dependency(registry, *args)
+    elif op == 'drop_pk':
+        model, pk = args
+        registry.get_model(model).pop_pk(pk)
+    elif op == 'drop_key':
+        model, key = args
+        registry.get_model(model).remove_key(key)
+    elif op == 'drop_deps':
+        Registry.pop_dependencies(registry, *args)
+    elif op == 'refresh':
+        Registry.add_refresh(registry, *args)
+    elif op == 'drop_refresh':
+        Registry.pop_refresh(registry, *args)
+
+def read_registry(path, shards, registry=None):
+    """
+    Return Registry with the state stored in path by JournaledRegistry,
+    without touching the files - safe while the invalidator is running.
+    """
+    if registry is None:
+        registry = Registry()
+    for shard in range(shards):
+        for kind in ('snapshot', 'journal'):
+            records, complete = read_records(os.path.join(path, 'registry.%03d.%s' % (shard, kind)))
+            for record in records:
+                apply_record(registry, record)
+    return registry
+
+
+class JournaledRegistry(Registry):
+    """
+    Registry persisted in a directory as a set of shards, every shard
+    consisting of a snapshot and a journal of changes made since the
+    snapshot was taken. Every change only appends a record to the journal of
+    its shard, the shard is compacted (its snapshot rewritten and journal
+    emptied) once the journal holds compact_after records.
+
+    Records are sharded by what they change (model and pk, key or source key
+    of a dependency) so every shard can be replayed and compacted on its own.
+    Replaying a journal over a snapshot it has already been compacted into
+    yields the same state, so a crash during compaction loses nothing.
+    """
+    def __init__(self, path, shards=16, compact_after=10000):
+        super(JournaledRegistry, self).__init__()
+        self.path = path
+        self.shards = shards
+        self.compact_after = compact_after
+        self._journals = {}
+        self._counts = [0] * shards
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.load()
+
+    def _shard(self, subject):
+        return (crc32(smart_str(subject)) & 0xffffffff) % self.shards
+
+    def _pk_shard(self, model, pk):
+        return self._shard('%s:%s' % (model, pk))
+
+    def _file(self, shard, kind):
+        return os.path.join(self.path, 'registry.%03d.%s' % (shard, kind))
+
+    def load(self):
+        for shard in range(self.shards):
+            snapshot, snapshot_complete = read_records(self._file(shard, 'snapshot'))
+            for record in snapshot:
+                apply_record(self, record)
+            journal, journal_complete = read_records(self._file(shard, 'journal'))
+            for record in journal:
+                apply_record(self, record)
+            self._counts[shard] = len(journal)
+            if not (snapshot_complete and journal_complete):
+                # never append after a broken record
+                self.compact(shard)
+
+    def _journal(self, shard, record):
+        f = self._journals.get(shard)
+        if f is None:
+            f = self._journals[shard] = open(self._file(shard, 'journal'), 'ab')
+        pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        self._counts[shard] += 1
+        if self._counts[shard] >= self.compact_after:
+            self.compact(shard)
+
+    def get_records(self, shard):
+        " Return records rebuilding the current state of the shard. "
+        out = []
+        for model, registry in self.models.items():
+            for pk, keys in registry.pks.items():
+                if self._pk_shard(model, pk) == shard:
+                    out.extend(('pk', model, pk, key) for key in keys)
+            for key, tests in registry.tests.items():
+                if self._shard(key) == shard:
+                    out.extend(('test', model, test, key, registry.fields.get((key, test), ())) for test in tests)
+        for src_key, dst_keys in self.dependencies.items():
+            if self._shard(src_key) == shard:
+                out.extend(('dep', src_key, dst_key) for dst_key in dst_keys)
+        for key, spec in self.refreshes.items():
+            if self._shard(key) == shard:
+                out.append(('refresh', key, spec))
+        return out
+
+    def compact(self, shard):
+        " Write the shard's state to a new snapshot and empty its journal. "
+        filename = self._file(shard, 'snapshot')
+        tmp = filename + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            for record in self.get_records(shard):
+                pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+
+        journal = self._journals.pop(shard, None)
+        if journal is not None:
+            journal.close()
+        open(self._file(shard, 'journal'), 'wb').close()
+        self._counts[shard] = 0
+        log.debug('CI: Compacted registry shard %d.' % shard)
+
+    def close(self):
+        for f in self._journals.values():
+            f.close()
+        self._journals = {}
+
+    # repeated registrations are not journaled
+
+    def add_pk(self, model, pk, key):
+        if key in self.get_model(model).pks.get(pk, ()):
+            return
+        super(JournaledRegistry, self).add_pk(model, pk, key)
+        self._journal(self._pk_shard(model, pk), ('pk', model, pk, key))
+
+    def add_test(self, model, test, key, fields=None):
+        if test in self.get_model(model).tests.get(key, ()):
+            return
+        super(JournaledRegistry, self).add_test(model, test, key, fields)
+        self._journal(self._shard(key), ('test', model, test, key, fields))
+
+    def add_dependency(self, src_key, dst_key):
+        if src_key == dst_key or dst_key in self.dependencies.get(src_key, ()):
+            return
+        super(JournaledRegistry, self).add_dependency(src_key, dst_key)
+        self._journal(self._shard(src_key), ('dep', src_key, dst_key))
+
+    def match(self, model, instance, changed=None):
+        pk = instance._get_pk_val()
+        registered_pk = model in self.models and pk in self.models[model].pks
+        keys = super(JournaledRegistry, self).match(model, instance, changed)
+        if registered_pk:
+            self._journal(self._pk_shard(model, pk), ('drop_pk', model, pk))
+        for key in keys:
+            self._journal(self._shard(key), ('drop_key', model, key))
+        return keys
+
+    def pop_dependencies(self, src_key):
+        keys = super(JournaledRegistry, self).pop_dependencies(src_key)
+        if keys:
+            self._journal(self._shard(src_key), ('drop_deps', src_key))
+        return keys
+
+    def add_refresh(self, key, spec):
+        if self.refreshes.get(key) == spec:
+            return
+        super(JournaledRegistry, self).add_refresh(key, spec)
+        self._journal(self._shard(key), ('refresh', key, spec))
+
+    def pop_refresh(self, key):
+        spec = super(JournaledRegistry, self).pop_refresh(key)
+        if spec is not None:
+            self._journal(self._shard(key), ('drop_refresh', key))
+        return spec
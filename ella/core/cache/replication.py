@@ -0,0 +1,90 @@
+"""
+Replicated keys for values read on (almost) every request.
+
+A memcached cluster places every key on a single node so a key read by every
+request - the homepage listing, categories, positions - saturates its node
+long before the cluster is loaded. A replicated key ends with ``.r<K>`` (see
+replicated_key) and its value is stored under K keys ``<key>:0`` ..
+``<key>:<K-1>`` landing on different nodes. Reads go to a random replica,
+writes and deletes to all of them.
+
+Replication is off unless CACHE_REPLICAS is set above 1, CACHE_REPLICATED_MODELS
+then picks the models whose objects and generation counters are replicated.
+
+Functions take the cache backend as their first argument so that they work
+with whatever backend the calling module uses.
+"""
+import re
+import random
+
+from django.conf import settings
+
+
+# number of replicas of a replicated key, 1 turns replication off
+CACHE_REPLICAS = getattr(settings, 'CACHE_REPLICAS', 1)
+# models (app_label.ModelName) whose objects and generation counters are
+# replicated, eg. ('core.Category', 'core.Listing')
+CACHE_REPLICATED_MODELS = getattr(settings, 'CACHE_REPLICATED_MODELS', ())
+
+_replicated = re.compile(r'\.r(\d+)$')
+
+
+def replicated_key(key, replicas=None):
+    " Return key whose value is stored in replicas (CACHE_REPLICAS by default) copies, a single copy means no replication. "
+    if replicas is None:
+        replicas = CACHE_REPLICAS
+    if replicas <= 1:
+        return key
+    return '%s.r%d' % (key, replicas)
+
+def is_replicated_model(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name) in CACHE_REPLICATED_MODELS
+
+def get_replicas(key):
+    " Return all the keys the value of key is stored under. "
+    match = _replicated.search(key)
+    if not match:
+        return [key]
+    return ['%s:%d' % (key, i) for i in range(int(match.group(1)))]
+
+def pick_replica(key):
+    " Return the key to read the value of key from. "
+    match = _replicated.search(key)
+    if not match:
+        return key
+    return '%s:%d' % (key, random.randrange(int(match.group(1))))
+
+def get(cache, key):
+    return cache.get(pick_replica(key))
+
+def get_many(cache, keys):
+    " Return {key: value} for keys found, every replicated key is read from one of its replicas. "
+    picked = dict((pick_replica(key), key) for key in keys)
+    return dict((picked[k], v) for k, v in cache.get_many(picked.keys()).items())
+
+def set(cache, key, value, timeout):
+    for k in get_replicas(key):
+        cache.set(k, value, timeout)
+
+def add(cache, key, value, timeout):
+    for k in get_replicas(key):
+        cache.add(k, value, timeout)
+
+def delete(cache, key):
+    for k in get_replicas(key):
+        cache.delete(k)
+
+def incr(cache, key):
+    """
+    Increment all the replicas as a unit: when any of them is missing, all
+    are deleted and ValueError is raised so that the caller initializes
+    them again (with one value).
+    """
+    replicas = get_replicas(key)
+    for k in replicas:
+        try:
+            cache.incr(k)
+        except ValueError:
+            for k in replicas:
+                cache.delete(k)
+            raise ValueError('Key %s not found' % key)
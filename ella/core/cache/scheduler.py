@@ -0,0 +1,152 @@
+"""
+Exact expiry of cached content at publish boundaries.
+
+Listings and placements appear (publish_from), disappear (publish_to) and
+change their order (priority_from, priority_to) at a given time without
+being saved, so nothing tells the cache and listings, boxes and pages used to
+be cached with short timeouts only. PublishScheduler watches these
+boundaries and when one passes it invalidates the instance as if it was
+saved - bumps its generations (see ella.core.cache.generations) and sends it
+to the cache invalidator.
+
+Pages cached whole by FetchFromCacheMiddleware are keyed by their URL and
+headers only, not registered anywhere, so they still expire by
+CACHE_MIDDLEWARE_SECONDS.
+
+It runs as the publishscheduler management command, tests drive it with a
+FakeClock.
+"""
+import time
+import logging
+from datetime import datetime, timedelta
+
+from django.db.models import Min, get_model
+
+from ella.core.cache.generations import bump_instance_generations
+from ella.core.cache.invalidate import CACHE_DELETER
+
+
+log = logging.getLogger('cache')
+
+# (app_label, model name, boundary fields) of the scheduled models
+BOUNDARY_FIELDS = (
+    ('core', 'Listing', ('publish_from', 'publish_to', 'priority_from', 'priority_to')),
+    ('core', 'Placement', ('publish_from', 'publish_to')),
+)
+
+
+class Clock(object):
+    def now(self):
+        return datetime.now()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+class FakeClock(object):
+    " Clock for tests, the time only moves on sleep() and advance(). "
+    def __init__(self, now):
+        self._now = now
+        self.sleeps = []
+
+    def now(self):
+        return self._now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        self._now += timedelta(seconds=seconds)
+
+def get_boundary_models():
+    return [(get_model(app_label, name), fields) for app_label, name, fields in BOUNDARY_FIELDS]
+
+def total_seconds(delta):
+    return delta.days * 24 * 60 * 60 + delta.seconds + delta.microseconds / 1000000.0
+
+class PublishScheduler(object):
+    """
+    Expires listings and placements whose boundary passed since the last
+    tick. Boundaries passed before the scheduler started are left to the
+    cache timeouts.
+    """
+    def __init__(self, clock=None, interval=60):
+        self.clock = clock or Clock()
+        # boundaries of objects saved meanwhile are found after interval seconds at the latest
+        self.interval = interval
+        self.last = self.clock.now()
+
+    def next_boundaries(self):
+        """
+        Return {category_id: the nearest upcoming boundary of the category's
+        listings and placements}, for inspection, ticks use next_boundary.
+        """
+        out = {}
+        for model, fields in get_boundary_models():
+            for field in fields:
+                qset = model._default_manager.filter(**{'%s__gt' % field: self.last}).order_by()
+                for row in qset.values('category').annotate(boundary=Min(field)):
+                    if row['category'] not in out or row['boundary'] < out[row['category']]:
+                        out[row['category']] = row['boundary']
+        return out
+
+    def next_boundary(self):
+        " Return the nearest upcoming boundary of any category, None if there is none. "
+        boundaries = []
+        for model, fields in get_boundary_models():
+            for field in fields:
+                boundary = model._default_manager.filter(**{'%s__gt' % field: self.last}).aggregate(boundary=Min(field))['boundary']
+                if boundary is not None:
+                    boundaries.append(boundary)
+        if not boundaries:
+            return None
+        return min(boundaries)
+
+    def get_sleep(self):
+        " Seconds to wait for the next boundary, interval at most. "
+        boundary = self.next_boundary()
+        if boundary is None:
+            return self.interval
+        return max(0, min(self.interval, total_seconds(boundary - self.clock.now())))
+
+    def tick(self):
+        " Expire everything whose boundary passed since the last tick, return number of expired instances. "
+        now = self.clock.now()
+        expired = 0
+        for model, fields in get_boundary_models():
+            seen = set()
+            for field in fields:
+                for obj in model._default_manager.filter(**{'%s__gt' % field: self.last, '%s__lte' % field: now}):
+                    if obj.pk not in seen:
+                        seen.add(obj.pk)
+                        self.expire(obj)
+            expired += len(seen)
+        self.last = now
+        return expired
+
+    def expire(self, instance):
+        " Invalidate everything cached for the instance as its save would. "
+        log.debug('Boundary of %s %s passed.' % (instance.__class__.__name__, instance.pk))
+        # the instance appears in or leaves its foreign keys' namespaces
+        bump_instance_generations(instance.__class__, instance, all_fks=True)
+        CACHE_DELETER.invalidate_instance(instance)
+        # publication of a placement shows or hides its publishable's pages
+        # and boxes, those are cached for its concrete class (Article, ...)
+        if getattr(instance, 'publishable_id', None):
+            publishable = instance.publishable
+            target = publishable.target
+            # bumps the namespaces of Publishable as well
+            bump_instance_generations(target.__class__, target, all_fks=True)
+            CACHE_DELETER.invalidate_instance(target)
+            if target.__class__ is not publishable.__class__:
+                CACHE_DELETER.invalidate_instance(publishable)
+
+    def run(self, ticks=None):
+        " Tick on every boundary (or every interval seconds at least), forever or the given number of times. "
+        while ticks is None or ticks > 0:
+            self.clock.sleep(self.get_sleep())
+            expired = self.tick()
+            if expired:
+                log.info('Publish scheduler expired %d objects.' % expired)
+            if ticks is not None:
+                ticks -= 1
@@ -0,0 +1,259 @@
+"""
+Cache telemetry aggregated per key family.
+
+Every cache helper reports the family its key belongs to (KEY_FORMAT_OBJECT,
+KEY_FORMAT_LIST, boxes, the page cache and one family for every function
+decorated with cache_this). Each process accumulates hits, misses, number
+and size of stored values and time spent talking to the cache, and
+periodically adds the numbers to counters kept in the cache backend so that
+the cachestats management command can report on the whole cluster.
+
+Collecting is off unless CACHE_STATS is set, sizes are measured by pickling
+the stored values once more which is not free.
+
+The cache invalidator keeps its own numbers (InvalidatorStats) - messages,
+processing time, keys deleted and the lag between sending a message and
+processing it, per message type - and stores them in the cache backend for
+every partition.
+"""
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import time
+import logging
+from threading import Lock, local
+
+from django.core.cache import cache
+from django.conf import settings
+
+
+log = logging.getLogger('ella.core.cache.stats')
+
+CACHE_STATS = getattr(settings, 'CACHE_STATS', False)
+# how often does a process push its numbers to the cache backend
+CACHE_STATS_FLUSH_INTERVAL = getattr(settings, 'CACHE_STATS_FLUSH_INTERVAL', 60)
+CACHE_STATS_TIMEOUT = getattr(settings, 'CACHE_STATS_TIMEOUT', 7*24*60*60)
+
+STATS_KEY = 'ella.core.cache.stats:%s:%s'
+FAMILIES_KEY = 'ella.core.cache.stats:families'
+
+# times are kept in microseconds so that the backend can incr them
+METRICS = ('hits', 'misses', 'sets', 'set_bytes', 'get_time', 'set_time')
+
+
+def _empty():
+    return dict.fromkeys(METRICS, 0)
+
+def get_size(value):
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except (pickle.PicklingError, TypeError):
+        return 0
+
+class CacheStats(object):
+    """
+    Counters of one process, additionally tracking the current request of
+    every thread between start_request() and end_request().
+    """
+    def __init__(self, enabled=CACHE_STATS, flush_interval=CACHE_STATS_FLUSH_INTERVAL):
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self._lock = Lock()
+        self._request = local()
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._data = {}
+            self._last_flush = time.time()
+        finally:
+            self._lock.release()
+
+    def _add(self, family, **values):
+        self._lock.acquire()
+        try:
+            row = self._data.setdefault(family, _empty())
+            for metric, value in values.items():
+                row[metric] += value
+        finally:
+            self._lock.release()
+
+        request = getattr(self._request, 'data', None)
+        if request is not None:
+            row = request.setdefault(family, _empty())
+            for metric, value in values.items():
+                row[metric] += value
+
+    def record_get(self, family, hits, misses, duration):
+        if self.enabled:
+            self._add(family, hits=hits, misses=misses, get_time=int(duration * 1000000))
+
+    def record_set(self, family, values, duration):
+        if self.enabled:
+            size = sum(get_size(v) for v in values)
+            self._add(family, sets=len(values), set_bytes=size, set_time=int(duration * 1000000))
+
+    def start_request(self):
+        self._request.data = {}
+
+    def end_request(self):
+        " Return numbers for the current request and stop tracking it. "
+        data = getattr(self._request, 'data', None) or {}
+        self._request.data = None
+        return data
+
+    def snapshot(self):
+        self._lock.acquire()
+        try:
+            return dict((family, row.copy()) for family, row in self._data.items())
+        finally:
+            self._lock.release()
+
+    def maybe_flush(self):
+        if self.enabled and self._last_flush + self.flush_interval <= time.time():
+            self.flush()
+
+    def flush(self):
+        " Add the collected numbers to the counters in the cache backend and start over. "
+        data = self.snapshot()
+        self.reset()
+        if not data:
+            return
+
+        families = cache.get(FAMILIES_KEY) or []
+        new = [f for f in data if f not in families]
+        if new:
+            cache.set(FAMILIES_KEY, families + new, CACHE_STATS_TIMEOUT)
+
+        for family, row in data.items():
+            for metric, value in row.items():
+                if not value:
+                    continue
+                key = STATS_KEY % (family, metric)
+                cache.add(key, 0, CACHE_STATS_TIMEOUT)
+                try:
+                    cache.incr(key, value)
+                except ValueError:
+                    log.warning('Cache stats counter %s disappeared, dropping %d.' % (key, value))
+
+STATS = CacheStats()
+
+
+def get_backend_stats():
+    " Return numbers collected by all processes, {family: {metric: value}}. "
+    families = cache.get(FAMILIES_KEY) or []
+    keys = [STATS_KEY % (family, metric) for family in families for metric in METRICS]
+    found = cache.get_many(keys)
+    out = {}
+    for family in families:
+        out[family] = dict((metric, found.get(STATS_KEY % (family, metric), 0)) for metric in METRICS)
+    return out
+
+def reset_backend_stats():
+    for family in cache.get(FAMILIES_KEY) or []:
+        for metric in METRICS:
+            cache.delete(STATS_KEY % (family, metric))
+    cache.delete(FAMILIES_KEY)
+
+def format_stats(data):
+    " Return one line per family, sorted by hits. "
+    lines = []
+    for family, row in sorted(data.items(), key=lambda i: -i[1]['hits']):
+        lookups = row['hits'] + row['misses']
+        lines.append('%s hits=%d misses=%d ratio=%.2f sets=%d set_bytes=%d avg_get_ms=%.2f avg_set_ms=%.2f' % (
+            family, row['hits'], row['misses'],
+            lookups and float(row['hits']) / lookups or 0,
+            row['sets'], row['set_bytes'],
+            lookups and row['get_time'] / 1000.0 / lookups or 0,
+            row['sets'] and row['set_time'] / 1000.0 / row['sets'] or 0,
+        ))
+    return lines
+
+
+INVALIDATOR_STATS_KEY = 'ella.core.cache.stats:invalidator:%d'
+# upper bounds (in seconds) of the invalidation lag histogram buckets
+LAG_BUCKETS = (0.01, 0.1, 1, 10, 60)
+
+def _empty_invalidator_row():
+    return {'messages': 0, 'time': 0.0, 'max_time': 0.0, 'deleted': 0, 'lagged': 0, 'lag': 0.0, 'max_lag': 0.0}
+
+class InvalidatorStats(object):
+    """
+    Counters of one cache invalidator worker (single threaded) since its
+    start. The lag is measured against the time the message was sent by an
+    ella process so the clocks of the machines have to be in sync.
+    """
+    def __init__(self, partition=0, flush_interval=CACHE_STATS_FLUSH_INTERVAL):
+        self.partition = partition
+        self.flush_interval = flush_interval
+        self.started = time.time()
+        self._last_flush = self.started
+        self.data = {}
+        self.lags = [0] * (len(LAG_BUCKETS) + 1)
+
+    def record(self, type, lag, duration, deleted):
+        row = self.data.setdefault(type, _empty_invalidator_row())
+        row['messages'] += 1
+        row['time'] += duration
+        row['max_time'] = max(row['max_time'], duration)
+        row['deleted'] += deleted
+        if lag is None:
+            return
+        row['lagged'] += 1
+        row['lag'] += lag
+        row['max_lag'] = max(row['max_lag'], lag)
+        for i, bound in enumerate(LAG_BUCKETS):
+            if lag <= bound:
+                self.lags[i] += 1
+                break
+        else:
+            self.lags[-1] += 1
+
+    def snapshot(self):
+        return {
+            'partition': self.partition,
+            'started': self.started,
+            'types': dict((type, row.copy()) for type, row in self.data.items()),
+            'lags': list(self.lags),
+        }
+
+    def maybe_flush(self):
+        if self.flush_interval is not None and self._last_flush + self.flush_interval <= time.time():
+            self.flush()
+
+    def flush(self):
+        " Store the numbers in the cache backend and log them. "
+        self._last_flush = time.time()
+        data = self.snapshot()
+        cache.set(INVALIDATOR_STATS_KEY % self.partition, data, CACHE_STATS_TIMEOUT)
+        for line in format_invalidator_stats([data]):
+            log.info(line)
+
+def get_invalidator_stats(partitions):
+    " Return snapshots stored by the invalidator's workers. "
+    found = cache.get_many([INVALIDATOR_STATS_KEY % p for p in range(partitions)])
+    return [found[INVALIDATOR_STATS_KEY % p] for p in range(partitions) if INVALIDATOR_STATS_KEY % p in found]
+
+def reset_invalidator_stats(partitions):
+    for p in range(partitions):
+        cache.delete(INVALIDATOR_STATS_KEY % p)
+
+def format_invalidator_stats(snapshots):
+    " Return one line per partition and message type plus the lag histogram of every partition. "
+    lines = []
+    for data in snapshots:
+        for type, row in sorted(data['types'].items()):
+            lines.append('invalidator[%d] %s messages=%d deleted=%d keys_per_message=%.2f avg_ms=%.2f max_ms=%.2f avg_lag_ms=%.2f max_lag_ms=%.2f' % (
+                data['partition'], type, row['messages'], row['deleted'],
+                row['messages'] and float(row['deleted']) / row['messages'] or 0,
+                row['messages'] and row['time'] * 1000 / row['messages'] or 0,
+                row['max_time'] * 1000,
+                row['lagged'] and row['lag'] * 1000 / row['lagged'] or 0,
+                row['max_lag'] * 1000,
+            ))
+        bounds = ['<=%ss' % b for b in LAG_BUCKETS] + ['>%ss' % LAG_BUCKETS[-1]]
+        lines.append('invalidator[%d] lag %s' % (data['partition'], ' '.join('%s:%d' % (b, n) for b, n in zip(bounds, data['lags']))))
+    return lines
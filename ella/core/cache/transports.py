@@ -0,0 +1,347 @@
+"""
+Transports carrying messages between ella processes (CACHE_DELETER) and the
+cache invalidator.
+
+Every transport delivers messages - (headers, body) pairs with lowercase
+header names - to the invalidator's on_message and the invalidator's
+notifications about deleted keys back to all connected processes.
+
+Configure the transport with CACHE_INVALIDATION_TRANSPORT (dotted path to the
+class) and CACHE_INVALIDATION_TRANSPORT_OPTIONS (keyword arguments of the
+class), by default stomp is used when ACTIVE_MQ_HOST is set.
+
+The invalidator can run as CI_PARTITIONS cooperating workers, each owning
+a part of the registry. Messages are routed to their owner - registrations
+and changed instances by model, dependencies by key (see route()).
+"""
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import os
+import hmac
+import stat
+import time
+import errno
+import glob
+import socket
+import logging
+from hashlib import sha1
+from zlib import crc32
+from threading import Thread
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import smart_str
+from django.conf import settings
+
+
+log = logging.getLogger('cache')
+
+AMQ_DESTINATION = getattr(settings, 'CI_AMQ_DESTINATION', '/topic/ella')
+AMQ_INVALIDATED_DESTINATION = getattr(settings, 'CI_AMQ_INVALIDATED_DESTINATION', '/topic/ella_invalidated')
+AMQ_HOST = getattr(settings, 'ACTIVE_MQ_HOST', None)
+AMQ_PORT = getattr(settings, 'ACTIVE_MQ_PORT', 61613)
+
+# has to be in a directory writable only by the ella and invalidator processes
+CI_SOCKET_PATH = getattr(settings, 'CI_SOCKET_PATH', None)
+CI_PARTITIONS = getattr(settings, 'CI_PARTITIONS', 1)
+
+if AMQ_HOST:
+    DEFAULT_TRANSPORT = 'ella.core.cache.transports.StompTransport'
+else:
+    DEFAULT_TRANSPORT = None
+TRANSPORT = getattr(settings, 'CACHE_INVALIDATION_TRANSPORT', DEFAULT_TRANSPORT)
+TRANSPORT_OPTIONS = getattr(settings, 'CACHE_INVALIDATION_TRANSPORT_OPTIONS', {})
+
+
+def get_transport(path=TRANSPORT, **options):
+    " Return instance of the configured transport or None if there is none. "
+    if not path:
+        return None
+    i = path.rfind('.')
+    module, attr = path[:i], path[i+1:]
+    try:
+        mod = __import__(module, {}, {}, [attr])
+    except ImportError, e:
+        raise ImproperlyConfigured('Error importing cache invalidation transport %s: "%s"' % (module, e))
+    try:
+        cls = getattr(mod, attr)
+    except AttributeError:
+        raise ImproperlyConfigured('Module "%s" does not define a "%s" cache invalidation transport' % (module, attr))
+    kwargs = TRANSPORT_OPTIONS.copy()
+    kwargs.update(options)
+    return cls(**kwargs)
+
+
+def get_partition(value, partitions):
+    if partitions <= 1:
+        return 0
+    return (crc32(smart_str(value)) & 0xffffffff) % partitions
+
+def route(headers, partitions):
+    " Return the partition owning the message. "
+    if headers['type'] in ('pk', 'test', 'del'):
+        return get_partition(headers['model'], partitions)
+    return get_partition(headers['key'], partitions)
+
+
+class BaseTransport(object):
+    def __init__(self, partitions=CI_PARTITIONS):
+        self.partitions = partitions
+
+    # ella processes
+    def connect(self, listener):
+        " Start delivering notifications to listener.on_message. "
+
+    def disconnect(self):
+        pass
+
+    def send(self, headers, body):
+        " Send one message to the invalidator (worker owning it). "
+        self.send_to(route(headers, self.partitions), headers, body)
+
+    def send_to(self, partition, headers, body):
+        raise NotImplementedError
+
+    def send_batch(self, messages):
+        " Send list of (headers, body) pairs as one message to every partition involved. "
+        batches = {}
+        for headers, body in messages:
+            batches.setdefault(route(headers, self.partitions), []).append((headers, body))
+        for partition, batch in batches.items():
+            self.send_batch_to(partition, batch)
+
+    def send_batch_to(self, partition, batch):
+        self.send_to(partition, {'type': 'batch', 'key': None, 'model': None}, pickle.dumps(batch, pickle.HIGHEST_PROTOCOL))
+
+    # the invalidator
+    def serve(self, invalidator, partition=0):
+        " Deliver messages of the partition to invalidator.on_message until interrupted. "
+        raise NotImplementedError
+
+    def notify(self, key):
+        " Let all the connected processes know that key has been deleted. "
+        raise NotImplementedError
+
+
+class InProcessTransport(BaseTransport):
+    """
+    Runs the invalidator (with an in-memory registry) inside the process
+    itself, no broker or daemon is needed. Meant for development and tests.
+    """
+    def __init__(self, partitions=CI_PARTITIONS):
+        # a single invalidator owns everything
+        super(InProcessTransport, self).__init__(1)
+        self.listeners = []
+        self.invalidator = None
+
+    def connect(self, listener):
+        if self.invalidator is None:
+            from ella.core.management.commands.cacheinvalidator import CacheInvalidator
+            from ella.core.cache.registry import Registry
+            self.invalidator = CacheInvalidator(self, Registry())
+        self.listeners.append(listener)
+
+    def disconnect(self):
+        self.listeners = []
+
+    def send_to(self, partition, headers, body):
+        self.invalidator.on_message(headers, body)
+
+    def serve(self, invalidator, partition=0):
+        raise ImproperlyConfigured('InProcessTransport runs the invalidator in the ella process itself.')
+
+    def notify(self, key):
+        for listener in self.listeners:
+            listener.on_message({'type': 'invalidated', 'key': key}, '')
+
+
+class UnixSocketTransport(BaseTransport):
+    """
+    Unix datagram sockets for setups running the invalidator on the same
+    machine as ella. The invalidator listens on path (path.partition<N> for
+    multiple partitions), every ella process binds path.<pid> to receive
+    notifications.
+
+    The sockets' directory must not be world writable and datagrams are
+    signed with SECRET_KEY, those not signed are dropped unread.
+    """
+    max_datagram = 64 * 1024
+
+    def __init__(self, path=CI_SOCKET_PATH, partitions=CI_PARTITIONS):
+        super(UnixSocketTransport, self).__init__(partitions)
+        if not path:
+            raise ImproperlyConfigured('UnixSocketTransport needs CI_SOCKET_PATH (or the path option) set.')
+        directory = os.path.dirname(os.path.abspath(path))
+        if os.stat(directory).st_mode & stat.S_IWOTH:
+            raise ImproperlyConfigured('Directory %s of the cache invalidator sockets must not be world writable.' % directory)
+        self.path = path
+        self.client_path = None
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def _bind(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        return sock
+
+    def _dumps(self, headers, body):
+        data = pickle.dumps((headers, body), pickle.HIGHEST_PROTOCOL)
+        return hmac.new(settings.SECRET_KEY, data, sha1).digest() + data
+
+    def _loads(self, data):
+        " Return (headers, body) of the datagram, ValueError if it is not signed by us. "
+        signature, data = data[:20], data[20:]
+        expected = hmac.new(settings.SECRET_KEY, data, sha1).digest()
+        # compare in constant time
+        if len(signature) != len(expected) or sum([ord(a) ^ ord(b) for a, b in zip(signature, expected)]):
+            raise ValueError('bad signature')
+        return pickle.loads(data)
+
+    def _receive(self, sock, listener):
+        while True:
+            data = sock.recv(self.max_datagram)
+            try:
+                headers, body = self._loads(data)
+            except ValueError, e:
+                log.warning('CI: Dropping message with %s.' % e)
+                continue
+            try:
+                listener.on_message(headers, body)
+            except Exception, e:
+                log.error('CI: Failed to process message (%s).' % e)
+
+    def connect(self, listener):
+        self.client_path = '%s.%d' % (self.path, os.getpid())
+        sock = self._bind(self.client_path)
+        t = Thread(target=self._receive, args=(sock, listener))
+        t.setDaemon(True)
+        t.start()
+
+    def disconnect(self):
+        if self.client_path and os.path.exists(self.client_path):
+            os.unlink(self.client_path)
+
+    def _sendto(self, data, path):
+        " Return the socket.error sending failed with, None on success. "
+        try:
+            self._socket.sendto(data, path)
+        except socket.error, e:
+            log.error('CI: Can not send message to %s (%s).' % (path, e))
+            return e
+        return None
+
+    def _partition_path(self, partition):
+        if self.partitions <= 1:
+            return self.path
+        return '%s.partition%d' % (self.path, partition)
+
+    def send_to(self, partition, headers, body):
+        self._sendto(self._dumps(headers, body), self._partition_path(partition))
+
+    def send_batch_to(self, partition, messages):
+        " Split the batch so that every datagram fits into max_datagram. "
+        batch, size = [], 0
+        for headers, body in messages:
+            length = len(body or '') + 256
+            if batch and size + length > self.max_datagram:
+                super(UnixSocketTransport, self).send_batch_to(partition, batch)
+                batch, size = [], 0
+            batch.append((headers, body))
+            size += length
+        if batch:
+            super(UnixSocketTransport, self).send_batch_to(partition, batch)
+
+    def serve(self, invalidator, partition=0):
+        path = self._partition_path(partition)
+        sock = self._bind(path)
+        log.info('CI now listen on "%s"' % path)
+        try:
+            self._receive(sock, invalidator)
+        finally:
+            sock.close()
+            os.unlink(path)
+
+    def notify(self, key):
+        data = self._dumps({'type': 'invalidated', 'key': key}, '')
+        for path in glob.glob('%s.[0-9]*' % self.path):
+            error = self._sendto(data, path)
+            if error is not None and error.args[0] in (errno.ECONNREFUSED, errno.ENOENT):
+                # nobody listens on the socket, the process is gone
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+
+class StompListener(object):
+    " Passes stomp messages to the listener with lowercase header names. "
+    def __init__(self, listener):
+        self.listener = listener
+
+    def on_error(self, headers, message):
+        log.error('AMQ: %s' % headers)
+
+    def on_disconnected(self):
+        log.error('AMQ: Connection was lost!')
+
+    def on_message(self, headers, message):
+        self.listener.on_message(dict((k.lower(), v) for k, v in headers.items()), message)
+
+class StompTransport(BaseTransport):
+    " ActiveMQ (or any other stomp broker), partitions get destination.<N>. "
+    def __init__(self, host=AMQ_HOST, port=AMQ_PORT, destination=AMQ_DESTINATION, invalidated_destination=AMQ_INVALIDATED_DESTINATION, partitions=CI_PARTITIONS):
+        super(StompTransport, self).__init__(partitions)
+        self.host, self.port = host, port
+        self.destination = destination
+        self.invalidated_destination = invalidated_destination
+        self.conn = None
+
+    def _connect(self, listener, destination):
+        import stomp
+
+        # check connection to defined AMQ
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((self.host, self.port))
+        s.close()
+
+        self.conn = stomp.Connection([(self.host, self.port)])
+        self.conn.add_listener(StompListener(listener))
+        self.conn.start()
+        self.conn.connect()
+        self.conn.subscribe(destination=destination, ack='auto')
+
+    def connect(self, listener):
+        self._connect(listener, self.invalidated_destination)
+
+    def disconnect(self):
+        if self.conn:
+            self.conn.stop()
+
+    def _headers(self, headers):
+        return dict((k.capitalize(), v) for k, v in headers.items())
+
+    def _destination(self, partition):
+        if self.partitions <= 1:
+            return self.destination
+        return '%s.%d' % (self.destination, partition)
+
+    def send_to(self, partition, headers, body):
+        if self.conn:
+            self.conn.send(body, headers=self._headers(headers), destination=self._destination(partition))
+
+    def serve(self, invalidator, partition=0):
+        destination = self._destination(partition)
+        self._connect(invalidator, destination)
+        log.info('CI now listen on "%s"' % destination)
+        try:
+            while True:
+                time.sleep(1)
+        finally:
+            self.conn.unsubscribe(destination=destination)
+            self.conn.stop()
+
+    def notify(self, key):
+        self.conn.send('', headers={'Type': 'invalidated', 'Key': key}, destination=self.invalidated_destination)
@@ -1,7 +1,11 @@
 from hashlib import md5
 import logging
+import time
+from threading import local
 
-from django.db.models import ObjectDoesNotExist
+from django.db.models import ObjectDoesNotExist, signals
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.fields.related import ForeignKey
 from django.core.cache import cache
 from django.http import Http404
 from django.contrib.contenttypes.models import ContentType
@@ -9,6 +13,13 @@ from django.utils.encoding import smart_str
 from django.conf import settings
 
 from ella.core.cache.invalidate import CACHE_DELETER
+from ella.core.cache.local import LOCAL_CACHE, IDENTITY_MAP
+from ella.core.cache.stats import STATS
+from ella.core.cache.encoding import encode, decode
+from ella.core.cache.generations import generation_key, get_generations, note_family, model_namespace, instance_namespace, field_namespace
+from ella.core.cache import replication
+from ella.core.cache.replication import replicated_key, is_replicated_model
+from ella.utils.mutex import EllaMutex
 
 
 log = logging.getLogger('ella.core.cache.utils')
@@ -16,11 +27,140 @@ log = logging.getLogger('ella.core.cache.utils')
 KEY_FORMAT_LIST = 'ella.core.cache.utils.get_cached_list'
 KEY_FORMAT_OBJECT = 'ella.core.cache.utils.get_cached_object'
 CACHE_TIMEOUT = getattr(settings, 'CACHE_TIMEOUT', 10*60)
+# how long after the soft expiry can cache_this serve the stale value
+CACHE_STALE_TIMEOUT = getattr(settings, 'CACHE_STALE_TIMEOUT', CACHE_TIMEOUT)
+# how long can one caller recompute a soft-expired value before others try again
+CACHE_REFRESH_TIMEOUT = getattr(settings, 'CACHE_REFRESH_TIMEOUT', 10)
+# how long to remember that an object does not exist
+CACHE_NEGATIVE_TIMEOUT = getattr(settings, 'CACHE_NEGATIVE_TIMEOUT', 60)
 
+# what to do with objects missing in get_cached_objects
+RAISE, SKIP, NONE = 0, 1, 2
+
+# hit counters for the cache backend, the local tier keeps its own
+BACKEND_STATS = {'hits': 0, 'misses': 0}
+
+# keys deleted by the cache invalidator must not survive in the local tier
+CACHE_DELETER.add_invalidation_listener(LOCAL_CACHE.delete)
+
+def _clear_identity_map(sender, instance, **kwargs):
+    " Objects modified during the request must not be served from the identity map. "
+    IDENTITY_MAP.delete_instance(sender, instance.pk)
+signals.post_save.connect(_clear_identity_map)
+signals.post_delete.connect(_clear_identity_map)
+
+# set while the cache invalidator regenerates a hot key, see regenerate()
+_refresh = local()
+
+def is_refreshing(key):
+    " Is key being regenerated? Its producer should skip the cache lookup and recompute it. "
+    if getattr(_refresh, 'key', None) == key:
+        _refresh.done = True
+        return True
+    return False
+
+def get_callable(path):
+    """
+    Return object at the dotted path, the path continues with attributes
+    after the module, eg. 'ella.core.models.Listing.objects.get_listing'.
+    """
+    parts = path.split('.')
+    for i in range(len(parts) - 1, 0, -1):
+        try:
+            obj = __import__('.'.join(parts[:i]), {}, {}, [parts[i]])
+        except ImportError:
+            continue
+        for attr in parts[i:]:
+            obj = getattr(obj, attr)
+        return obj
+    raise ImportError('Can not import %s' % path)
+
+def regenerate(key, path, args, kwargs):
+    """
+    Call the producer of key at path bypassing the cache for key only (the
+    values it is computed from are read from the cache as usual), so that
+    it recomputes and overwrites key (and registers it again). Used by the
+    cache invalidator for keys registered with CACHE_DELETER.register_refresh.
+
+    Return False if the producer never got to compute key.
+    """
+    _refresh.key = key
+    _refresh.done = False
+    try:
+        get_callable(path)(*args, **kwargs)
+        return _refresh.done
+    finally:
+        _refresh.key = None
+
+
+def _cache_get(key, family):
+    """
+    Get value from the local tier, fall back to the cache backend. family
+    identifies the kind of the key for ella.core.cache.stats.
+    """
+    return _cache_get_tier(key, family)[0]
+
+def _cache_get_tier(key, family):
+    " Like _cache_get, return (value, whether it came from the local tier). "
+    start = time.time()
+    value = LOCAL_CACHE.get(key)
+    local = value is not None
+    if not local:
+        value = replication.get(cache, key)
+        if value is None:
+            BACKEND_STATS['misses'] += 1
+        else:
+            BACKEND_STATS['hits'] += 1
+            LOCAL_CACHE.set(key, value)
+
+    STATS.record_get(family, int(value is not None), int(value is None), time.time() - start)
+    return value, local
+
+def _cache_get_many(keys, family):
+    " Get values for multiple keys from the local tier and the cache backend. "
+    start = time.time()
+    out = LOCAL_CACHE.get_many(keys)
+    if len(out) < len(keys):
+        rest = [key for key in keys if key not in out]
+        found = replication.get_many(cache, rest)
+        BACKEND_STATS['hits'] += len(found)
+        BACKEND_STATS['misses'] += len(rest) - len(found)
+        for key, value in found.items():
+            LOCAL_CACHE.set(key, value)
+        out.update(found)
+
+    STATS.record_get(family, len(out), len(keys) - len(out), time.time() - start)
+    return out
+
+def _cache_set(key, value, timeout, family):
+    start = time.time()
+    replication.set(cache, key, value, timeout)
+    STATS.record_set(family, [value], time.time() - start)
+    LOCAL_CACHE.set(key, value, timeout)
+
+def _cache_set_many(data, timeout, family):
+    start = time.time()
+    if hasattr(cache, 'set_many'):
+        cache.set_many(dict((k, value) for key, value in data.items() for k in replication.get_replicas(key)), timeout)
+    else:
+        for key, value in data.items():
+            replication.set(cache, key, value, timeout)
+    STATS.record_set(family, data.values(), time.time() - start)
+    for key, value in data.items():
+        LOCAL_CACHE.set(key, value, timeout)
+
+def get_cache_stats():
+    " Return hit and miss counts for the local tier and the cache backend. "
+    return {
+        'local': {'hits': LOCAL_CACHE.hits, 'misses': LOCAL_CACHE.misses, 'entries': len(LOCAL_CACHE)},
+        'backend': BACKEND_STATS.copy(),
+    }
 
 def delete_cached_object(key, auto_normalize=True):
     """ proxy function for direct object deletion from cache. May be implemented through ActiveMQ in future. """
-    cache.delete(normalize_key(key))
+    key = normalize_key(key)
+    replication.delete(cache, key)
+    LOCAL_CACHE.delete(key)
 
 def normalize_key(key):
     return md5(key).hexdigest()
@@ -30,20 +170,121 @@ def dump_param(param):
         return '|'.join((param._meta.app_label, param._meta.object_name, str(param.pk)))
     return smart_str(param)
 
+class DoesNotExistMarker(object):
+    " Cached in place of objects that do not exist in the database. "
+
+def _get_lookup_fields(model, kwargs):
+    """
+    Return (field, value) pairs for lookups in kwargs that test the equality
+    of a concrete field of the model (and could thus be checked on the instance
+    itself), other lookups (spanning relations, non-exact) are left out.
+    """
+    opts = model._meta
+    out = []
+    for lookup, value in kwargs.items():
+        bits = lookup.split('__')
+        if len(bits) > 1 and bits[-1] == 'exact':
+            bits.pop()
+
+        if bits[0] == 'pk':
+            field = opts.pk
+        else:
+            try:
+                field = opts.get_field(bits[0])
+            except FieldDoesNotExist:
+                continue
+            if field not in opts.fields:
+                # many to many relation
+                continue
+
+        if len(bits) == 2 and field.rel and bits[1] in ('id', 'pk'):
+            pass
+        elif len(bits) > 1:
+            continue
+
+        if hasattr(value, 'pk'):
+            value = value.pk
+        out.append((field, value))
+    return out
+
+def _get_test(model, kwargs):
+    """
+    Translate lookup kwargs into an invalidation test string ("attr:value;attr:value")
+    for CACHE_DELETER.register_test. Lookups that cannot be checked on the
+    instance itself are left out which makes the test match more instances,
+    never less.
+    """
+    return ';'.join(sorted('%s:%s' % c for c in _get_test_conditions(model, kwargs)))
+
+def _get_test_conditions(model, kwargs):
+    " Return (attname, value) pairs of _get_test's test. "
+    out = []
+    for field, value in _get_lookup_fields(model, kwargs):
+        value = smart_str(value)
+        if ':' in value or ';' in value:
+            continue
+        out.append((field.attname, value))
+    return out
+
+def _get_test_fields(model, kwargs):
+    """
+    Return fields of _get_test's test for CACHE_DELETER.register_test - the
+    test's attributes, or all fields (empty list) when some of the lookups
+    are left out of the test.
+    """
+    conditions = _get_test_conditions(model, kwargs)
+    if len(conditions) < len(kwargs):
+        return []
+    return [attname for attname, value in conditions]
+
+def _get_namespaces(model, kwargs):
+    """
+    Pick the narrowest generation namespaces containing all objects matching
+    the lookup: the instance for pk lookups, instances with the same values
+    in each of the lookup's foreign keys or all the model's instances.
+    Foreign key namespaces are only bumped on changes of the fields they
+    know of (see ella.core.cache.generations), lookups of other fields and
+    those _get_lookup_fields leaves out (spanning relations, non-exact) take
+    the model's.
+    """
+    fields = _get_lookup_fields(model, kwargs)
+    fks = []
+    others = len(fields) < len(kwargs)
+    for field, value in fields:
+        if field is model._meta.pk:
+            return [instance_namespace(model, value)]
+        if isinstance(field, ForeignKey):
+            fks.append((field.attname, value))
+        else:
+            others = True
+    if fks and not others:
+        # a change of any of the foreign keys only bumps its own namespaces
+        return [field_namespace(model, attname, value) for attname, value in sorted(fks)]
+    return [model_namespace(model)]
+
 def _get_key(start, model, kwargs):
     for key, val in kwargs.iteritems():
         if hasattr(val, 'pk'):
             kwargs[key] = val.pk
-    return normalize_key(start + ':'.join((
+    key = normalize_key(start + ':'.join((
                 model._meta.app_label,
                 model._meta.object_name,
                 ','.join(':'.join((key, dump_param(kwargs[key]))) for key in sorted(kwargs.keys()))
     )))
+    if is_replicated_model(model):
+        key = replicated_key(key)
+    return key
 
 def get_cached_list(model, *args, **kwargs):
     """
-    Return a cached list. If the list does not exist in the cache, create it
-    and register it for invalidation if any object from the list is updated (check via _get_pk_val()).
+    Return a cached list. Only the ordered list of primary keys is stored
+    under the list's key, the objects themselves are cached individually
+    (under the same keys get_cached_object uses) and fetched in bulk via
+    get_cached_objects. Editing an object thus only touches the object's key.
+
+    The list's key includes the generation of the namespace picked by
+    _get_namespaces so saving or deleting any object that is or was part of
+    the list starts a new one.
 
     Params:
         model - Model class ContentType instance representing the model's class
@@ -54,15 +295,26 @@ def get_cached_list(model, *args, **kwargs):
         model = model.model_class()
 
     key = _get_key(KEY_FORMAT_LIST, model, kwargs)
+    key = normalize_key(generation_key(key, _get_namespaces(model, kwargs), KEY_FORMAT_LIST))
+    if is_replicated_model(model):
+        key = replicated_key(key)
 
-    l = cache.get(key)
-    if l is None:
-        log.debug('get_cached_list(model=%s), object not cached.' % str(model))
-        l = list(model._default_manager.filter(*args, **kwargs))
-        cache.set(key, l, CACHE_TIMEOUT)
-        for o in l:
-            CACHE_DELETER.register_pk(o, key)
-        #CACHE_DELETER.register_test(model, lambda x: model._default_manager.filter(**kwargs).filter(pk=x._get_pk_val()) == 1, key)
+    pks = _cache_get(key, KEY_FORMAT_LIST)
+    if pks is not None:
+        return get_cached_objects(pks, model=model, missing=SKIP)
+
+    log.debug('get_cached_list(model=%s), object not cached.' % str(model))
+    l = list(model._default_manager.filter(*args, **kwargs))
+
+    objects = {}
+    for o in l:
+        obj_key = _get_key(KEY_FORMAT_OBJECT, model, {'pk': o.pk})
+        objects[obj_key] = encode(o)
+        CACHE_DELETER.register_pk(o, obj_key)
+    if objects:
+        _cache_set_many(objects, CACHE_TIMEOUT, KEY_FORMAT_OBJECT)
+
+    _cache_set(key, [o.pk for o in l], CACHE_TIMEOUT, KEY_FORMAT_LIST)
     return l
 
 def get_cached_object(model, **kwargs):
@@ -75,20 +327,116 @@ def get_cached_object(model, **kwargs):
         **kwargs - lookup parameters for content_type.get_object_for_this_type and for key creation
 
     Throws:
-        model.DoesNotExist is propagated from content_type.get_object_for_this_type
+        model.DoesNotExist is propagated from content_type.get_object_for_this_type,
+        the fact that the object does not exist is cached for CACHE_NEGATIVE_TIMEOUT
+        seconds or until a matching object is saved
     """
     if isinstance(model, ContentType):
         model = model.model_class()
 
     key = _get_key(KEY_FORMAT_OBJECT, model, kwargs)
 
-    obj = cache.get(key)
+    obj = IDENTITY_MAP.get(key)
+    if obj is not None:
+        return obj
+
+    obj = decode(_cache_get(key, KEY_FORMAT_OBJECT))
     if obj is None:
-        obj = model._default_manager.get(**kwargs)
-        cache.set(key, obj, CACHE_TIMEOUT)
+        try:
+            obj = model._default_manager.get(**kwargs)
+        except model.DoesNotExist:
+            _cache_set(key, DoesNotExistMarker(), CACHE_NEGATIVE_TIMEOUT, KEY_FORMAT_OBJECT)
+            CACHE_DELETER.register_test(model, _get_test(model, kwargs), key, _get_test_fields(model, kwargs))
+            raise
+        _cache_set(key, encode(obj), CACHE_TIMEOUT, KEY_FORMAT_OBJECT)
         CACHE_DELETER.register_pk(obj, key)
+    elif isinstance(obj, DoesNotExistMarker):
+        raise model.DoesNotExist('%s matching query does not exist.' % model._meta.object_name)
+    IDENTITY_MAP.set(key, obj)
     return obj
 
+def get_cached_objects(pks, model=None, timeout=CACHE_TIMEOUT, missing=RAISE):
+    """
+    Return a list of cached objects in the order of pks. All the objects are
+    fetched from the cache with a single get_many call, objects missing in the
+    cache are retrieved from the database with one pk__in query per model and
+    stored in the cache (and registered for invalidation) afterwards.
+
+    Params:
+        pks - list of primary keys of objects of the model given or list of
+              (content_type_id, pk) tuples if model is None
+        model - Model class or ContentType instance representing the model's class
+        timeout - cache timeout for newly cached objects
+        missing - what to do with objects that do not exist in the database:
+                  RAISE (default) - raise model.DoesNotExist
+                  SKIP - leave them out of the result
+                  NONE - put None in their place
+
+    Throws:
+        model.DoesNotExist if any of the objects doesn't exist and missing is RAISE
+    """
+    if model is not None:
+        if isinstance(model, ContentType):
+            model = model.model_class()
+        pks = [(model, pk) for pk in pks]
+    else:
+        pks = [(ContentType.objects.get_for_id(ct_id).model_class(), pk) for ct_id, pk in pks]
+
+    keys = [_get_key(KEY_FORMAT_OBJECT, m, {'pk': pk}) for m, pk in pks]
+
+    cached = IDENTITY_MAP.get_many(keys)
+    if len(cached) < len(keys):
+        found = _cache_get_many([key for key in keys if key not in cached], KEY_FORMAT_OBJECT)
+        for key, o in found.items():
+            o = decode(o)
+            if o is None:
+                # encoded for a different schema
+                continue
+            if not isinstance(o, DoesNotExistMarker):
+                IDENTITY_MAP.set(key, o)
+            cached[key] = o
+
+    # group the misses by model so that we can fetch them using one query per model
+    to_fetch = {}
+    for (m, pk), key in zip(pks, keys):
+        if key not in cached:
+            to_fetch.setdefault(m, {})[key] = pk
+
+    fetched = {}
+    not_found = {}
+    for m, m_keys in to_fetch.items():
+        log.debug('get_cached_objects(model=%s), %d objects not cached.' % (str(m), len(m_keys)))
+        for o in m._default_manager.filter(pk__in=m_keys.values()):
+            key = _get_key(KEY_FORMAT_OBJECT, m, {'pk': o.pk})
+            fetched[key] = o
+            CACHE_DELETER.register_pk(o, key)
+
+        # remember the objects that do not exist
+        for key, pk in m_keys.items():
+            if key not in fetched:
+                not_found[key] = DoesNotExistMarker()
+                CACHE_DELETER.register_test(m, _get_test(m, {'pk': pk}), key, _get_test_fields(m, {'pk': pk}))
+
+    if fetched:
+        _cache_set_many(dict((key, encode(o)) for key, o in fetched.items()), timeout, KEY_FORMAT_OBJECT)
+        for key, o in fetched.items():
+            IDENTITY_MAP.set(key, o)
+        cached.update(fetched)
+
+    if not_found:
+        _cache_set_many(not_found, CACHE_NEGATIVE_TIMEOUT, KEY_FORMAT_OBJECT)
+        cached.update(not_found)
+
+    out = []
+    for (m, pk), key in zip(pks, keys):
+        if key in cached and not isinstance(cached[key], DoesNotExistMarker):
+            out.append(cached[key])
+        elif missing == RAISE:
+            raise m.DoesNotExist('%s matching query does not exist (pk=%s).' % (m._meta.object_name, pk))
+        elif missing == NONE:
+            out.append(None)
+    return out
+
 def get_cached_object_or_404(model, **kwargs):
     """
     Shortcut that will raise Http404 if there is no object matching the query
@@ -100,18 +448,124 @@ def get_cached_object_or_404(model, **kwargs):
     except ObjectDoesNotExist, e:
         raise Http404('Reason: %s' % str(e))
 
-def cache_this(key_getter, invalidator=None, timeout=CACHE_TIMEOUT):
+class SoftExpiringValue(object):
+    """
+    Value stored by cache_this along with the time it should be recomputed
+    and, for hot keys, the generations it was computed in.
+    """
+    def __init__(self, value, soft_timeout, generations=None):
+        self.value = value
+        self.soft_expires = time.time() + soft_timeout
+        self.generations = generations
+
+    def is_expired(self, generations=None):
+        if generations is not None and getattr(self, 'generations', None) != generations:
+            return True
+        return self.soft_expires <= time.time()
+
+def cache_this(key_getter, invalidator=None, timeout=CACHE_TIMEOUT, soft_timeout=None, generations=None, refresh=None, replicate=False):
+    """
+    Decorator caching the function's result under key returned by key_getter(func, *args, **kwargs).
+
+    Params:
+        key_getter - function constructing the cache key
+        invalidator - function called with the key and the function's arguments
+                      when the result is recomputed, used to register
+                      invalidation tests with CACHE_DELETER
+        timeout - (hard) timeout of the cached value
+        soft_timeout - when set, the value is recomputed after soft_timeout
+                       seconds by one caller only (guarded by EllaMutex) while
+                       the others keep getting the stale value until the hard
+                       timeout passes
+        generations - function returning list of generation namespaces (see
+                      ella.core.cache.generations) for the function's
+                      arguments, their generations become part of the key
+        refresh - function marking hot keys, returns None or (path, args,
+                  kwargs, tests) for the function's arguments - the cache
+                  invalidator then regenerates the value by calling the
+                  callable at path (see regenerate()) instead of deleting it
+                  whenever an instance matching one of the tests (list of
+                  (model, test, fields) triples, see
+                  CACHE_DELETER.register_test) changes. Keys are only hot
+                  while CACHE_DELETER has a transport. Their generations
+                  are stored with the value instead of the key (the save
+                  bumping a generation would move the readers to an empty
+                  key before the invalidator regenerates the old one), a
+                  value of an older generation the invalidator missed is
+                  served stale while one caller recomputes it
+        replicate - True or function returning True for the function's
+                    arguments when the value is read so often that it should
+                    be stored in several replicas (see
+                    ella.core.cache.replication)
+    """
     def wrapped_decorator(func):
+        # key family for ella.core.cache.stats
+        family = '%s.%s' % (func.__module__, func.__name__)
+
+        def recompute(key, spec, gens, *args, **kwargs):
+            result = func(*args, **kwargs)
+            if gens is not None:
+                _cache_set(key, SoftExpiringValue(result, soft_timeout or timeout, gens), timeout, family)
+            elif soft_timeout is None:
+                _cache_set(key, result, timeout, family)
+            else:
+                _cache_set(key, SoftExpiringValue(result, soft_timeout), timeout, family)
+            if invalidator:
+                invalidator(key, *args, **kwargs)
+            if spec:
+                path, r_args, r_kwargs, tests = spec
+                for model, test, fields in tests:
+                    CACHE_DELETER.register_test(model, test, key, fields)
+                CACHE_DELETER.register_refresh(key, path, r_args, r_kwargs)
+            return result
+
         def wrapped_func(*args, **kwargs):
-            key = normalize_key(key_getter(func, *args, **kwargs))
-            result = cache.get(key)
+            spec = gens = None
+            if refresh and CACHE_DELETER.transport:
+                spec = refresh(func, *args, **kwargs)
+            key = key_getter(func, *args, **kwargs)
+            if generations:
+                namespaces = generations(func, *args, **kwargs)
+                if spec:
+                    note_family(namespaces, family)
+                    gens = get_generations(namespaces)
+                else:
+                    key = generation_key(key, namespaces, family)
+            key = normalize_key(key)
+            if replicate is True or (replicate and replicate(func, *args, **kwargs)):
+                key = replicated_key(key)
+            if is_refreshing(key):
+                log.debug('cache_this(key=%s), regenerating hot key.' % key)
+                return recompute(key, spec, gens, *args, **kwargs)
+            result, local = _cache_get_tier(key, family)
             if result is None:
                 log.debug('cache_this(key=%s), object not cached.' % key)
-                result = func(*args, **kwargs)
-                cache.set(key, result, timeout)
-                if invalidator:
-                    invalidator(key, *args, **kwargs)
-            return result
+                return recompute(key, spec, gens, *args, **kwargs)
+
+            if not isinstance(result, SoftExpiringValue):
+                return result
+
+            if not result.is_expired(gens):
+                return result.value
+
+            if local:
+                # the local copy may have been refreshed in the backend already
+                fresh = replication.get(cache, key)
+                if isinstance(fresh, SoftExpiringValue) and not fresh.is_expired(gens):
+                    LOCAL_CACHE.set(key, fresh, timeout)
+                    return fresh.value
+
+            mutex = EllaMutex('%s:refresh' % key, CACHE_REFRESH_TIMEOUT)
+            if not mutex.lock():
+                # somebody else is already working on it
+                log.debug('cache_this(key=%s), serving stale value.' % key)
+                return result.value
+
+            log.debug('cache_this(key=%s), refreshing soft-expired value.' % key)
+            try:
+                return recompute(key, spec, gens, *args, **kwargs)
+            finally:
+                mutex.unlock()
 
         wrapped_func.__dict__ = func.__dict__
         wrapped_func.__doc__ = func.__doc__
@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+
+from ella.core.cache.explain import get_registry, explain, format_explanation, get_totals, explain_generations, format_generations
+from ella.core.cache.transports import CI_PARTITIONS
+
+
+class Command(BaseCommand):
+    help = 'List cache keys the cache invalidator deletes when the object changes, with their dependents and sizes, and the generation namespaces it bumps.'
+    args = '<app_label.model> <pk>'
+    option_list = BaseCommand.option_list + (
+        make_option('--partitions', type='int', dest='partitions', default=CI_PARTITIONS,
+            help='Number of the cache invalidator\'s partitions.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2 or '.' not in args[0]:
+            raise CommandError('Usage: cacheexplain %s' % self.args)
+        model = models.get_model(*args[0].split('.', 1))
+        if model is None:
+            raise CommandError('Unknown model %s.' % args[0])
+        try:
+            obj = model._default_manager.get(pk=args[1])
+        except model.DoesNotExist:
+            raise CommandError('%s with pk %s does not exist.' % (args[0], args[1]))
+
+        entries = explain(obj, get_registry(options['partitions']))
+        for line in format_explanation(entries):
+            print line
+        keys, size = get_totals(entries)
+        print '%d keys, %d bytes cached' % (keys, size)
+        print
+        for line in format_generations(explain_generations(obj)):
+            print line
@@ -3,190 +3,289 @@ try:
 except ImportError:
     import pickle
 
+import os
 import time
+import signal
 import logging
-import stomp
-import socket
+import tempfile
+from optparse import make_option
+
 from django.core.cache import cache
 from django.core.management.base import BaseCommand, CommandError
-from django.utils.datastructures import MultiValueDict
 from django.conf import settings
 
+from ella.core.cache.registry import JournaledRegistry
+from ella.core.cache.stats import InvalidatorStats
+from ella.core.cache import replication
+from ella.core.cache.transports import get_transport, get_partition, CI_PARTITIONS
 
-log = logging.getLogger('cache')
 
-AMQ_DESTINATION = getattr(settings, 'CI_AMQ_DESTINATION', '/topic/ella')
-AMQ_HOST = getattr(settings, 'ACTIVE_MQ_HOST', None)
-AMQ_PORT = getattr(settings, 'ACTIVE_MQ_PORT', 61613)
+log = logging.getLogger('cache')
 
-REGISTER_KEY = getattr(settings, 'CI_REGISTER_KEY', 'ella_ci_register')
-DEPS_KEY = getattr(settings, 'CI_DEPS_KEY', 'ella_ci_deps')
+# directory holding the registry's snapshots and journals
+REGISTRY_DIR = getattr(settings, 'CI_REGISTRY_DIR', os.path.join(tempfile.gettempdir(), 'ella_ci_registry'))
+REGISTRY_SHARDS = getattr(settings, 'CI_REGISTRY_SHARDS', 16)
+# number of journaled changes after which a shard's snapshot is rewritten
+REGISTRY_COMPACT_AFTER = getattr(settings, 'CI_REGISTRY_COMPACT_AFTER', 10000)
+
+
+class MessageLog(object):
+    " Append-only file of (received, headers, body) records, see the replayinvalidations command. "
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab')
+
+    def write(self, received, headers, body):
+        pickle.dump((received, headers, body), self._file, pickle.HIGHEST_PROTOCOL)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+def read_message_log(path):
+    " Yield records of a message log, a record broken by a crash ends it. "
+    f = open(path, 'rb')
+    try:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+            except Exception, e:
+                log.warning('CI: Broken record in %s (%s), ignoring the rest of the file.' % (path, e))
+                return
+    finally:
+        f.close()
 
 
 class CacheInvalidator(object):
-    def __init__(self):
-        self._register = self._register_get()
-        self._dependencies = self._dependencies_get()
-
-    def _register_get(self):
-        r = cache.get(REGISTER_KEY)
-        if not r:
-            return {}
-        log.info('CI: I have loaded existing register from cache.')
-        return r
-
-    def _register_save(self):
-        cache.set(REGISTER_KEY, self._register)
-
-    def _dependencies_get(self):
-        d = cache.get(DEPS_KEY)
-        if not d:
-            return {}
-        log.info('CI: I have loaded existing dependencies from cache.')
-        return d
-
-    def _dependencies_save(self):
-        cache.set(DEPS_KEY, self._dependencies)
-
-    def on_error(self, headers, message):
-        log.error('ActiveMQ/Stomp on_error')
-
-    def on_disconnected(self):
-        log.error('CI: Connection was lost!')
-
-    def on_message(self, headers, message):
-        " Process message from ActiveMQ "
-
+    """
+    Keeps the registry of cached keys and deletes them when objects change.
+
+    With multiple partitions every worker owns the registrations of some
+    models and the dependencies of some keys (see
+    ella.core.cache.transports.route) and hands over keys whose dependencies
+    live elsewhere to their owners.
+
+    Hot keys registered with CACHE_DELETER.register_refresh are regenerated
+    instead of deleted, by the worker owning the key.
+
+    Lag, processing time and keys deleted are counted per message type in
+    self.stats, all received messages are written to message_log if given.
+    """
+    def __init__(self, transport=None, registry=None, partition=0, message_log=None):
+        self.transport = transport
+        self.partition = partition
+        self.message_log = message_log
+        self.stats = InvalidatorStats(partition)
+        # keys deleted or regenerated so far
+        self.deleted = 0
+        if transport is not None:
+            self.partitions = transport.partitions
+        else:
+            self.partitions = 1
+        if registry is None:
+            path = REGISTRY_DIR
+            if self.partitions > 1:
+                path = os.path.join(path, str(partition))
+            registry = JournaledRegistry(path, REGISTRY_SHARDS, REGISTRY_COMPACT_AFTER)
+            log.info('CI: I have loaded existing register from %s.' % path)
+        self._register = registry
+
+    def owns(self, key):
+        " Are the dependencies of key kept by this worker? "
+        return get_partition(key, self.partitions) == self.partition
+
+    def on_message(self, headers, message, received=None):
+        " Process message from the transport "
+        if received is None:
+            received = time.time()
+        if self.message_log is not None:
+            self.message_log.write(received, headers, message)
+
+        if headers['type'] == 'batch':
+            for h, m in pickle.loads(message):
+                self.measure(h, m, received)
+        else:
+            self.measure(headers, message, received)
+        self.stats.maybe_flush()
+
+    def measure(self, headers, message, received):
+        " Process one message and record its lag, processing time and number of keys deleted "
+        deleted = self.deleted
+        start = time.time()
+        try:
+            self.process(headers, message)
+        finally:
+            lag = None
+            if headers.get('sent'):
+                lag = received - float(headers['sent'])
+            self.stats.record(headers['type'], lag, time.time() - start, self.deleted - deleted)
+
+    def process(self, headers, message):
         type = headers['type']
         key = headers['key']
 
         if type == 'pk':
-            self.append_pk(pickle.loads(message), key)
+            self.append_pk(headers['model'], message, key)
         elif type == 'test':
-            self.append_test(headers['model'], message, key)
+            fields = headers.get('fields')
+            if fields is not None:
+                fields = [f for f in fields.split(',') if f]
+            self.append_test(headers['model'], message, key, fields)
         elif type == 'del':
             self.run(pickle.loads(message))
         elif type == 'dep':
             self.register_dependency(key, headers['model'])
+        elif type == 'dependents':
+            self.invalidate([key])
+        elif type == 'refresh':
+            self._register.add_refresh(key, pickle.loads(message))
 
-    def append_model(self, model):
-        " Append model to _registry "
-
-        if model not in self._register:
-            self._register[model] = (MultiValueDict(), MultiValueDict())
-            log.debug('CI appended model: %s' % model)
-
-    def append_test(self, model, test, key):
+    def append_test(self, model, test, key, fields=None):
         " Append invalidation test to _registry "
 
-        self.append_model(model)
-        self._register[model][1].appendlist(key, test)
-        self._register_save()
+        self._register.add_test(model, test, key, fields)
         log.debug('CI appended test - model: %s, test: %s, key: %s' % (model, test, key))
 
-    def append_pk(self, instance, key):
+    def append_pk(self, model, pk, key):
         " Append PK to _registry "
 
-        # We need key for _register as string
-        modelkey = str(instance.__class__)
-        self.append_model(modelkey)
-        self._register[modelkey][0].appendlist(instance._get_pk_val(), key)
-        self._register_save()
-#        log.debug('CI appended PK, model: %s, pk: %s, key: %s' % (instance.__class__, instance._get_pk_val(), key))
+        self._register.add_pk(model, pk, key)
 
     def register_dependency(self, src_key, dst_key):
-        if src_key not in self._dependencies:
-            self._dependencies[src_key] = list()
-        self._dependencies[src_key].append(dst_key)
-        self._dependencies_save()
+        self._register.add_dependency(src_key, dst_key)
         log.debug('CI register dependency, src: %s, dst: %s' % (src_key, dst_key))
 
-    def _check_test(self, instance, test_str):
-        " Check test params on instance "
+    def run(self, instance):
+        " Process cache invalidation PKs and tests for the changed instance (InstanceDescriptor) "
 
-        log.debug('Trying test "%s" for %s.' % (test_str, instance))
+        sender = instance.model
 
-        if not test_str:
-            return True
+        log.debug('CI start processing invalidation sender: %s, inst: %s, changed: %s.' % (sender, instance, instance.changed))
 
-        # Parse string
-        for subtest in test_str.split(';'):
-            attr = subtest.split(':')
-            if not (str(instance.__getattribute__(attr[0].strip())) == attr[1].strip()):
-                return False
-        log.debug('CI True test(s) %s on %s.' % (test_str, instance))
-        return True
+        keys = self._register.match(sender, instance, instance.changed)
+        if keys:
+            self.invalidate(keys)
 
-    def run(self, instance):
-        " Process cache invalidation PKs and tests "
-
-        sender = str(instance.__class__)
-
-        log.debug('CI start processing invalidation sender: %s, inst: %s.' % (sender, instance))
-
-        if sender in self._register:
-            log.debug('CI Sender %s is in _register.' % sender)
-            pks, tests = self._register[sender]
-            if instance._get_pk_val() in pks:
-                for key in pks.getlist(instance._get_pk_val()):
-                    self.invalidate(sender, key, from_test=False)
-                del pks[instance._get_pk_val()]
-                self._register_save()
-
-            for key in tests.keys():
-                for t in tests.getlist(key):
-                    if self._check_test(instance, t):
-                        self.invalidate(sender, key)
-                        del tests[key]
-                        self._register_save()
-                        break
-
-    def invalidate(self, sender, key, from_test=True):
-        " Invaidate cache "
-        cache.delete(key)
-        log.debug('CI invalidate key "%s".' % key)
+    def notify(self, key):
+        " Let the local cache tiers of all ella processes know the key is gone "
+        if self.transport:
+            self.transport.notify(key)
 
-        # Process cache dependencies
-        if key in self._dependencies.keys():
-            for dst in self._dependencies[key]:
-                log.debug('CI dependency invalidate key "%s".' % dst)
-                cache.delete(dst)
-            del self._dependencies[key]
-            self._dependencies_save()
+    def delete(self, key):
+        replication.delete(cache, key)
+        self.deleted += 1
+        self.notify(key)
+        log.debug('CI invalidate key "%s".' % key)
 
+    def regenerate(self, key):
+        """
+        Overwrite the hot key with a freshly computed value, the producer
+        registers the key (or its next generation) again. Falls back to
+        deleting the key if the producer fails or does not compute the key.
+        """
+        path, args, kwargs = self._register.pop_refresh(key)
+        # imported here so that the invalidator can run without loading models
+        from ella.core.cache.invalidate import CACHE_DELETER
+        from ella.core.cache.utils import regenerate
+
+        CACHE_DELETER.start_batch()
+        try:
+            try:
+                if regenerate(key, path, args, kwargs):
+                    log.debug('CI regenerated key "%s".' % key)
+                else:
+                    log.warning('CI: Key "%s" not computed by %s, deleting it.' % (key, path))
+                    replication.delete(cache, key)
+            except Exception, e:
+                log.error('CI: Failed to regenerate key "%s" (%s), deleting it.' % (key, e))
+                replication.delete(cache, key)
+        finally:
+            messages = CACHE_DELETER.pop_batch()
+        if messages and self.transport:
+            self.transport.send_batch(messages)
+        self.deleted += 1
+        self.notify(key)
+
+    def invalidate(self, keys):
+        " Invalidate keys and all the keys depending on them "
+        for key in keys:
+            # hot keys stay in the cache until they are regenerated, only
+            # the key's owner knows whether it is hot
+            if self.owns(key) and self._register.get_refresh(key) is None:
+                self.delete(key)
+        self.invalidate_dependents(keys)
+
+    def invalidate_dependents(self, keys):
+        " Invalidate keys depending on already invalidated keys, regenerate the hot ones "
+        dependents = self._register.pop_dependents(keys, self.owns)
+        for key in dependents:
+            if not self.owns(key):
+                # the key's refresh and dependencies are kept by another worker
+                self.transport.send({'type': 'dependents', 'key': key, 'model': None}, '')
+            elif self._register.get_refresh(key) is not None:
+                self.regenerate(key)
+            elif key not in keys:
+                self.delete(key)
+
+
+def serve(transport, partition, record=None):
+    message_log = None
+    if record:
+        if transport.partitions > 1:
+            record = '%s.%d' % (record, partition)
+        message_log = MessageLog(record)
+    invalidator = CacheInvalidator(transport, partition=partition, message_log=message_log)
+    try:
+        transport.serve(invalidator, partition)
+    except KeyboardInterrupt:
+        log.info('Connection was closed...')
+    finally:
+        invalidator.stats.flush()
+        invalidator._register.close()
+        if message_log is not None:
+            message_log.close()
 
 class Command(BaseCommand):
     help = 'Run cache invalidator.'
+    option_list = BaseCommand.option_list + (
+        make_option('--partitions', type='int', dest='partitions', default=CI_PARTITIONS,
+            help='Number of partitions the registry is split into, must match CI_PARTITIONS of the ella processes.'),
+        make_option('--partition', type='int', dest='partition', default=None,
+            help='Run worker for this partition only, otherwise one worker process for every partition is started.'),
+        make_option('--record', dest='record', default=None,
+            help='Append all received messages to this file (file.<partition> for multiple partitions), see replayinvalidations.'),
+    )
 
     def handle(self,  *ct_names, **options):
-
-        if not AMQ_HOST:
-            raise CommandError('ActiveMQ host not defined!')
-
-        try:
-            # check connection to defined AMQ
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((AMQ_HOST, AMQ_PORT))
-            s.close()
-        except:
-            raise CommandError('Can\'t connect to defined AMQ server %s:%s!' % (AMQ_HOST, AMQ_PORT))
+        partitions = options['partitions']
+        transport = get_transport(partitions=partitions)
+        if not transport:
+            raise CommandError('No cache invalidation transport defined, set ACTIVE_MQ_HOST or CACHE_INVALIDATION_TRANSPORT!')
+
+        if options['partition'] is not None or partitions <= 1:
+            serve(transport, options['partition'] or 0, options['record'])
+            return
+
+        children = []
+        for partition in range(partitions):
+            pid = os.fork()
+            if not pid:
+                # every worker has its own connection
+                try:
+                    serve(get_transport(partitions=partitions), partition, options['record'])
+                finally:
+                    os._exit(0)
+            children.append(pid)
+        log.info('CI started %d workers.' % partitions)
 
         try:
-            # initialize connection for CI
-            conn = stomp.Connection([(AMQ_HOST, AMQ_PORT)])
-            conn.add_listener(CacheInvalidator())
-            conn.start()
-            conn.connect()
-            conn.subscribe(destination=AMQ_DESTINATION, ack='auto')
-            log.info('CI now listen on "%s"' % AMQ_DESTINATION)
-
-            while True:
-                time.sleep(1)
-
+            for pid in children:
+                os.waitpid(pid, 0)
         except KeyboardInterrupt:
-            conn.unsubscribe(destination=AMQ_DESTINATION)
-            conn.stop()
-            log.info('Connection was closed...')
-
-        except:
-            raise CommandError('Can not initialize stomp connection!')
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGINT)
+                except OSError:
+                    pass
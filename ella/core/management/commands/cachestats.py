@@ -0,0 +1,31 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from ella.core.cache.stats import get_backend_stats, reset_backend_stats, format_stats, \
+    get_invalidator_stats, reset_invalidator_stats, format_invalidator_stats
+from ella.core.cache.transports import CI_PARTITIONS
+
+
+class Command(NoArgsCommand):
+    help = 'Print cache hits, misses, stored sizes and latencies per key family collected when CACHE_STATS is on and the cache invalidator\'s lag and throughput.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--reset', action='store_true', dest='reset', default=False,
+            help='Reset the counters after printing them.'),
+        make_option('--partitions', type='int', dest='partitions', default=CI_PARTITIONS,
+            help='Number of the cache invalidator\'s partitions.'),
+    )
+
+    def handle_noargs(self, **options):
+        data = get_backend_stats()
+        if not data:
+            print 'No cache stats collected, is CACHE_STATS on?'
+        for line in format_stats(data):
+            print line
+
+        for line in format_invalidator_stats(get_invalidator_stats(options['partitions'])):
+            print line
+
+        if options.get('reset'):
+            reset_backend_stats()
+            reset_invalidator_stats(options['partitions'])
@@ -0,0 +1,19 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ella.core.cache.scheduler import PublishScheduler
+
+
+class Command(BaseCommand):
+    help = 'Invalidate cached listings, boxes and pages exactly when scheduled content gets published, unpublished or (de)prioritized.'
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', type='int', dest='interval', default=60,
+            help='Look for boundaries of newly saved objects at least every INTERVAL seconds.'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            PublishScheduler(interval=options['interval']).run()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,10 @@
+from django.core.management.base import NoArgsCommand
+
+from ella.core.models import CategoryClosure
+
+class Command(NoArgsCommand):
+    help = 'Recreate the category closure (ancestors of every category) from tree_parent.'
+
+    def handle_noargs(self, **options):
+        CategoryClosure.objects.rebuild()
+        print '%d category links' % CategoryClosure.objects.count()
@@ -0,0 +1,83 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import LabelCommand
+
+from ella.core.cache.registry import Registry
+from ella.core.cache.transports import BaseTransport
+from ella.core.cache.stats import format_invalidator_stats
+from ella.core.management.commands.cacheinvalidator import CacheInvalidator, read_message_log
+
+
+class ReplayTransport(BaseTransport):
+    " Delivers messages the invalidator sends to itself straight back, notifications are dropped. "
+    def __init__(self):
+        super(ReplayTransport, self).__init__(1)
+        self.invalidator = None
+
+    def send_to(self, partition, headers, body):
+        self.invalidator.on_message(headers, body)
+
+    def notify(self, key):
+        pass
+
+class ReplayInvalidator(CacheInvalidator):
+    """
+    Cache invalidator with an in-memory registry that leaves the cache
+    alone, keys are only counted (and reported when traced).
+    """
+    def __init__(self, trace=None):
+        transport = ReplayTransport()
+        super(ReplayInvalidator, self).__init__(transport, Registry())
+        transport.invalidator = self
+        # never overwrite the numbers of the running invalidator
+        self.stats.flush_interval = None
+        self.trace = trace
+        self.current = None
+        self.instance = None
+
+    def process(self, headers, message):
+        self.current = headers
+        self.instance = None
+        if self.trace and self.trace in (headers['key'], headers['model']) and headers['type'] != 'del':
+            print 'registered %s: %s %r' % (self.trace, headers, message)
+        super(ReplayInvalidator, self).process(headers, message)
+
+    def run(self, instance):
+        self.instance = instance
+        super(ReplayInvalidator, self).run(instance)
+
+    def delete(self, key):
+        self.deleted += 1
+        if key == self.trace:
+            print 'deleted %s by %s %r' % (key, self.current, self.instance)
+
+    def regenerate(self, key):
+        # producers are not called offline
+        self._register.pop_refresh(key)
+        self.delete(key)
+
+
+class Command(LabelCommand):
+    help = 'Feed message logs recorded by cacheinvalidator --record through an offline invalidator, report throughput and lag.'
+    args = '<message log ...>'
+    label = 'message log'
+    option_list = LabelCommand.option_list + (
+        make_option('--trace', dest='trace', default=None,
+            help='Print registrations and deletions of this key.'),
+    )
+
+    def handle_label(self, path, **options):
+        invalidator = ReplayInvalidator(options.get('trace'))
+        records = 0
+        start = time.time()
+        for received, headers, body in read_message_log(path):
+            invalidator.on_message(headers, body, received)
+            records += 1
+        duration = time.time() - start
+
+        messages = sum(row['messages'] for row in invalidator.stats.data.values())
+        print '%s: %d records, %d messages, %d keys deleted in %.3fs (%.1f messages/s)' % (
+                path, records, messages, invalidator.deleted, duration, duration and messages / duration or 0)
+        for line in format_invalidator_stats([invalidator.stats.snapshot()]):
+            print line
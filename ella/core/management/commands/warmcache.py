@@ -0,0 +1,143 @@
+import sys
+import logging
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.template import Context, NodeList, TextNode
+from django.db import connection
+from django.core.cache import cache
+from django.conf import settings
+
+from ella.core.models import Category, Placement, Listing, HitCount
+from ella.core.box import Box
+from ella.core.cache.utils import get_cached_object
+
+
+log = logging.getLogger('ella.core.management.commands.warmcache')
+
+
+def warm_category(pk, count, paginate_by):
+    " Category lookups and listing heads used by the category pages and the listing tag. "
+    category = get_cached_object(Category, pk=pk)
+    get_cached_object(Category, tree_path=category.tree_path, site__id=settings.SITE_ID)
+    category.get_tree_parent()
+    Listing.objects.get_listing(category=category, count=count)
+    if category.tree_parent_id:
+        Listing.objects.get_listing(category=category, children=Listing.objects.ALL, count=paginate_by)
+
+def warm_position(pk):
+    from ella.positions.models import Position
+    position = Position.objects.get(pk=pk)
+    try:
+        Position.objects.get_active_position(position.category, position.name)
+    except Position.DoesNotExist:
+        pass
+
+def warm_placement(pk, boxes):
+    " Main placement of the placed object and its rendered boxes. "
+    placement = get_cached_object(Placement, pk=pk)
+    publishable = placement.publishable
+    publishable.main_placement
+    obj = publishable.target
+    for box_type, params in boxes:
+        # the parameters make a part of the box's cache key
+        box = getattr(obj, 'box_class', Box)(obj, box_type, NodeList([TextNode(params)]))
+        box.prepare(Context({}))
+        box.render()
+
+TASKS = {
+    'category': warm_category,
+    'position': warm_position,
+    'placement': warm_placement,
+}
+
+def run_task(task):
+    " Run one task, return None or the error message, never raise so that the other tasks keep going. "
+    name, args = task
+    try:
+        TASKS[name](*args)
+    except Exception, e:
+        log.exception('Cache warm-up of %s%r failed.' % (name, args))
+        return '%s%r: %s' % (name, args, e)
+    return None
+
+def parse_box(definition):
+    " Return (box_type, params) of a box given as 'box_type;key:value;...', params as inside {% box %}. "
+    parts = definition.split(';')
+    return parts[0].strip(), '\n'.join(part.strip() for part in parts[1:])
+
+def get_tasks(count, paginate_by, top, boxes):
+    tasks = []
+    for pk in Category.objects.filter(site=settings.SITE_ID).order_by('tree_path').values_list('pk', flat=True):
+        tasks.append(('category', (pk, count, paginate_by)))
+
+    if 'ella.positions' in settings.INSTALLED_APPS:
+        from ella.positions.models import Position
+        for pk in Position.objects.filter(category__site=settings.SITE_ID, disabled=False).values_list('pk', flat=True):
+            tasks.append(('position', (pk,)))
+
+    if top:
+        # not through the cached get_top_objects, workers forked later
+        # must not share the cache connection it would open
+        top_placements = HitCount.objects.filter(placement__category__site=settings.SITE_ID).order_by('-hits').values_list('placement', flat=True)[:top]
+        for pk in top_placements:
+            tasks.append(('placement', (pk, boxes)))
+    return tasks
+
+
+class Command(NoArgsCommand):
+    help = 'Fill the cache with objects, listings, positions and boxes needed right after a deploy or a cache restart.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=1,
+            help='Number of worker processes (requires multiprocessing).'),
+        make_option('--count', type='int', dest='count', default=10,
+            help='Number of objects in listing heads.'),
+        make_option('--paginate-by', type='int', dest='paginate_by', default=20,
+            help='Number of objects on the first page of category listings.'),
+        make_option('--top', type='int', dest='top', default=100,
+            help='Number of most visited objects to warm main placements and boxes for.'),
+        make_option('--box', action='append', dest='boxes', default=[],
+            help='Box to render for the most visited objects, its type optionally followed by its parameters, '
+                'eg. "listing;level:2;css_class:top", can be repeated (defaults to a "listing" box without parameters).'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        boxes = [parse_box(b) for b in options['boxes'] or ['listing']]
+        tasks = get_tasks(options['count'], options['paginate_by'], options['top'], boxes)
+
+        workers = options['workers']
+        if workers > 1:
+            try:
+                from multiprocessing import Pool
+            except ImportError:
+                log.warning('multiprocessing not available, warming the cache in a single process.')
+                workers = 1
+
+        if workers > 1:
+            # every worker has to open its own database and cache connections
+            connection.close()
+            if hasattr(cache, 'close'):
+                cache.close()
+            pool = Pool(workers)
+            results = pool.imap_unordered(run_task, tasks)
+        else:
+            results = (run_task(task) for task in tasks)
+
+        errors = []
+        total = len(tasks)
+        for done, error in enumerate(results):
+            if error:
+                errors.append(error)
+            if verbosity:
+                sys.stdout.write('\rWarmed %d/%d (%d failed)' % (done + 1, total, len(errors)))
+                sys.stdout.flush()
+
+        if workers > 1:
+            pool.close()
+            pool.join()
+
+        if verbosity:
+            sys.stdout.write('\n')
+            for error in errors:
+                print error
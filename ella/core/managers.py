@@ -1,16 +1,25 @@
 from datetime import datetime
 
-from django.db import models
+from django.db import models, connection
 from django.db.models import F
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.utils.encoding import smart_str
 
-from ella.core.cache import cache_this
-from ella.core.cache.invalidate import CACHE_DELETER
+from ella.core.cache import cache_this, CACHE_TIMEOUT, CACHE_STALE_TIMEOUT
+from ella.core.cache.generations import model_namespace, field_namespace
 
 
 DEFAULT_LISTING_PRIORITY = getattr(settings, 'DEFAULT_LISTING_PRIORITY', 0)
+# regenerate listings of root categories on change instead of deleting them,
+# only while a transport to the cache invalidator is connected
+CACHE_REFRESH_LISTINGS = getattr(settings, 'CACHE_REFRESH_LISTINGS', True)
+# number of top listings cached once per category, children, models and
+# filters - get_listing slices pages within it from the cached window
+LISTING_WINDOW_SIZE = getattr(settings, 'LISTING_WINDOW_SIZE', 30)
+# fields of Listing the listing queries filter and order by, changes of the
+# others (commercial) leave the hot windows alone
+LISTING_FIELDS = ('id', 'placement_id', 'category_id', 'publish_from', 'publish_to', 'priority_from', 'priority_to', 'priority_value')
 
 
 class RelatedManager(models.Manager):
@@ -77,19 +86,107 @@ class RelatedManager(models.Manager):
         return related
 
 
-def invalidate_listing(key, self, *args, **kwargs):
-    CACHE_DELETER.register_test(self.model, '', key)
-
-def get_listings_key(func, self, category=None, count=10, offset=1, mods=[], content_types=[], **kwargs):
-    c = category and  category.id or ''
-
-    return 'ella.core.managers.ListingManager.get_listing:%s:%d:%d:%s:%s:%s' % (
-            c, count, offset,
+def get_listing_generations(func, self, category=None, children=None, *args, **kwargs):
+    " Listing of a single category only changes with the category's listings, others with any listing. "
+    if category and (children is None or children == self.NONE):
+        return [field_namespace(self.model, 'category_id', category.pk)]
+    return [model_namespace(self.model)]
+
+def get_listing_after_generations(func, self, cursor, count, category=None, children=None, *args, **kwargs):
+    " Cursor pages change with the listing they page through, see get_listing_generations. "
+    return get_listing_generations(func, self, category, children, *args, **kwargs)
+
+def get_listing_window_refresh(func, self, category=None, children=None, mods=[], content_types=[], **kwargs):
+    """
+    Windows of root categories' listings (the homepage) are hot, the cache
+    invalidator regenerates them whenever a listing in their scope changes.
+    """
+    if not CACHE_REFRESH_LISTINGS or not category or category.tree_parent_id or kwargs:
+        return None
+    if children is None or children == self.NONE:
+        tests = [(self.model, 'category_id:%s' % category.pk, LISTING_FIELDS)]
+    else:
+        tests = [(self.model, '', LISTING_FIELDS)]
+    return 'ella.core.models.Listing.objects.get_listing_window', (), {
+            'category': category, 'children': children,
+            'mods': mods, 'content_types': content_types,
+        }, tests
+
+def is_hot_listing_window(func, self, *args, **kwargs):
+    " Hot listing windows are replicated as well, see ella.core.cache.replication. "
+    return get_listing_window_refresh(func, self, *args, **kwargs) is not None
+
+def _listing_key_params(mods, content_types, kwargs):
+    return '%s:%s:%s' % (
             ','.join('.'.join((model._meta.app_label, model._meta.object_name)) for model in mods),
             ','.join(map(str, content_types)),
             ','.join(':'.join((k, smart_str(v))) for k, v in kwargs.items()),
     )
 
+def get_listings_key(func, self, category=None, children=None, count=10, offset=1, mods=[], content_types=[], unique=None, **kwargs):
+    c = category and  category.id or ''
+
+    return 'ella.core.managers.ListingManager.get_listing_page:%s:%s:%d:%d:%s:%s' % (
+            c, children or 0, count, offset,
+            ','.join(map(str, sorted(unique or ()))),
+            _listing_key_params(mods, content_types, kwargs),
+    )
+
+def get_listing_window_key(func, self, category=None, children=None, mods=[], content_types=[], **kwargs):
+    c = category and  category.id or ''
+
+    return 'ella.core.managers.ListingManager.get_listing_window:%s:%s:%d:%s' % (
+            c, children or 0, LISTING_WINDOW_SIZE,
+            _listing_key_params(mods, content_types, kwargs),
+    )
+
+def get_listing_count_key(func, self, category=None, children=None, mods=[], content_types=[], **kwargs):
+    c = category and  category.id or ''
+
+    return 'ella.core.managers.ListingManager.get_listing_count:%s:%s:%s' % (
+            c, children or 0, _listing_key_params(mods, content_types, kwargs),
+    )
+
+def get_listing_after_key(func, self, cursor, count, category=None, children=None, mods=[], content_types=[], **kwargs):
+    c = category and  category.id or ''
+
+    return 'ella.core.managers.ListingManager.get_listing_after:%s:%d:%s:%d:%s:%s' % (
+            cursor[0].isoformat(), cursor[1], c, count, children or 0,
+            _listing_key_params(mods, content_types, kwargs),
+    )
+
+class CategoryClosureManager(models.Manager):
+    def link(self, category):
+        """
+        Link category (and its descendants) to its current ancestors,
+        replacing the links to the ancestors it had before a move. Return
+        True if the ancestors have changed.
+        """
+        if category.tree_parent_id:
+            ancestors = [(a, depth + 1) for a, depth in self.filter(descendant=category.tree_parent_id).values_list('ancestor', 'depth')]
+        else:
+            ancestors = []
+        linked = list(self.filter(descendant=category).values_list('ancestor', 'depth'))
+        if not linked:
+            self.create(ancestor=category, descendant=category, depth=0)
+        elif sorted(ancestors) == sorted((a, depth) for a, depth in linked if depth):
+            return False
+
+        subtree = list(self.filter(ancestor=category).values_list('descendant', 'depth'))
+        subtree_ids = [d for d, depth in subtree]
+        self.filter(descendant__in=subtree_ids).exclude(ancestor__in=subtree_ids).delete()
+        for a, a_depth in ancestors:
+            for d, d_depth in subtree:
+                self.create(ancestor_id=a, descendant_id=d, depth=a_depth + d_depth)
+        return True
+
+    def rebuild(self):
+        " Recreate the whole closure from tree_parent, see the rebuildcategoryclosure command. "
+        from ella.core.models import Category
+        self.all().delete()
+        for category in Category.objects.order_by('tree_path'):
+            self.link(category)
+
 class PlacementManager(models.Manager):
     def get_query_set(self, *args, **kwargs):
         qset = super(PlacementManager, self).get_query_set(*args, **kwargs).select_related('publishable')
@@ -133,10 +230,10 @@ class ListingManager(models.Manager):
                 qset = qset.filter(category=category)
             elif children == self.IMMEDIATE:
                 # this category and its children
-                qset = qset.filter(models.Q(category__tree_parent=category) | models.Q(category=category))
+                qset = qset.filter(category__ancestor_links__ancestor=category, category__ancestor_links__depth__lte=1)
             elif children == self.ALL:
                 # this category and all its descendants
-                qset = qset.filter(category__tree_path__startswith=category.tree_path, category__site=category.site_id)
+                qset = qset.filter(category__ancestor_links__ancestor=category)
 
             else:
                 raise AttributeError('Invalid children value (%s) - should be one of (%s, %s, %s)' % (children, self.NONE, self.IMMEDIATE, self.ALL))
@@ -147,7 +244,6 @@ class ListingManager(models.Manager):
 
         return qset.exclude(publish_to__lt=now)
 
-    @cache_this(get_listings_key, invalidate_listing)
     def get_listing(self, category=None, children=NONE, count=10, offset=1, mods=[], content_types=[], unique=None, **kwargs):
         """
         Get top objects for given category and potentionally also its child categories.
@@ -157,16 +253,48 @@ class ListingManager(models.Manager):
             count - number of objects to output, defaults to 10
             offset - starting with object number... 1-based
             mods - list of Models, if empty, object from all models are included
+            unique - set of placement ids to leave out, only used with USE_PRIORITIES
             [now] - datetime used instead of default datetime.now() value
             **kwargs - rest of the parameter are passed to the queryset unchanged
+
+        Pages within the first LISTING_WINDOW_SIZE listings are sliced from
+        the cached window (see get_listing_window), only pages beyond it are
+        queried (and cached) one by one.
         """
-        # TODO try to write  SQL (.extra())
         assert offset > 0, "Offset must be a positive integer"
         assert count >= 0, "Count must be a positive integer"
 
         if not count:
             return []
 
+        limit = offset - 1 + count
+        if 'now' not in kwargs and limit <= LISTING_WINDOW_SIZE:
+            window = self.get_listing_window(category, children, mods, content_types, **kwargs)
+            # shorter window holds the whole listing
+            complete = len(window) < LISTING_WINDOW_SIZE
+            if unique and getattr(settings, 'USE_PRIORITIES', False):
+                window = [l for l in window if l.placement_id not in unique]
+            if complete or len(window) >= limit:
+                return window[offset - 1:limit]
+
+        return self.get_listing_page(category, children, count, offset, mods, content_types, unique, **kwargs)
+
+    @cache_this(get_listing_window_key, timeout=CACHE_TIMEOUT + CACHE_STALE_TIMEOUT, soft_timeout=CACHE_TIMEOUT, generations=get_listing_generations, refresh=get_listing_window_refresh, replicate=is_hot_listing_window)
+    def get_listing_window(self, category=None, children=NONE, mods=[], content_types=[], **kwargs):
+        """
+        Return the first LISTING_WINDOW_SIZE listings in get_listing's order,
+        the one cached value overlapping listings on a page (boxes, the
+        category's first pages, ...) are all sliced from.
+        """
+        return list(self.query_listing(category, children, LISTING_WINDOW_SIZE, 1, mods, content_types, **kwargs))
+
+    @cache_this(get_listings_key, timeout=CACHE_TIMEOUT + CACHE_STALE_TIMEOUT, soft_timeout=CACHE_TIMEOUT, generations=get_listing_generations)
+    def get_listing_page(self, category=None, children=NONE, count=10, offset=1, mods=[], content_types=[], unique=None, **kwargs):
+        " Page of get_listing beyond the window, cached under its exact parameters. "
+        return self.query_listing(category, children, count, offset, mods, content_types, unique, **kwargs)
+
+    def query_listing(self, category=None, children=NONE, count=10, offset=1, mods=[], content_types=[], unique=None, **kwargs):
+        " Query the database for get_listing's page. "
         now = datetime.now()
         if 'now' in kwargs:
             now = kwargs.pop('now')
@@ -178,27 +306,8 @@ class ListingManager(models.Manager):
 
         # only use priorities if somebody wants them
         if not getattr(settings, 'USE_PRIORITIES', False):
-            return qset[offset:limit]
-
-
-        # listings with active priority override
-        active = models.Q(
-                    priority_value__isnull=False,
-                    priority_from__isnull=False,
-                    priority_from__lte=now,
-                    priority_to__gte=now
-        )
-
-        qsets = (
-            # modded-up objects
-            qset.filter(active, priority_value__gt=DEFAULT_LISTING_PRIORITY).order_by('-priority_value', '-publish_from'),
-            # default priority
-            qset.exclude(active).order_by('-publish_from'),
-            # modded-down priority
-            qset.filter(active, priority_value__lt=DEFAULT_LISTING_PRIORITY).order_by('-priority_value', '-publish_from'),
-        )
-
-        out = []
+            # same order as get_listing_after, cursor pages follow these
+            return qset.order_by('-publish_from', '-pk')[offset:limit]
 
         # take out not unwanted objects
         if unique:
@@ -206,19 +315,61 @@ class ListingManager(models.Manager):
         else:
             listed_targets = set([])
 
-        # iterate through qsets until we have enough objects
-        for q in qsets:
-            data = q[:limit]
-            if data:
-                for l in data:
-                    tgt = l.placement_id
-                    if tgt in listed_targets:
-                        continue
-                    listed_targets.add(tgt)
-                    out.append(l)
-                    if len(out) == limit:
-                        return out[offset:limit]
-        return out[offset:offset + count]
+        # walk the ordered (id, placement) pairs skipping repeated placements,
+        # only the listings on the requested page are fetched whole
+        rows = self.get_priority_queryset(qset, now).values('id', 'placement', 'effective_priority')
+        ids = []
+        start = 0
+        while len(ids) < limit:
+            chunk = list(rows[start:start + limit - len(ids)])
+            if not chunk:
+                break
+            start += len(chunk)
+            for row in chunk:
+                if row['placement'] in listed_targets:
+                    continue
+                listed_targets.add(row['placement'])
+                ids.append(row['id'])
+
+        ids = ids[offset:limit]
+        listings = self.get_query_set().in_bulk(ids)
+        return [listings[pk] for pk in ids if pk in listings]
+
+    def get_priority_queryset(self, qset, now):
+        """
+        Order qset by the effective priority - priority_value while the
+        priority is active, DEFAULT_LISTING_PRIORITY otherwise - and
+        publish_from, computed by the database.
+        """
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        column = dict((f, '%s.%s' % (table, qn(f))) for f in ('priority_value', 'priority_from', 'priority_to'))
+        effective = 'CASE WHEN %(priority_value)s IS NOT NULL AND %(priority_from)s IS NOT NULL AND %(priority_from)s <= %%s AND %(priority_to)s >= %%s THEN %(priority_value)s ELSE %%s END' % column
+        now = connection.ops.value_to_db_datetime(now)
+        return qset.extra(
+                select={'effective_priority': effective},
+                select_params=(now, now, DEFAULT_LISTING_PRIORITY),
+                order_by=('-effective_priority', '-publish_from')
+        )
+
+    @cache_this(get_listing_count_key, timeout=CACHE_TIMEOUT + CACHE_STALE_TIMEOUT, soft_timeout=CACHE_TIMEOUT, generations=get_listing_generations)
+    def get_listing_count(self, category=None, children=NONE, mods=[], content_types=[], **kwargs):
+        return self.get_listing_queryset(category, children, mods, content_types, **kwargs).count()
+
+    @cache_this(get_listing_after_key, timeout=CACHE_TIMEOUT + CACHE_STALE_TIMEOUT, soft_timeout=CACHE_TIMEOUT, generations=get_listing_after_generations)
+    def get_listing_after(self, cursor, count, category=None, children=NONE, mods=[], content_types=[], **kwargs):
+        """
+        Get count listings published before the cursor - (publish_from, id)
+        of a listing, see ella.core.pagination - newest first.
+
+        Unlike get_listing, priorities are ignored and placements listed
+        more than once are not skipped, these pages only follow get_listing's
+        pages when USE_PRIORITIES is off.
+        """
+        publish_from, pk = cursor
+        qset = self.get_listing_queryset(category, children, mods, content_types, **kwargs)
+        qset = qset.filter(models.Q(publish_from__lt=publish_from) | models.Q(publish_from=publish_from, pk__lt=pk))
+        return list(qset.order_by('-publish_from', '-pk')[:count])
 
     def get_queryset_wrapper(self, kwargs):
         return ListingQuerySetWrapper(self, kwargs)
@@ -239,7 +390,7 @@ class ListingQuerySetWrapper(object):
     
     def count(self):
         if not hasattr(self, '_count'):
-            self._count = self.manager.get_listing_queryset(**self._kwargs).count()
+            self._count = self.manager.get_listing_count(**self._kwargs)
         return self._count
 
 
@@ -256,10 +407,13 @@ class HitCountManager(models.Manager):
         if count < 1:
             hc = self.create(placement=placement, hits=1)
 
-    @cache_this(get_top_objects_key)
+    @cache_this(get_top_objects_key, timeout=CACHE_TIMEOUT + CACHE_STALE_TIMEOUT, soft_timeout=CACHE_TIMEOUT, replicate=True)
     def get_top_objects(self, count, mods=[]):
         """
-        Return count top rated objects. Cache this for 10 minutes without any chance of cache invalidation.
+        Return count top rated objects. Hits change on every view so the list
+        is never invalidated, after CACHE_TIMEOUT seconds one caller
+        recomputes it while the others keep getting the stale one, see
+        cache_this. The key is replicated, every page of the site reads it.
         """
         kwa = {}
         if mods:
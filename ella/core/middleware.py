@@ -6,14 +6,25 @@ from django import template
 from django.middleware.cache import CacheMiddleware as DjangoCacheMiddleware
 from django.core.cache import cache
 from django.utils.cache import get_cache_key, add_never_cache_headers, learn_cache_key
+from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
 
+from ella.core.cache.local import IDENTITY_MAP
+from ella.core.cache.invalidate import CACHE_DELETER
+from ella.core.cache.stats import STATS, format_stats
 
 
 ECACHE_INFO = 'ella.core.middleware.ECACHE_INFO'
 
 DOUBLE_RENDER = getattr(settings, 'DOUBLE_RENDER', False)
 
+# key family of cached pages in ella.core.cache.stats
+PAGE_STATS_FAMILY = 'ella.core.middleware.page'
+# add X-Ella-Cache header with the request's cache numbers to every response
+CACHE_STATS_HEADER = getattr(settings, 'CACHE_STATS_HEADER', False)
+
+TRANSACTION_MIDDLEWARE = 'django.middleware.transaction.TransactionMiddleware'
+
 class DoubleRenderMiddleware(object):
     def process_response(self, request, response):
         if response.status_code != 200 or not response['Content-Type'].startswith('text') or not DOUBLE_RENDER:
@@ -27,6 +38,69 @@ class DoubleRenderMiddleware(object):
             log.warning('Failed to double render on (%s)', e)
         return response
 
+class IdentityMapMiddleware(object):
+    """
+    Makes get_cached_object and the cached foreign keys return the same
+    instance for repeated lookups within one request. The map is thrown away
+    when the request is over.
+    """
+    def process_request(self, request):
+        IDENTITY_MAP.activate()
+
+    def process_response(self, request, response):
+        IDENTITY_MAP.deactivate()
+        return response
+
+    def process_exception(self, request, exception):
+        IDENTITY_MAP.deactivate()
+
+class InvalidationBatchMiddleware(object):
+    """
+    Sends all the messages for the cache invalidator produced while handling
+    the request in a single message once the response is ready. It has to
+    be listed above TransactionMiddleware so that the changes, sent after
+    the commit, make it to the batch.
+    """
+    def __init__(self):
+        classes = list(settings.MIDDLEWARE_CLASSES)
+        this = '%s.%s' % (self.__class__.__module__, self.__class__.__name__)
+        if TRANSACTION_MIDDLEWARE in classes and this in classes and classes.index(TRANSACTION_MIDDLEWARE) < classes.index(this):
+            raise ImproperlyConfigured('%s must be listed above %s in MIDDLEWARE_CLASSES.' % (this, TRANSACTION_MIDDLEWARE))
+
+    def process_request(self, request):
+        CACHE_DELETER.start_batch()
+
+    def process_response(self, request, response):
+        CACHE_DELETER.send_batch()
+        return response
+
+    def process_exception(self, request, exception):
+        CACHE_DELETER.send_batch()
+
+class CacheStatsMiddleware(object):
+    """
+    Collects cache numbers (see ella.core.cache.stats) for every request,
+    logs them and optionally sends them in the X-Ella-Cache header. It also
+    takes care of pushing the process' numbers to the cache backend.
+    """
+    def process_request(self, request):
+        if STATS.enabled:
+            STATS.start_request()
+
+    def process_response(self, request, response):
+        if not STATS.enabled:
+            return response
+
+        data = STATS.end_request()
+        if data:
+            log.debug('Cache stats for %s: %s', request.path, '; '.join(format_stats(data)))
+            if CACHE_STATS_HEADER:
+                response['X-Ella-Cache'] = ', '.join(
+                    '%s=%d/%d' % (family, row['hits'], row['hits'] + row['misses']) for family, row in sorted(data.items())
+                )
+        STATS.maybe_flush()
+        return response
+
 class CacheMiddleware(DjangoCacheMiddleware):
     def process_request(self, request):
         resp = super(CacheMiddleware, self).process_request(request)
@@ -87,7 +161,9 @@ class UpdateCacheMiddleware(object):
             cache_key = learn_cache_key(request, response, self.cache_timeout, self.key_prefix)
 
         # include the orig_time information within the cache
-        cache.set(cache_key, (time.time(), response), self.cache_timeout)
+        start = time.time()
+        cache.set(cache_key, (start, response), self.cache_timeout)
+        STATS.record_set(PAGE_STATS_FAMILY, [response], time.time() - start)
         return response
 
 class FetchFromCacheMiddleware(object):
@@ -128,7 +204,9 @@ class FetchFromCacheMiddleware(object):
             request._cache_update_cache = True
             return None # No cache information available, need to rebuild.
 
+        start = time.time()
         response = cache.get(cache_key, None)
+        STATS.record_get(PAGE_STATS_FAMILY, int(response is not None), int(response is None), time.time() - start)
         if response is None:
             request._cache_update_cache = True
             return None # No cache information available, need to rebuild.
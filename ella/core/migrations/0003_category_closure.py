@@ -0,0 +1,58 @@
+
+from south.db import db
+from django.db import models
+from ella.core.models import *
+
+class Migration:
+
+    def forwards(self, orm):
+
+        # Adding model 'CategoryClosure'
+        db.create_table('core_categoryclosure', (
+            ('id', models.AutoField(primary_key=True)),
+            ('ancestor', models.ForeignKey(orm.Category, related_name='descendant_links')),
+            ('descendant', models.ForeignKey(orm.Category, related_name='ancestor_links')),
+            ('depth', models.PositiveSmallIntegerField()),
+        ))
+        db.create_index('core_categoryclosure', ['descendant_id'])
+        db.create_unique('core_categoryclosure', ['ancestor_id', 'descendant_id'])
+        db.send_create_signal('core', ['CategoryClosure'])
+
+        # link every category to itself and its ancestors, parents go first
+        ancestors = {}
+        for pk, parent in orm.Category.objects.order_by('tree_path').values_list('id', 'tree_parent'):
+            ancestors[pk] = [(pk, 0)] + [(a, depth + 1) for a, depth in ancestors.get(parent, ())]
+            for a, depth in ancestors[pk]:
+                orm.CategoryClosure.objects.create(ancestor_id=a, descendant_id=pk, depth=depth)
+
+    def backwards(self, orm):
+
+        # Deleting model 'CategoryClosure'
+        db.delete_table('core_categoryclosure')
+
+
+    models = {
+        'core.category': {
+            'Meta': {'unique_together': "(('site','tree_path'),)", 'app_label': "'core'"},
+            'description': ('models.TextField', ['_("Category Description")'], {'blank': 'True'}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'}),
+            'site': ('models.ForeignKey', ["orm['sites.Site']"], {}),
+            'slug': ('models.SlugField', ["_('Slug')"], {'max_length': '255'}),
+            'title': ('models.CharField', ['_("Category Title")'], {'max_length': '200'}),
+            'tree_parent': ('models.ForeignKey', ["orm['core.Category']"], {'null': 'True', 'verbose_name': '_("Parent Category")', 'blank': 'True'}),
+            'tree_path': ('models.CharField', [], {'editable': 'False', 'max_length': '255', 'verbose_name': '_("Path from root category")'})
+        },
+        'core.categoryclosure': {
+            'Meta': {'unique_together': "(('ancestor','descendant'),)", 'app_label': "'core'"},
+            'ancestor': ('models.ForeignKey', ["orm['core.Category']"], {'related_name': "'descendant_links'"}),
+            'depth': ('models.PositiveSmallIntegerField', [], {}),
+            'descendant': ('models.ForeignKey', ["orm['core.Category']"], {'related_name': "'ancestor_links'"}),
+            'id': ('models.AutoField', [], {'primary_key': 'True'})
+        },
+        'sites.site': {
+            'Meta': {'ordering': "('domain',)", 'db_table': "'django_site'"},
+            '_stub': True,
+            'id': ('models.AutoField', [], {'primary_key': 'True'})
+        },
+    }
+
@@ -0,0 +1,19 @@
+
+from south.db import db
+from django.db import models
+from ella.core.models import *
+
+class Migration:
+
+    def forwards(self, orm):
+
+        # listings of a category newest first, see ListingManager.get_listing_after
+        db.create_index('core_listing', ['category_id', 'publish_from', 'id'])
+
+    def backwards(self, orm):
+
+        db.delete_index('core_listing', ['category_id', 'publish_from', 'id'])
+
+
+    models = {}
+
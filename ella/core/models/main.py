@@ -9,6 +9,7 @@ from django.contrib.auth.models import User
 
 from ella.core.box import Box
 from ella.core.cache import get_cached_object, cache_this, CachedGenericForeignKey
+from ella.core.managers import CategoryClosureManager
 
 LISTING_UNIQUE_DEFAULT_SET = 'unique_set_default'
 
@@ -162,6 +163,41 @@ class Category(models.Model):
     def __unicode__(self):
         return '%s/%s' % (self.site.name, self.tree_path)
 
+class CategoryClosure(models.Model):
+    """
+    Closure of the category tree - one row for every category and each of
+    its ancestors (and the category itself with depth 0), kept current by
+    the link_category post_save handler. Subtree queries join it on an
+    index instead of scanning tree_path with LIKE or walking the tree level
+    by level.
+    """
+    ancestor = models.ForeignKey(Category, related_name='descendant_links')
+    descendant = models.ForeignKey(Category, related_name='ancestor_links')
+    depth = models.PositiveSmallIntegerField()
+
+    objects = CategoryClosureManager()
+
+    class Meta:
+        app_label = 'core'
+        unique_together = (('ancestor', 'descendant'),)
+        verbose_name = _('Category closure')
+        verbose_name_plural = _('Category closures')
+
+    def __unicode__(self):
+        return u'%s > %s' % (self.ancestor_id, self.descendant_id)
+
+def link_category(sender, instance, raw=False, **kwargs):
+    """
+    Keep CategoryClosure in sync with tree_parent. Raw saves (loaddata) come
+    in any order, children saved before their parent are linked with it.
+    """
+    CategoryClosure.objects.link(instance)
+    if raw:
+        for child in Category.objects.filter(tree_parent=instance).exclude(ancestor_links__ancestor=instance):
+            CategoryClosure.objects.link(child)
+
+models.signals.post_save.connect(link_category, sender=Category)
+
 class Dependency(models.Model):
     """
     Object dependency - model for recording dependent items. For example when we use photo in article content.
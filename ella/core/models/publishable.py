@@ -10,8 +10,9 @@ from django.template.defaultfilters import slugify
 from django.core.urlresolvers import reverse
 from django.contrib.redirects.models import Redirect
 
-from ella.core.managers import ListingManager, HitCountManager, PlacementManager, RelatedManager
+from ella.core.managers import ListingManager, HitCountManager, PlacementManager, RelatedManager, LISTING_FIELDS
 from ella.core.cache import get_cached_object, get_cached_list, CachedGenericForeignKey
+from ella.core.cache.generations import register_membership_fields
 from ella.core.models.main import Category, Author, Source
 from ella.photos.models import Photo
 from ella.core.box import Box
@@ -345,6 +346,10 @@ class Listing(models.Model):
         verbose_name_plural = _('Listings')
         ordering = ('-publish_from',)
 
+# listings of a category are filtered and ordered by these fields too, see
+# ella.core.managers.get_listing_generations
+register_membership_fields(Listing, LISTING_FIELDS)
+
 class HitCount(models.Model):
     """
     Count hits for individual objects.
@@ -0,0 +1,48 @@
+"""
+Keyset (cursor) pagination of listings.
+
+A cursor is the (publish_from, id) of the last listing on a page, the next
+page lists what is older than it. Unlike OFFSET, a deep page costs the same
+as the first one and its URL (``?c=<cursor>``) always shows the same
+listings, so it can be cached. See ListingManager.get_listing_after.
+"""
+from datetime import datetime
+
+
+def encode_cursor(listing):
+    " Return cursor of the listing, eg. 20080110120000000000-42. "
+    d = listing.publish_from
+    # strftime can not format years before 1900
+    return '%04d%02d%02d%02d%02d%02d%06d-%d' % (d.year, d.month, d.day, d.hour, d.minute, d.second, d.microsecond, listing.pk)
+
+def decode_cursor(value):
+    " Return (publish_from, id) of the cursor, ValueError if malformed. "
+    stamp, pk = value.split('-', 1)
+    if len(stamp) != 20 or not stamp.isdigit() or not pk.isdigit():
+        raise ValueError('Invalid cursor %r' % value)
+    parts = [int(stamp[i:j]) for i, j in ((0, 4), (4, 6), (6, 8), (8, 10), (10, 12), (12, 14), (14, 20))]
+    return datetime(*parts), int(pk)
+
+class CursorPage(object):
+    """
+    Page of listings following a cursor, provides the parts of
+    django.core.paginator.Page which make sense without counting.
+    """
+    number = None
+
+    def __init__(self, object_list, next_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        # the page before a cursor has no number nor cursor to link to
+        return False
+
+    def has_other_pages(self):
+        return True
+
+    def __len__(self):
+        return len(self.object_list)
@@ -220,13 +220,15 @@ class BoxNode(template.Node):
         # restore the context
         context.pop()
 
-        # record parent box dependecy on child box or cached full-page on box
+        # record parent box dependecy on child box or cached full-page on box:
+        # the enclosing fragment dies with the box or with the box's object
         if not (DOUBLE_RENDER and box.can_double_render) and (BOX_INFO in context or ECACHE_INFO in context):
             if BOX_INFO in context:
                 source_key = context[BOX_INFO]
             elif ECACHE_INFO in context:
                 source_key = context[ECACHE_INFO]
-            CACHE_DELETER.register_dependency(source_key, box_key)
+            CACHE_DELETER.register_dependency(box_key, source_key)
+            CACHE_DELETER.register_pk(box.obj, source_key)
 
         return result
 
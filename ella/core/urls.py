@@ -33,6 +33,9 @@ urlpatterns = patterns( '',
     url( r'^export/$', 'ella.core.views.export', { 'count' : 3 }, name="export" ),
     url( r'^export/(?P<name>[a-z0-9-]+)/$', 'ella.core.views.export', { 'count' : 3 }, name="named_export" ),
 
+    # cache keys registered against an object, staff only
+    url( r'^cache-explain/(?P<app_label>\w+)\.(?P<model_name>\w+)/(?P<pk>\d+)/$', 'ella.core.views.cache_explain', name="cache_explain" ),
+
     # rss feeds
     url( r'^feeds/(?P<url>.*)/$', 'django.contrib.syndication.views.feed', { 'feed_dict': feeds }, name="feeds" ),
 
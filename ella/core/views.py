@@ -6,18 +6,25 @@ from django.core.paginator import Paginator
 from django.conf import settings
 from django.template.defaultfilters import slugify
 from django.db import models
-from django.http import Http404
+from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.contrib.admin.views.decorators import staff_member_required
 
 from ella.core.models import Listing, Category, Placement
-from ella.core.cache import get_cached_object_or_404, cache_this
+from ella.core.cache import get_cached_object_or_404, cache_this, CACHE_STALE_TIMEOUT
 from ella.core import custom_urls
 from ella.core.cache.template_loader import render_to_response
+from ella.core.cache.explain import explain, format_explanation, get_totals, explain_generations, format_generations
+from ella.core.pagination import CursorPage, encode_cursor, decode_cursor
 
 __docformat__ = "restructuredtext en"
 
 # local cache for get_content_type()
 CONTENT_TYPE_MAPPING = {}
 CACHE_TIMEOUT_LONG = getattr(settings, 'CACHE_TIMEOUT_LONG', 60 * 60)
+# pages of ListContentType reachable by number, the following ones by cursor
+LISTING_NUMBERED_PAGES = getattr(settings, 'LISTING_NUMBERED_PAGES', 5)
+# deepest page number redirected to its cursor, deeper ones are not found
+LISTING_REDIRECT_PAGES = getattr(settings, 'LISTING_REDIRECT_PAGES', 20)
 
 class EllaCoreView(object):
     ' Base class for class-based views used in ella.core.views. '
@@ -33,7 +40,8 @@ class EllaCoreView(object):
             - `request`: current request
 
         :Returns:
-            Dictionary with all the data
+            Dictionary with all the data or a `HttpResponse` (eg. a redirect)
+            to be returned instead of rendering
         """
         raise NotImplementedError()
 
@@ -57,6 +65,8 @@ class EllaCoreView(object):
 
     def __call__(self, request, **kwargs):
         context = self.get_context(request, **kwargs)
+        if isinstance(context, HttpResponse):
+            return context
         return self.render(request, context, self.get_templates(context))
 
 class CategoryDetail(EllaCoreView):
@@ -83,8 +93,7 @@ class CategoryDetail(EllaCoreView):
             now = datetime.now()
             try:
                 year = Listing.objects.filter(
-                        category__site__id=settings.SITE_ID,
-                        category__tree_path__startswith=category.tree_path,
+                        category__ancestor_links__ancestor=category,
                         publish_from__lte=now
                     ).values('publish_from')[0]['publish_from'].year
             except:
@@ -187,11 +196,12 @@ class ListContentType(EllaCoreView):
         - `year, month, day`: date matching the `publish_from` field of the `Placement` object.
           All of these parameters are optional, the list will be filtered by the non-empty ones
         - `content_type`: slugified verbose_name_plural of the target model, if omitted all content_types are listed
-        - `page_no`: which page to display
+        - `page_no`: which page to display, pages beyond the first LISTING_NUMBERED_PAGES (up to LISTING_REDIRECT_PAGES) redirect to their cursor
+        - `cursor`: the page following the cursor (see ella.core.pagination), deeper pages are only linked this way
         - `paginate_by`: number of records in one page
 
     :Exceptions:
-        - `Http404`: if the specified category or content_type does not exist or if the given date is malformed.
+        - `Http404`: if the specified category or content_type does not exist, if the given date or cursor is malformed or the page is out of range.
     """
     template_name = 'listing.html'
     def get_context(self, request, category='', year=None, month=None, day=None, content_type=None, paginate_by=20):
@@ -232,19 +242,56 @@ class ListContentType(EllaCoreView):
         else:
             ct = False
 
-        qset = Listing.objects.get_queryset_wrapper(kwa)
-        paginator = Paginator(qset, paginate_by)
+        if 'c' in request.GET:
+            try:
+                cursor = decode_cursor(request.GET['c'])
+            except ValueError, e:
+                raise Http404()
+            listings = Listing.objects.get_listing_after(cursor, paginate_by + 1, **kwa)
+            next_cursor = None
+            if len(listings) > paginate_by:
+                listings = listings[:paginate_by]
+                next_cursor = encode_cursor(listings[-1])
+            page = CursorPage(listings, next_cursor)
+            is_paginated = True
 
-        if page_no > paginator.num_pages or page_no < 1:
-            raise Http404()
+        else:
+            # cursor pages are chronological, they only continue numbered
+            # pages listed in the same order - without priorities
+            cursors = not getattr(settings, 'USE_PRIORITIES', False)
+
+            if cursors and page_no > LISTING_NUMBERED_PAGES:
+                # the page follows the last listing of the previous one, the
+                # previous page is cached just like the numbered pages (or
+                # sliced from the listing window), resolving deeper pages
+                # would take an OFFSET query as deep as the page
+                if page_no > LISTING_REDIRECT_PAGES:
+                    raise Http404()
+                previous = Listing.objects.get_listing(offset=(page_no - 2) * paginate_by + 1, count=paginate_by, **kwa)
+                if len(previous) < paginate_by:
+                    raise Http404()
+                return HttpResponseRedirect('%s?c=%s' % (request.path, encode_cursor(previous[-1])))
+
+            qset = Listing.objects.get_queryset_wrapper(kwa)
+            paginator = Paginator(qset, paginate_by)
+
+            if page_no > paginator.num_pages or page_no < 1:
+                raise Http404()
+
+            page = paginator.page(page_no)
+            listings = page.object_list
+            is_paginated = paginator.num_pages > 1
 
-        page = paginator.page(page_no)
-        listings = page.object_list
+            # the last numbered page continues with the listings after it
+            next_cursor = None
+            if cursors and page_no == LISTING_NUMBERED_PAGES and page.has_next():
+                next_cursor = encode_cursor(listings[-1])
 
         context = {
                 'page': page,
-                'is_paginated': paginator.num_pages > 1,
+                'is_paginated': is_paginated,
                 'results_per_page': paginate_by,
+                'next_cursor': next_cursor,
 
                 'content_type' : ct,
                 'content_type_name' : content_type,
@@ -328,7 +375,7 @@ def get_export_key(func, request, count, name='', content_type=None):
             settings.SITE_ID, count, name, content_type
         )
 
-@cache_this(get_export_key, timeout=CACHE_TIMEOUT_LONG)
+@cache_this(get_export_key, timeout=CACHE_TIMEOUT_LONG + CACHE_STALE_TIMEOUT, soft_timeout=CACHE_TIMEOUT_LONG)
 def export(request, count, name='', content_type=None):
     """
     Export banners.
@@ -353,6 +400,19 @@ def export(request, count, name='', content_type=None):
         )
 
 
+@staff_member_required
+def cache_explain(request, app_label, model_name, pk):
+    " List cache keys invalidated when the object changes, see ella.core.cache.explain. "
+    model = models.get_model(app_label, model_name)
+    if model is None:
+        raise Http404
+    obj = get_cached_object_or_404(model, pk=pk)
+    entries = explain(obj)
+    keys, size = get_totals(entries)
+    lines = format_explanation(entries) + ['', '%d keys, %d bytes cached' % (keys, size), '']
+    lines.extend(format_generations(explain_generations(obj)))
+    return HttpResponse('\n'.join(lines), mimetype='text/plain')
+
 ##
 # Error handlers
 ##
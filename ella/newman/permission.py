@@ -105,11 +105,9 @@ def category_children(cats):
     Returns all nested categories as list.
     @param cats: list of Category objects
     """
-    sub_cats = set(map(None, cats))
-    for c in cats:
-        out = Category.objects.filter(tree_parent=c)
-        map(lambda o: sub_cats.add(o), category_children(out))
-    return sub_cats
+    if not cats:
+        return set()
+    return set(Category.objects.filter(ancestor_links__ancestor__in=[c.pk for c in cats]).distinct())
 
 #@cache_this(key_applicable_categories, timeout=CACHE_TIMEOUT)
 @utils.profiled_section
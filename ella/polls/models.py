@@ -10,7 +10,7 @@ from django.utils.safestring import mark_safe
 from django.conf import settings
 
 from ella.core.models import Publishable
-from ella.core.cache import get_cached_object, get_cached_list
+from ella.core.cache import get_cached_object, get_cached_objects, get_cached_list
 from ella.core.box import Box
 
 ACTIVITY_NOT_YET_ACTIVE = 0
@@ -387,12 +387,11 @@ class Contestant(models.Model):
         """
         Parse choices represented as a string and returns reached points count
         """
-        points = 0
+        pks = []
         for q in self.choices.split('|'):
             vs = q.split(':')
-            for v in vs[1].split(','):
-                points += get_cached_object(Choice, pk=v).points
-        return points
+            pks.extend(vs[1].split(','))
+        return sum(c.points for c in get_cached_objects(pks, model=Choice))
 
     def __unicode__(self):
         return u'%s %s' % (self.surname, self.name)
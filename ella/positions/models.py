@@ -8,17 +8,17 @@ from django.template import Template
 
 from ella.core.models import Category
 from ella.core.box import Box
-from ella.core.cache import CACHE_DELETER, cache_this, CachedGenericForeignKey
+from ella.core.cache import CACHE_DELETER, cache_this, CachedGenericForeignKey, CACHE_TIMEOUT, CACHE_STALE_TIMEOUT
 
 def get_position_key(func, self, category, name, nofallback=False):
     return 'ella.positions.models.PositionManager.get_active_position:%d:%s:%s' % (
             category.pk, name, nofallback and '1' or '0'
     )
 def invalidate_cache(key,  self, category, name, nofallback=False):
-    CACHE_DELETER.register_test(Position, "category_id:%s;name:%s" % (category.pk, name) , key)
+    CACHE_DELETER.register_test(Position, "category_id:%s;name:%s" % (category.pk, name) , key, [])
 
 class PositionManager(models.Manager):
-    @cache_this(get_position_key, invalidate_cache)
+    @cache_this(get_position_key, invalidate_cache, timeout=CACHE_TIMEOUT + CACHE_STALE_TIMEOUT, soft_timeout=CACHE_TIMEOUT, replicate=True)
     def get_active_position(self, category, name, nofallback=False):
         """
         Get active position for given position name.
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+'''
+Throughput of the cache invalidator's test matching.
+
+Compares the indexed ella.core.cache.registry.Registry with the linear walk
+over all registered tests the cache invalidator used before.
+
+    python invalidation_registry.py [number of keys] [number of messages]
+'''
+import sys
+import time
+import random
+from os.path import join, pardir, abspath, dirname
+
+sys.path.insert(0, abspath(join(dirname(__file__), pardir, pardir)))
+
+from django.utils.encoding import smart_str
+from django.utils.datastructures import MultiValueDict
+
+from ella.core.cache.registry import Registry
+
+
+MODEL = 'ella.core.models.Listing'
+CATEGORIES = 500
+
+
+class Instance(object):
+    def __init__(self, pk, category_id, publishable_id):
+        self.pk, self.category_id, self.publishable_id = pk, category_id, publishable_id
+
+    def _get_pk_val(self):
+        return self.pk
+
+class LinearRegistry(object):
+    " The registry as it used to be - a MultiValueDict of tests walked for every message. "
+    def __init__(self):
+        self.tests = MultiValueDict()
+
+    def add_test(self, model, test, key):
+        self.tests.appendlist(key, test)
+
+    def check_test(self, instance, test_str):
+        for subtest in test_str.split(';'):
+            attr = subtest.split(':')
+            if not (smart_str(instance.__getattribute__(attr[0].strip())) == attr[1].strip()):
+                return False
+        return True
+
+    def match(self, model, instance):
+        keys = set()
+        for key in self.tests.keys():
+            for t in self.tests.getlist(key):
+                if self.check_test(instance, t):
+                    keys.add(key)
+                    del self.tests[key]
+                    break
+        return keys
+
+def get_tests(count):
+    out = []
+    for i in range(count):
+        if i % 3:
+            test = 'category_id:%d' % random.randrange(CATEGORIES)
+        else:
+            test = 'category_id:%d;publishable_id:%d' % (random.randrange(CATEGORIES), random.randrange(count))
+        out.append((test, 'key:%d' % i))
+    return out
+
+def get_instances(count, keys):
+    return [Instance(i, random.randrange(CATEGORIES), random.randrange(keys)) for i in range(count)]
+
+def bench(registry, tests, instances):
+    for test, key in tests:
+        registry.add_test(MODEL, test, key)
+
+    start = time.time()
+    invalidated = 0
+    for instance in instances:
+        invalidated += len(registry.match(MODEL, instance))
+    return time.time() - start, invalidated
+
+def main(keys=20000, messages=500):
+    random.seed(0)
+    tests = get_tests(keys)
+    instances = get_instances(messages, keys)
+
+    for name, registry in (('linear', LinearRegistry()), ('indexed', Registry())):
+        duration, invalidated = bench(registry, tests, instances)
+        print '%-8s %6d keys %5d messages: %8.3fs, %8.1f messages/s, %d keys invalidated' % (
+            name, keys, messages, duration, messages / duration, invalidated)
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
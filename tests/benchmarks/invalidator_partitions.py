@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+'''
+Replays a synthetic invalidation stream through partitioned cache invalidators.
+
+Every partition is processed in turn, the throughput the workers would reach
+running in parallel is limited by the slowest one (and the messages they send
+to each other).
+
+    python invalidator_partitions.py [max partitions] [number of keys] [number of changes]
+'''
+import os
+import sys
+import time
+import random
+from os.path import join, pardir, abspath, dirname
+
+sys.path.insert(0, abspath(join(dirname(__file__), pardir)))
+sys.path.insert(0, abspath(join(dirname(__file__), pardir, pardir)))
+os.environ['DJANGO_SETTINGS_MODULE'] = 'unit_project.settings'
+
+from ella.core.cache.registry import Registry
+from ella.core.cache.transports import BaseTransport, route
+from ella.core.management.commands.cacheinvalidator import CacheInvalidator
+
+
+MODELS = ['ella.articles.models.Article', 'ella.core.models.Listing', 'ella.core.models.Placement',
+    'ella.core.models.Category', 'ella.photos.models.Photo', 'ella.positions.models.Position']
+CATEGORIES = 200
+
+
+class Instance(object):
+    def __init__(self, pk, category_id):
+        self.pk, self.category_id = pk, category_id
+
+    def _get_pk_val(self):
+        return self.pk
+
+class ReplayTransport(BaseTransport):
+    " Queues messages per partition instead of sending them. "
+    def __init__(self, partitions):
+        super(ReplayTransport, self).__init__(partitions)
+        self.queues = [[] for i in range(partitions)]
+
+    def send_to(self, partition, headers, body):
+        self.queues[partition].append((headers, body))
+
+    def notify(self, key):
+        pass
+
+def get_stream(keys, changes):
+    " Registrations of keys followed by changes of instances, as (headers, instance or body) pairs. "
+    stream = []
+    for i in range(keys):
+        model = random.choice(MODELS)
+        key = 'key:%d' % i
+        stream.append(({'type': 'test', 'key': key, 'model': model}, 'category_id:%d' % random.randrange(CATEGORIES)))
+        stream.append(({'type': 'pk', 'key': key, 'model': model}, Instance(random.randrange(keys), 0)))
+        if i % 4:
+            stream.append(({'type': 'dep', 'key': key, 'model': 'key:%d' % random.randrange(keys)}, ''))
+    for i in range(changes):
+        stream.append(({'type': 'del', 'key': None, 'model': random.choice(MODELS)}, Instance(random.randrange(keys), random.randrange(CATEGORIES))))
+    return stream
+
+def replay(invalidator, headers, body):
+    # skip pickling, it costs the same with any number of partitions
+    if headers['type'] == 'pk':
+        invalidator._register.add_pk(headers['model'], body.pk, headers['key'])
+    elif headers['type'] == 'del':
+        keys = invalidator._register.match(headers['model'], body)
+        if keys:
+            invalidator.invalidate(keys)
+    else:
+        invalidator.on_message(headers, body)
+
+def bench(stream, partitions):
+    transport = ReplayTransport(partitions)
+    invalidators = [CacheInvalidator(transport, Registry(), partition) for partition in range(partitions)]
+    for headers, body in stream:
+        transport.queues[route(headers, partitions)].append((headers, body))
+
+    durations = [0.0] * partitions
+    pending = True
+    while pending:
+        pending = False
+        for partition in range(partitions):
+            queue, transport.queues[partition] = transport.queues[partition], []
+            pending = pending or bool(queue)
+            start = time.time()
+            for headers, body in queue:
+                replay(invalidators[partition], headers, body)
+            durations[partition] += time.time() - start
+    return durations
+
+def main(max_partitions=8, keys=20000, changes=2000):
+    random.seed(0)
+    stream = get_stream(keys, changes)
+    partitions = 1
+    while partitions <= max_partitions:
+        durations = bench(stream, partitions)
+        print '%2d partitions: slowest worker %7.3fs, %9.1f messages/s, load %s' % (
+            partitions, max(durations), len(stream) / max(durations), ' '.join('%.2f' % d for d in durations))
+        partitions *= 2
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+'''
+Cost of deep listing pages.
+
+Compares OFFSET pagination with COUNT, which ListContentType used for every
+page, with the keyset pagination of Listing.objects.get_listing_after used
+beyond the first LISTING_NUMBERED_PAGES pages now. The cache is disabled.
+
+    python listing_pagination.py [number of listings] [page size]
+'''
+import sys
+import time
+
+# sets up the environment and the dummy cache, populates the database
+from listing_priorities import settings, connection, populate
+
+
+def offset_page(category, page, paginate_by):
+    from ella.core.models import Listing
+    qset = Listing.objects.get_listing_queryset(category, Listing.objects.ALL)
+    qset.count()
+    return list(qset.order_by('-publish_from', '-pk')[(page - 1) * paginate_by:page * paginate_by])
+
+def keyset_page(category, cursor, paginate_by):
+    from ella.core.models import Listing
+    return Listing.objects.get_listing_after(cursor, paginate_by, category, Listing.objects.ALL)
+
+def bench(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+def main(listings=5000, paginate_by=20):
+    database_name = settings.DATABASE_NAME
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        category = populate(listings)
+        page, cursor = 1, None
+        while (page - 1) * paginate_by < listings:
+            offset, result = bench(offset_page, category, page, paginate_by)
+            if cursor is None:
+                print 'page %5d: offset %7.4fs' % (page, offset)
+            else:
+                keyset, result = bench(keyset_page, category, cursor, paginate_by)
+                print 'page %5d: offset %7.4fs, keyset %7.4fs' % (page, offset, keyset)
+            # cursor of the page before the next one measured
+            page *= 4
+            previous = offset_page(category, page - 1, paginate_by)
+            cursor = previous and (previous[-1].publish_from, previous[-1].pk) or None
+    finally:
+        connection.creation.destroy_test_db(database_name, verbosity=0)
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
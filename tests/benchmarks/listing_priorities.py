@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+'''
+Cost of prioritized listings at growing offsets.
+
+Compares Listing.objects.get_listing, which orders by the effective priority
+in the database, with the three querysets (positive, normal and negative
+priority) merged in Python that get_listing used before.
+
+    python listing_priorities.py [number of listings] [page size]
+'''
+import os
+import sys
+import time
+import random
+from datetime import datetime, timedelta
+from os.path import join, pardir, abspath, dirname
+
+sys.path.insert(0, abspath(join(dirname(__file__), pardir)))
+sys.path.insert(0, abspath(join(dirname(__file__), pardir, pardir)))
+os.environ['DJANGO_SETTINGS_MODULE'] = 'unit_project.settings'
+
+from django.conf import settings
+settings.CACHE_BACKEND = 'dummy://'
+settings.USE_PRIORITIES = True
+
+from django.db import connection, models
+
+from ella.core.managers import DEFAULT_LISTING_PRIORITY
+
+
+def old_get_listing(category, count, offset, now):
+    " get_listing as it was - every priority group fetched up to limit and merged. "
+    from ella.core.models import Listing
+    qset = Listing.objects.get_listing_queryset(category, Listing.objects.ALL, now=now)
+    offset -= 1
+    limit = offset + count
+    listed_targets = set([])
+
+    active = models.Q(priority_value__isnull=False, priority_from__isnull=False, priority_from__lte=now, priority_to__gte=now)
+    qsets = (
+        qset.filter(active, priority_value__gt=DEFAULT_LISTING_PRIORITY).order_by('-priority_value', '-publish_from'),
+        qset.exclude(active).order_by('-publish_from'),
+        qset.filter(active, priority_value__lt=DEFAULT_LISTING_PRIORITY).order_by('-priority_value', '-publish_from'),
+    )
+
+    out = []
+    for q in qsets:
+        for l in q[:limit]:
+            if l.placement_id not in listed_targets:
+                listed_targets.add(l.placement_id)
+                out.append(l)
+                if len(out) == limit:
+                    return out[offset:limit]
+    return out[offset:limit]
+
+def populate(listings):
+    from ella.core.models import Category, Placement, Listing
+    from ella.articles.models import Article
+
+    category = Category.objects.create(title=u'bench', slug=u'bench', site_id=settings.SITE_ID)
+    now = datetime.now()
+    for i in range(listings):
+        publish_from = now - timedelta(hours=i + 1)
+        article = Article.objects.create(title=u'Article %d' % i, slug=u'article-%d' % i, description=u'', category=category)
+        placement = Placement.objects.create(publishable=article, category=category, publish_from=publish_from)
+        listing = Listing(placement=placement, category=category, publish_from=publish_from)
+        if not i % 20:
+            listing.priority_from = now - timedelta(days=1)
+            listing.priority_to = now + timedelta(days=1)
+            listing.priority_value = random.choice((-10, 10))
+        listing.save()
+    return category
+
+def bench(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+def main(listings=5000, count=10):
+    from ella.core.models import Listing
+
+    random.seed(0)
+    database_name = settings.DATABASE_NAME
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        category = populate(listings)
+        now = datetime.now()
+        offset = 1
+        while offset < listings:
+            old = bench(old_get_listing, category, count, offset, now)
+            new = bench(Listing.objects.get_listing, category, Listing.objects.ALL, count, offset)
+            print 'offset %6d: three querysets %7.3fs, single query %7.3fs' % (offset, old, new)
+            offset *= 4
+    finally:
+        connection.creation.destroy_test_db(database_name, verbosity=0)
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -20,7 +20,12 @@ CACHE_TEMPLATE_LOADERS = (
     'django.template.loaders.filesystem.load_template_source',
 )
 
+# InvalidationBatchMiddleware has to be listed above
+# django.middleware.transaction.TransactionMiddleware (when used), changes
+# saved in the request's transaction are sent to the cache invalidator after
+# the commit and must still make it to the request's batch
 MIDDLEWARE_CLASSES = (
+    'ella.core.middleware.InvalidationBatchMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
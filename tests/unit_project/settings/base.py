@@ -16,7 +16,12 @@ TEMPLATE_LOADERS = (
     'unit_project.template_loader.load_template_source',
 )
 
+# InvalidationBatchMiddleware has to be listed above
+# django.middleware.transaction.TransactionMiddleware (when used), changes
+# saved in the request's transaction are sent to the cache invalidator after
+# the commit and must still make it to the request's batch
 MIDDLEWARE_CLASSES = (
+    'ella.core.middleware.InvalidationBatchMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
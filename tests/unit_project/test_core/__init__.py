@@ -2,10 +2,18 @@
 from datetime import datetime, timedelta
 
 from django.conf import settings
+from django.core.cache import get_cache
+from django.db.models import signals
+
+from djangosanetesting import DatabaseTestCase
 
 from ella.core.models import Placement, Category, Listing, Publishable
 # choose Article as an example publishable
 from ella.articles.models import Article
+from ella.core.cache import utils, generations, explain
+from ella.core.cache.invalidate import CACHE_DELETER
+from ella.core.cache.transports import InProcessTransport
+from ella.core.management.commands import cacheinvalidator
 
 def create_basic_categories(case):
     case.site_id = getattr(settings, "SITE_ID", 1)
@@ -88,3 +96,37 @@ def list_all_placements_in_category_by_hour(case, category=None):
         )
         publish_from += timedelta(seconds=3600)
     case.listings.reverse()
+
+class CacheTestCase(DatabaseTestCase):
+    " Replace the dummy cache backend used by unit_project with a fresh local memory cache. "
+    def setUp(self):
+        super(CacheTestCase, self).setUp()
+        self.old_caches = utils.cache, generations.cache
+        self.cache = utils.cache = generations.cache = get_cache('locmem://')
+
+    def tearDown(self):
+        utils.cache, generations.cache = self.old_caches
+        super(CacheTestCase, self).tearDown()
+
+class InProcessTestCase(CacheTestCase):
+    " Run the cache invalidator in the test process. "
+    def setUp(self):
+        super(InProcessTestCase, self).setUp()
+        create_basic_categories(self)
+        self.old_invalidator_caches = cacheinvalidator.cache, explain.cache
+        cacheinvalidator.cache = explain.cache = self.cache
+        self.transport = InProcessTransport()
+        CACHE_DELETER.connect(self.transport)
+        # tests run in a transaction never committed, send changes right away
+        CACHE_DELETER.send_after_commit = False
+        signals.post_save.connect(CACHE_DELETER.propagate_signal)
+
+    def tearDown(self):
+        signals.post_save.disconnect(CACHE_DELETER.propagate_signal)
+        CACHE_DELETER.send_after_commit = True
+        CACHE_DELETER.disconnect()
+        cacheinvalidator.cache, explain.cache = self.old_invalidator_caches
+        super(InProcessTestCase, self).tearDown()
+
+def get_test_key(func, value):
+    return 'unit_project.test_core:%s' % value
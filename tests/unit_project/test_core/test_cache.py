@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+from djangosanetesting import UnitTestCase
+
+from django.core.cache import get_cache
+from django.http import Http404
+from django.contrib.sites.models import Site
+
+from ella.core.cache import utils, generations, encoding, replication
+from ella.core.cache.utils import get_cached_object, get_cached_objects, get_cached_object_or_404, get_cached_list, cache_this, normalize_key, SKIP, NONE
+from ella.utils import mutex
+from ella.utils.mutex import EllaMutex
+from ella.core.cache.local import LocalCache, LOCAL_CACHE, IDENTITY_MAP
+from ella.core.middleware import IdentityMapMiddleware
+from ella.core.cache.invalidate import CACHE_DELETER
+from ella.core.models import Category, Placement
+
+from unit_project.test_core import create_basic_categories, create_and_place_a_publishable, CacheTestCase, get_test_key
+
+
+class TestGetCachedObjects(CacheTestCase):
+    def setUp(self):
+        super(TestGetCachedObjects, self).setUp()
+        create_basic_categories(self)
+        self.categories = [self.category, self.category_nested, self.category_nested_second]
+
+    def test_returns_objects_in_order_of_pks(self):
+        pks = [c.pk for c in reversed(self.categories)]
+        self.assert_equals(list(reversed(self.categories)), get_cached_objects(pks, model=Category))
+
+    def test_stores_objects_under_get_cached_object_keys(self):
+        get_cached_objects([self.category.pk], model=Category)
+        Category.objects.filter(pk=self.category.pk).update(title=u'changed')
+        self.assert_equals(self.category.title, get_cached_object(Category, pk=self.category.pk).title)
+
+    def test_uses_objects_cached_by_get_cached_object(self):
+        get_cached_object(Category, pk=self.category.pk)
+        Category.objects.update(title=u'changed')
+        self.assert_equals([self.category.title, u'changed'], [c.title for c in get_cached_objects([self.category.pk, self.category_nested.pk], model=Category)])
+
+    def test_raises_on_missing_object(self):
+        self.assert_raises(Category.DoesNotExist, get_cached_objects, [self.category.pk, 1000], model=Category)
+
+    def test_skips_missing_object(self):
+        self.assert_equals([self.category], get_cached_objects([self.category.pk, 1000], model=Category, missing=SKIP))
+
+    def test_returns_none_for_missing_object(self):
+        self.assert_equals([None, self.category], get_cached_objects([1000, self.category.pk], model=Category, missing=NONE))
+
+class TestGetCachedObjectsMultipleModels(CacheTestCase):
+    def setUp(self):
+        super(TestGetCachedObjectsMultipleModels, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+
+    def test_content_type_pk_tuples(self):
+        from django.contrib.contenttypes.models import ContentType
+        cat_ct = ContentType.objects.get_for_model(Category)
+        plc_ct = ContentType.objects.get_for_model(Placement)
+        self.assert_equals(
+                [self.placement, self.category],
+                get_cached_objects([(plc_ct.pk, self.placement.pk), (cat_ct.pk, self.category.pk)])
+            )
+
+class TestLocalCache(UnitTestCase):
+    def setUp(self):
+        super(TestLocalCache, self).setUp()
+        self.local = LocalCache(max_entries=2, timeout=60)
+
+    def test_returns_stored_value(self):
+        self.local.set('a', {'x': 1})
+        self.assert_equals({'x': 1}, self.local.get('a'))
+
+    def test_returns_copy_of_stored_value(self):
+        self.local.set('a', {'x': 1})
+        self.local.get('a')['x'] = 2
+        self.assert_equals({'x': 1}, self.local.get('a'))
+
+    def test_least_recently_used_entry_is_dropped(self):
+        self.local.set('a', 1)
+        self.local.set('b', 2)
+        self.local.get('a')
+        self.local.set('c', 3)
+        self.assert_equals({'a': 1, 'c': 3}, self.local.get_many(['a', 'b', 'c']))
+
+    def test_expired_entry_is_dropped(self):
+        self.local.set('a', 1, timeout=-1)
+        self.assert_equals(None, self.local.get('a'))
+        self.assert_equals(0, len(self.local))
+
+    def test_timeout_is_capped_by_local_timeout(self):
+        self.local.timeout = -1
+        self.local.set('a', 1, timeout=600)
+        self.assert_equals(None, self.local.get('a'))
+
+    def test_counts_hits_and_misses(self):
+        self.local.set('a', 1)
+        self.local.get('a')
+        self.local.get('b')
+        self.assert_equals((1, 1), (self.local.hits, self.local.misses))
+
+    def test_disabled_cache_stores_nothing(self):
+        self.local.max_entries = 0
+        self.local.set('a', 1)
+        self.assert_equals(None, self.local.get('a'))
+
+class TestLocalCacheTier(CacheTestCase):
+    def setUp(self):
+        super(TestLocalCacheTier, self).setUp()
+        self.old_max_entries = LOCAL_CACHE.max_entries
+        LOCAL_CACHE.max_entries = 100
+        LOCAL_CACHE.clear()
+        create_basic_categories(self)
+
+    def tearDown(self):
+        LOCAL_CACHE.max_entries = self.old_max_entries
+        LOCAL_CACHE.clear()
+        super(TestLocalCacheTier, self).tearDown()
+
+    def test_object_is_served_from_local_tier(self):
+        get_cached_object(Category, pk=self.category.pk)
+        # empty backend, only the local tier remembers the object
+        utils.cache = get_cache('locmem://')
+        self.assert_equals(self.category, get_cached_object(Category, pk=self.category.pk))
+        self.assert_equals(1, utils.get_cache_stats()['local']['hits'])
+
+    def test_invalidated_key_is_evicted_from_local_tier(self):
+        get_cached_object(Category, pk=self.category.pk)
+        key = utils._get_key(utils.KEY_FORMAT_OBJECT, Category, {'pk': self.category.pk})
+        CACHE_DELETER.on_message({'type': 'invalidated', 'key': key}, '')
+        self.assert_equals(None, LOCAL_CACHE.get(key))
+
+class TestIdentityMap(CacheTestCase):
+    def setUp(self):
+        super(TestIdentityMap, self).setUp()
+        create_basic_categories(self)
+        self.middleware = IdentityMapMiddleware()
+        self.middleware.process_request(None)
+
+    def tearDown(self):
+        IDENTITY_MAP.deactivate()
+        super(TestIdentityMap, self).tearDown()
+
+    def test_same_instance_is_returned_within_request(self):
+        c = get_cached_object(Category, pk=self.category.pk)
+        self.assert_true(c is get_cached_object(Category, pk=self.category.pk))
+
+    def test_get_cached_objects_shares_instances_with_get_cached_object(self):
+        c = get_cached_object(Category, pk=self.category.pk)
+        self.assert_true(c is get_cached_objects([self.category.pk], model=Category)[0])
+
+    def test_map_is_cleared_after_request(self):
+        c = get_cached_object(Category, pk=self.category.pk)
+        self.middleware.process_response(None, None)
+        self.assert_false(c is get_cached_object(Category, pk=self.category.pk))
+
+    def test_map_is_not_used_outside_request(self):
+        self.middleware.process_response(None, None)
+        c = get_cached_object(Category, pk=self.category.pk)
+        self.assert_false(c is get_cached_object(Category, pk=self.category.pk))
+
+    def test_saved_object_is_evicted_from_map(self):
+        c = get_cached_object(Category, pk=self.category.pk)
+        t = get_cached_object(Category, tree_path=self.category.tree_path, site__id=self.site_id)
+        self.category.save()
+        self.assert_false(c is get_cached_object(Category, pk=self.category.pk))
+        self.assert_false(t is get_cached_object(Category, tree_path=self.category.tree_path, site__id=self.site_id))
+
+    def test_map_keeps_objects_on_unrelated_save(self):
+        c = get_cached_object(Category, pk=self.category.pk)
+        self.category_nested.save()
+        self.assert_true(c is get_cached_object(Category, pk=self.category.pk))
+
+class TestCacheThisSoftExpiry(UnitTestCase):
+    def setUp(self):
+        super(TestCacheThisSoftExpiry, self).setUp()
+        self.old_caches = utils.cache, mutex.cache
+        self.cache = utils.cache = mutex.cache = get_cache('locmem://')
+        self.calls = []
+
+    def tearDown(self):
+        utils.cache, mutex.cache = self.old_caches
+        super(TestCacheThisSoftExpiry, self).tearDown()
+
+    def get_func(self, soft_timeout):
+        def func(value):
+            self.calls.append(value)
+            return '%s-%d' % (value, len(self.calls))
+        return cache_this(get_test_key, soft_timeout=soft_timeout)(func)
+
+    def test_fresh_value_is_not_recomputed(self):
+        func = self.get_func(60)
+        self.assert_equals('a-1', func('a'))
+        self.assert_equals('a-1', func('a'))
+        self.assert_equals(['a'], self.calls)
+
+    def test_soft_expired_value_is_recomputed(self):
+        func = self.get_func(0)
+        self.assert_equals('a-1', func('a'))
+        self.assert_equals('a-2', func('a'))
+
+    def test_stale_value_is_served_while_somebody_else_recomputes(self):
+        func = self.get_func(0)
+        self.assert_equals('a-1', func('a'))
+        key = normalize_key(get_test_key(None, 'a'))
+        EllaMutex('%s:refresh' % key).lock()
+        self.assert_equals('a-1', func('a'))
+        self.assert_equals(['a'], self.calls)
+
+    def test_lock_is_released_after_recompute(self):
+        func = self.get_func(0)
+        func('a')
+        func('a')
+        key = normalize_key(get_test_key(None, 'a'))
+        self.assert_true(EllaMutex('%s:refresh' % key).lock())
+
+    def test_soft_expired_value_is_read_from_backend_once(self):
+        func = self.get_func(0)
+        func('a')
+        key = normalize_key(get_test_key(None, 'a'))
+        gets = []
+        get = self.cache.get
+        def counting_get(k, default=None):
+            if k == key:
+                gets.append(k)
+            return get(k, default)
+        self.cache.get = counting_get
+        self.assert_equals('a-2', func('a'))
+        self.assert_equals(1, len(gets))
+
+    def test_hard_expired_value_is_recomputed(self):
+        func = self.get_func(60)
+        func('a')
+        self.cache.delete(normalize_key(get_test_key(None, 'a')))
+        self.assert_equals('a-2', func('a'))
+
+class TestNegativeCaching(CacheTestCase):
+    def setUp(self):
+        super(TestNegativeCaching, self).setUp()
+        create_basic_categories(self)
+
+    def test_missing_object_is_remembered(self):
+        self.assert_raises(Category.DoesNotExist, get_cached_object, Category, slug='missing', site=self.site_id)
+        Category.objects.filter(pk=self.category_nested_second.pk).update(slug='missing')
+        self.assert_raises(Category.DoesNotExist, get_cached_object, Category, slug='missing', site=self.site_id)
+
+    def test_missing_object_raises_404(self):
+        self.assert_raises(Http404, get_cached_object_or_404, Category, slug='missing')
+        self.assert_raises(Http404, get_cached_object_or_404, Category, slug='missing')
+
+    def test_missing_objects_are_remembered_by_get_cached_objects(self):
+        self.assert_equals([None], get_cached_objects([1000], model=Category, missing=NONE))
+        self.assert_raises(Category.DoesNotExist, get_cached_object, Category, pk=1000)
+
+    def test_invalidation_test_for_lookups(self):
+        self.assert_equals('site_id:1;slug:missing', utils._get_test(Category, {'slug': 'missing', 'site': 1}))
+        self.assert_equals('site_id:1;tree_path:', utils._get_test(Category, {'tree_path': '', 'site__id': 1}))
+        self.assert_equals('id:1000', utils._get_test(Category, {'pk': 1000}))
+
+    def test_invalidation_test_skips_lookups_it_cannot_check(self):
+        self.assert_equals('site_id:1', utils._get_test(Category, {'tree_parent__isnull': True, 'site__name': 'x', 'site': 1}))
+
+class TestEncoding(CacheTestCase):
+    def setUp(self):
+        super(TestEncoding, self).setUp()
+        create_basic_categories(self)
+
+    def test_round_trip(self):
+        c = encoding.decode(encoding.encode(self.category_nested))
+        self.assert_equals(self.category_nested, c)
+        self.assert_equals(self.category_nested.title, c.title)
+        self.assert_equals(self.category_nested.tree_parent_id, c.tree_parent_id)
+
+    def test_loaded_related_objects_are_kept(self):
+        self.category_nested.tree_parent
+        c = encoding.decode(encoding.encode(self.category_nested))
+        self.assert_equals(self.category, c.__dict__[Category._meta.get_field('tree_parent').get_cache_name()])
+
+    def test_different_schema_is_discarded(self):
+        value = list(encoding.encode(self.category))
+        value[3] += 1
+        self.assert_equals(None, encoding.decode(tuple(value)))
+
+    def test_other_values_pass_unchanged(self):
+        self.assert_equals([1, 2], encoding.decode([1, 2]))
+
+    def test_get_cached_object_stores_encoded_instance(self):
+        get_cached_object(Category, pk=self.category.pk)
+        key = utils._get_key(utils.KEY_FORMAT_OBJECT, Category, {'pk': self.category.pk})
+        self.assert_true(encoding.is_encoded(replication.get(self.cache, key)))
+
+    def test_value_with_different_schema_is_refetched(self):
+        key = utils._get_key(utils.KEY_FORMAT_OBJECT, Category, {'pk': self.category.pk})
+        value = list(encoding.encode(self.category))
+        value[3] += 1
+        replication.set(self.cache, key, tuple(value), 60)
+        self.assert_equals(self.category, get_cached_object(Category, pk=self.category.pk))
+        self.assert_equals([self.category], get_cached_objects([self.category.pk], model=Category))
+
+class TestGetCachedList(CacheTestCase):
+    def setUp(self):
+        super(TestGetCachedList, self).setUp()
+        create_basic_categories(self)
+
+    @property
+    def list_key(self):
+        key = utils._get_key(utils.KEY_FORMAT_LIST, Category, {'site': self.site_id})
+        return replication.replicated_key(normalize_key(generations.generation_key(key, [generations.field_namespace(Category, 'site_id', self.site_id)])))
+
+    def object_key(self, category):
+        return utils._get_key(utils.KEY_FORMAT_OBJECT, Category, {'pk': category.pk})
+
+    def test_returns_objects_matching_lookup(self):
+        self.assert_equals(list(Category.objects.filter(site=self.site_id)), get_cached_list(Category, site=self.site_id))
+
+    def test_stores_only_primary_keys_under_list_key(self):
+        get_cached_list(Category, site=self.site_id)
+        self.assert_equals([c.pk for c in Category.objects.filter(site=self.site_id)], replication.get(self.cache, self.list_key))
+
+    def test_objects_are_hydrated_from_object_keys(self):
+        get_cached_list(Category, site=self.site_id)
+        Category.objects.filter(pk=self.category.pk).update(title=u'changed')
+        replication.delete(self.cache, self.object_key(self.category))
+        self.assert_true(u'changed' in [c.title for c in get_cached_list(Category, site=self.site_id)])
+
+    def test_deleted_objects_are_left_out(self):
+        get_cached_list(Category, site=self.site_id)
+        Category.objects.filter(pk=self.category_nested_second.pk).delete()
+        replication.delete(self.cache, self.object_key(self.category_nested_second))
+        self.assert_equals(list(Category.objects.filter(site=self.site_id)), get_cached_list(Category, site=self.site_id))
+
+    def test_saving_object_starts_new_list(self):
+        get_cached_list(Category, site=self.site_id)
+        self.category_nested_second.delete()
+        self.assert_equals([self.category, self.category_nested], get_cached_list(Category, site=self.site_id))
+
+    def test_moving_object_out_of_spanning_lookup_starts_new_list(self):
+        create_and_place_a_publishable(self)
+        self.assert_equals([self.placement], get_cached_list(Placement, publishable=self.publishable.pk, category__site=self.site_id))
+        site = Site.objects.create(name='some site', domain='not-example.com')
+        self.placement.category = Category.objects.create(
+            title=u'other site category',
+            description=u'example testing category, second site',
+            site=site,
+            slug=u'other-site-category',
+        )
+        self.placement.save()
+        self.assert_equals([], get_cached_list(Placement, publishable=self.publishable.pk, category__site=self.site_id))
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from ella.core.cache import explain, generations
+from ella.core.cache.invalidate import CACHE_DELETER
+from ella.core.cache.utils import get_cached_list
+from ella.core.models import Category
+
+from unit_project.test_core import InProcessTestCase
+
+
+class TestExplain(InProcessTestCase):
+    def test_explain_lists_keys_and_their_dependents(self):
+        self.cache.set('inner', 'x' * 100)
+        CACHE_DELETER.register_pk(self.category, 'inner')
+        CACHE_DELETER.register_test(Category, 'slug:%s' % self.category.slug, 'list')
+        CACHE_DELETER.register_dependency('inner', 'box')
+        CACHE_DELETER.register_dependency('box', 'page')
+        CACHE_DELETER.register_dependency('page', 'inner')
+        entries = explain.explain(self.category)
+        self.assert_equals(['inner', 'list'], [e['key'] for e in entries])
+        self.assert_equals(('pk', True), (entries[0]['reason'], entries[0]['size'] > 100))
+        self.assert_equals('page', entries[0]['dependents'][0]['dependents'][0]['key'])
+        self.assert_equals([], entries[0]['dependents'][0]['dependents'][0]['dependents'])
+        self.assert_equals((4, entries[0]['size']), explain.get_totals(entries))
+
+    def test_explain_does_not_change_registry(self):
+        CACHE_DELETER.register_pk(self.category, 'inner')
+        explain.explain(self.category)
+        self.assert_equals(1, len(self.transport.invalidator._register.get_model(str(Category))))
+
+    def test_explain_generations_lists_bumped_namespaces_and_their_families(self):
+        generations._noted.clear()
+        get_cached_list(Category, tree_parent=self.category)
+        entries = dict((e['namespace'], e) for e in explain.explain_generations(self.category_nested))
+        field_ns = generations.field_namespace(Category, 'tree_parent_id', self.category.pk)
+        self.assert_equals(['ella.core.cache.utils.get_cached_list'], entries[field_ns]['families'])
+        self.assert_true(entries[field_ns]['generation'] is not None)
+        instance_ns = generations.instance_namespace(Category, self.category_nested.pk)
+        self.assert_equals([], entries[instance_ns]['families'])
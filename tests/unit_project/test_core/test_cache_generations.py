@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+from ella.core.cache import generations, replication
+from ella.core.cache.utils import cache_this, get_cached_list
+from ella.core.models import Category, Placement, Listing
+
+from unit_project.test_core import create_basic_categories, create_and_place_a_publishable, create_and_place_more_publishables, \
+        CacheTestCase, get_test_key
+
+
+class TestGenerations(CacheTestCase):
+    def setUp(self):
+        super(TestGenerations, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+
+    def get_generation(self, namespace):
+        return generations.get_generations([namespace])[0]
+
+    def test_generation_is_stable(self):
+        ns = generations.model_namespace(Category)
+        self.assert_equals(self.get_generation(ns), self.get_generation(ns))
+
+    def test_save_bumps_model_and_instance_namespaces(self):
+        namespaces = [generations.model_namespace(Category), generations.instance_namespace(Category, self.category.pk)]
+        before = generations.get_generations(namespaces)
+        self.category.save()
+        self.assert_equals([g + 1 for g in before], generations.get_generations(namespaces))
+
+    def test_save_bumps_old_and_new_foreign_key_namespaces(self):
+        old_ns = generations.field_namespace(Placement, 'category_id', self.category_nested.pk)
+        new_ns = generations.field_namespace(Placement, 'category_id', self.category.pk)
+        before = generations.get_generations([old_ns, new_ns])
+        self.placement.category = self.category
+        self.placement.save()
+        self.assert_equals([g + 1 for g in before], generations.get_generations([old_ns, new_ns]))
+
+    def test_save_keeps_namespaces_of_unchanged_foreign_keys(self):
+        ns = generations.field_namespace(Placement, 'category_id', self.category_nested.pk)
+        before = self.get_generation(ns)
+        placement = Placement.objects.get(pk=self.placement.pk)
+        placement.slug = u'changed-slug'
+        placement.save()
+        self.assert_equals(before, self.get_generation(ns))
+
+    def test_created_instance_bumps_foreign_key_namespaces(self):
+        ns = generations.field_namespace(Listing, 'category_id', self.category.pk)
+        before = self.get_generation(ns)
+        Listing.objects.create(placement=self.placement, category=self.category, publish_from=self.placement.publish_from)
+        self.assert_equals(before + 1, self.get_generation(ns))
+
+    def test_change_of_membership_field_bumps_foreign_key_namespaces(self):
+        listing = Listing.objects.create(placement=self.placement, category=self.category, publish_from=self.placement.publish_from)
+        ns = generations.field_namespace(Listing, 'category_id', self.category.pk)
+        before = self.get_generation(ns)
+        listing.priority_value = 10
+        listing.save()
+        self.assert_equals(before + 1, self.get_generation(ns))
+
+    def test_save_of_subclass_bumps_parent_namespace(self):
+        from ella.core.models import Publishable
+        ns = generations.instance_namespace(Publishable, self.publishable.pk)
+        before = self.get_generation(ns)
+        self.publishable.save()
+        self.assert_equals(before + 1, self.get_generation(ns))
+
+    def test_list_is_refreshed_on_change_of_any_of_its_foreign_keys(self):
+        create_and_place_more_publishables(self)
+        other = self.publishables[0]
+        self.assert_equals([], get_cached_list(Placement, category=self.category_nested.pk, publishable=other.pk))
+        self.placement.publishable = other
+        self.placement.save()
+        self.assert_equals([self.placement], get_cached_list(Placement, category=self.category_nested.pk, publishable=other.pk))
+
+    def test_cache_this_key_includes_generations(self):
+        calls = []
+        def func(value):
+            calls.append(value)
+            return value
+        ns = generations.model_namespace(Category)
+        func = cache_this(get_test_key, generations=lambda f, value: [ns])(func)
+        func('a')
+        func('a')
+        self.category.save()
+        func('a')
+        self.assert_equals(['a', 'a'], calls)
+
+class TestGenerationSeed(CacheTestCase):
+    def setUp(self):
+        super(TestGenerationSeed, self).setUp()
+        self.now = 1000000000.0
+        self.old_time = generations.time
+        generations.time = self
+
+    def tearDown(self):
+        generations.time = self.old_time
+        super(TestGenerationSeed, self).tearDown()
+
+    def time(self):
+        return self.now
+
+    def test_evicted_counter_never_repeats_a_used_generation(self):
+        ns = generations.model_namespace(Category)
+        generations.get_generations([ns])
+        generations.bump([ns])
+        generations.bump([ns])
+        used = generations.get_generations([ns])[0]
+        replication.delete(self.cache, generations.get_counter_key(ns))
+        self.now += 1
+        self.assert_true(generations.get_generations([ns])[0] > used)
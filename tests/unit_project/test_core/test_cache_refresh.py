@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from django.db.models import signals
+from django.template import Context, NodeList, TextNode
+
+from ella.core import box, managers
+from ella.core.box import Box
+from ella.core.cache.utils import cache_this, normalize_key
+from ella.core.cache.invalidate import CACHE_DELETER
+from ella.core.models import Category, Listing
+
+from unit_project import template_loader
+from unit_project.test_core import CacheTestCase, InProcessTestCase, create_basic_categories, get_test_key, create_and_place_a_publishable, \
+        create_and_place_more_publishables, list_all_placements_in_category_by_hour
+
+
+HOT_VALUES = []
+
+def get_hot_refresh(func, category_id):
+    return 'unit_project.test_core.test_cache_refresh.get_hot_value', (category_id,), {}, [(Category, 'id:%s' % category_id, [])]
+
+@cache_this(get_test_key, refresh=get_hot_refresh)
+def get_hot_value(category_id):
+    if not HOT_VALUES:
+        raise ValueError('no value')
+    return HOT_VALUES[-1]
+
+@cache_this(get_test_key)
+def get_cached_value(name):
+    return name
+
+def get_pair_key(func, category_id):
+    return get_test_key(func, 'pair:%s' % category_id)
+
+def get_pair_refresh(func, category_id):
+    return 'unit_project.test_core.test_cache_refresh.get_hot_pair', (category_id,), {}, [(Category, 'id:%s' % category_id, [])]
+
+@cache_this(get_pair_key, refresh=get_pair_refresh)
+def get_hot_pair(category_id):
+    return get_cached_value('cached'), HOT_VALUES[-1]
+
+class TestRefreshOnInvalidate(InProcessTestCase):
+    def setUp(self):
+        super(TestRefreshOnInvalidate, self).setUp()
+        HOT_VALUES[:] = ['old']
+        self.key = normalize_key(get_test_key(None, self.category.pk))
+        get_hot_value(self.category.pk)
+
+    def test_hot_key_is_regenerated_instead_of_deleted(self):
+        HOT_VALUES.append('new')
+        self.category.save()
+        self.assert_equals('new', self.cache.get(self.key))
+
+    def test_regenerated_key_stays_hot(self):
+        HOT_VALUES.append('new')
+        self.category.save()
+        HOT_VALUES.append('newer')
+        self.category.save()
+        self.assert_equals('newer', self.cache.get(self.key))
+
+    def test_hot_key_computed_from_cached_values_stays_hot(self):
+        key = normalize_key(get_pair_key(None, self.category.pk))
+        get_hot_pair(self.category.pk)
+        HOT_VALUES.append('new')
+        self.category.save()
+        HOT_VALUES.append('newer')
+        self.category.save()
+        self.assert_equals(('cached', 'newer'), self.cache.get(key))
+
+    def test_key_is_deleted_when_regeneration_fails(self):
+        HOT_VALUES[:] = []
+        self.category.save()
+        self.assert_equals(None, self.cache.get(self.key))
+
+    def test_dependent_hot_key_is_regenerated(self):
+        self.cache.set('inner', 'inner')
+        CACHE_DELETER.register_pk(self.category_nested, 'inner')
+        CACHE_DELETER.register_dependency('inner', self.key)
+        HOT_VALUES.append('new')
+        self.category_nested.save()
+        self.assert_equals((None, 'new'), (self.cache.get('inner'), self.cache.get(self.key)))
+
+class TestHotListingWindow(InProcessTestCase):
+    def setUp(self):
+        super(TestHotListingWindow, self).setUp()
+        create_and_place_a_publishable(self)
+        create_and_place_more_publishables(self)
+        list_all_placements_in_category_by_hour(self, self.category)
+        self.old_refresh_listings = managers.CACHE_REFRESH_LISTINGS
+        managers.CACHE_REFRESH_LISTINGS = True
+
+        self.queries = []
+        def query_listing(*args, **kwargs):
+            self.queries.append((args, kwargs))
+            return Listing.objects.__class__.query_listing(Listing.objects, *args, **kwargs)
+        Listing.objects.query_listing = query_listing
+
+    def tearDown(self):
+        del Listing.objects.query_listing
+        managers.CACHE_REFRESH_LISTINGS = self.old_refresh_listings
+        super(TestHotListingWindow, self).tearDown()
+
+    def get_window(self):
+        return Listing.objects.get_listing_window(category=self.category, children=Listing.objects.ALL)
+
+    def test_readers_get_the_regenerated_window(self):
+        self.assert_equals(self.listings, self.get_window())
+        listing = self.listings[-1]
+        listing.publish_from = self.listings[0].publish_from + timedelta(seconds=3600)
+        listing.save()
+        self.assert_equals([listing] + self.listings[:-1], self.get_window())
+        # computed once and regenerated once, the readers never missed
+        self.assert_equals(2, len(self.queries))
+
+    def test_window_missed_by_the_invalidator_is_recomputed(self):
+        self.assert_equals(self.listings, self.get_window())
+        signals.post_save.disconnect(CACHE_DELETER.propagate_signal)
+        try:
+            listing = self.listings[-1]
+            listing.publish_from = self.listings[0].publish_from + timedelta(seconds=3600)
+            listing.save()
+        finally:
+            signals.post_save.connect(CACHE_DELETER.propagate_signal)
+        self.assert_equals([listing] + self.listings[:-1], self.get_window())
+
+    def test_window_is_kept_on_change_of_unrelated_field(self):
+        self.get_window()
+        signals.post_init.connect(CACHE_DELETER.remember_values)
+        try:
+            listing = Listing.objects.get(pk=self.listings[0].pk)
+            listing.commercial = True
+            listing.save()
+            self.assert_equals(1, len(self.queries))
+            listing.priority_value = 10
+            listing.save()
+            self.assert_equals(2, len(self.queries))
+        finally:
+            signals.post_init.disconnect(CACHE_DELETER.remember_values)
+
+class TestListingWindowWithoutTransport(CacheTestCase):
+    def setUp(self):
+        super(TestListingWindowWithoutTransport, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        create_and_place_more_publishables(self)
+        list_all_placements_in_category_by_hour(self, self.category)
+        self.old_refresh_listings = managers.CACHE_REFRESH_LISTINGS
+        managers.CACHE_REFRESH_LISTINGS = True
+
+    def tearDown(self):
+        managers.CACHE_REFRESH_LISTINGS = self.old_refresh_listings
+        super(TestListingWindowWithoutTransport, self).tearDown()
+
+    def test_window_is_not_hot_and_follows_generations(self):
+        window = Listing.objects.get_listing_window(category=self.category, children=Listing.objects.ALL)
+        self.assert_equals(self.listings, window)
+        listing = self.listings[-1]
+        listing.publish_from = self.listings[0].publish_from + timedelta(seconds=3600)
+        listing.save()
+        window = Listing.objects.get_listing_window(category=self.category, children=Listing.objects.ALL)
+        self.assert_equals([listing] + self.listings[:-1], window)
+
+class TestHotBox(InProcessTestCase):
+    def setUp(self):
+        super(TestHotBox, self).setUp()
+        create_and_place_a_publishable(self)
+        self.old_box_cache = box.cache
+        box.cache = self.cache
+        template_loader.templates['box/box.html'] = '{{ object.title }}'
+
+    def tearDown(self):
+        template_loader.templates = {}
+        box.cache = self.old_box_cache
+        super(TestHotBox, self).tearDown()
+
+    def get_box(self):
+        b = Box(self.publishable, 'hot_box', NodeList([TextNode('hot: 1')]))
+        b.prepare(Context({}))
+        return b
+
+    def test_hot_box_key_survives_save_of_its_object(self):
+        b = self.get_box()
+        self.assert_equals(u'First Article', b.render())
+        self.publishable.title = u'Changed Article'
+        self.publishable.save()
+        b2 = self.get_box()
+        self.assert_equals(b.get_cache_key(), b2.get_cache_key())
+        self.assert_equals(u'Changed Article', b2.render())
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import random
+from zlib import crc32
+
+from djangosanetesting import UnitTestCase
+
+from django.core.cache import get_cache
+
+from ella.core.cache import generations, replication
+from ella.core.cache.registry import Registry
+from ella.core.management.commands import cacheinvalidator
+from ella.core.models import Category
+
+
+class SimulatedNodes(object):
+    " Local memory caches standing for memcached nodes, keys are spread by their hash. Counts reads per node. "
+    def __init__(self, nodes):
+        self.nodes = [get_cache('locmem://') for i in range(nodes)]
+        self.reads = [0] * nodes
+
+    def _node(self, key):
+        return (crc32(key) & 0xffffffff) % len(self.nodes)
+
+    def get(self, key, default=None):
+        self.reads[self._node(key)] += 1
+        return self.nodes[self._node(key)].get(key, default)
+
+    def get_many(self, keys):
+        out = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                out[key] = value
+        return out
+
+    def set(self, key, value, timeout=None):
+        self.nodes[self._node(key)].set(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        return self.nodes[self._node(key)].add(key, value, timeout)
+
+    def delete(self, key):
+        self.nodes[self._node(key)].delete(key)
+
+    def incr(self, key, delta=1):
+        return self.nodes[self._node(key)].incr(key, delta)
+
+class TestReplication(UnitTestCase):
+    def setUp(self):
+        super(TestReplication, self).setUp()
+        self.old_caches = generations.cache, cacheinvalidator.cache
+        self.cache = generations.cache = cacheinvalidator.cache = SimulatedNodes(4)
+        self.old_replication = replication.CACHE_REPLICAS, replication.CACHE_REPLICATED_MODELS
+        replication.CACHE_REPLICAS, replication.CACHE_REPLICATED_MODELS = 3, ('core.Category',)
+        self.key = replication.replicated_key('hot', 8)
+        random.seed(0)
+
+    def tearDown(self):
+        replication.CACHE_REPLICAS, replication.CACHE_REPLICATED_MODELS = self.old_replication
+        generations.cache, cacheinvalidator.cache = self.old_caches
+        super(TestReplication, self).tearDown()
+
+    def get_counter_replicas(self, ns):
+        return [self.cache.get(k) for k in replication.get_replicas(generations.get_counter_key(ns))]
+
+    def test_plain_keys_are_not_replicated(self):
+        self.assert_equals(['k'], replication.get_replicas('k'))
+        self.assert_equals('k', replication.replicated_key('k', 1))
+
+    def test_reads_are_spread_over_nodes(self):
+        replication.set(self.cache, self.key, 'value', 60)
+        for i in range(100):
+            self.assert_equals('value', replication.get(self.cache, self.key))
+        self.assert_true(max(self.cache.reads) < 100)
+
+    def test_invalidator_deletes_all_replicas(self):
+        replication.set(self.cache, self.key, 'value', 60)
+        cacheinvalidator.CacheInvalidator(None, Registry()).delete(self.key)
+        self.assert_equals({}, self.cache.get_many(replication.get_replicas(self.key)))
+
+    def test_bump_increments_all_replicas(self):
+        ns = generations.model_namespace(Category)
+        key = generations.get_counter_key(ns)
+        self.assert_equals(replication.CACHE_REPLICAS, len(replication.get_replicas(key)))
+        before = generations.get_generations([ns])[0]
+        generations.bump([ns])
+        self.assert_equals([before + 1] * replication.CACHE_REPLICAS, [self.cache.get(k) for k in replication.get_replicas(key)])
+
+    def test_replication_is_off_by_default(self):
+        replication.CACHE_REPLICAS, replication.CACHE_REPLICATED_MODELS = self.old_replication
+        self.assert_equals('k', replication.replicated_key('k'))
+        self.assert_false(replication.is_replicated_model(Category))
+
+    def test_partially_evicted_counter_is_dropped_on_bump(self):
+        ns = generations.model_namespace(Category)
+        before = generations.get_generations([ns])[0]
+        self.cache.delete(replication.get_replicas(generations.get_counter_key(ns))[1])
+        generations.bump([ns])
+        self.assert_equals([None] * 3, self.get_counter_replicas(ns))
+        after = generations.get_generations([ns])[0]
+        self.assert_true(after > before)
+        self.assert_equals([after] * 3, self.get_counter_replicas(ns))
+
+    def test_missing_replica_reseeds_all_of_them(self):
+        ns = generations.model_namespace(Category)
+        before = generations.get_generations([ns])[0]
+        generations.bump([ns])
+        self.cache.delete(replication.get_replicas(generations.get_counter_key(ns))[1])
+        for i in range(20):
+            generations.get_generations([ns])
+        replicas = self.get_counter_replicas(ns)
+        self.assert_equals([replicas[0]] * 3, replicas)
+        self.assert_true(replicas[0] >= before + 1)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from djangosanetesting import UnitTestCase
+
+from ella.core.cache import utils, stats
+from ella.core.cache.utils import get_cached_object, cache_this
+from ella.core.models import Category
+
+from unit_project.test_core import create_basic_categories, CacheTestCase, get_test_key
+
+
+class TestCacheStats(CacheTestCase):
+    def setUp(self):
+        super(TestCacheStats, self).setUp()
+        create_basic_categories(self)
+        self.old_stats_cache = stats.cache
+        stats.cache = self.cache
+        stats.STATS.enabled = True
+        stats.STATS.reset()
+
+    def tearDown(self):
+        stats.STATS.enabled = False
+        stats.STATS.reset()
+        stats.cache = self.old_stats_cache
+        super(TestCacheStats, self).tearDown()
+
+    def test_hits_and_misses_are_counted_per_family(self):
+        get_cached_object(Category, pk=self.category.pk)
+        get_cached_object(Category, pk=self.category.pk)
+        row = stats.STATS.snapshot()[utils.KEY_FORMAT_OBJECT]
+        self.assert_equals((1, 1, 1), (row['hits'], row['misses'], row['sets']))
+        self.assert_true(row['set_bytes'] > 0)
+
+    def test_cache_this_family_is_the_function(self):
+        def func(value):
+            return value
+        cache_this(get_test_key)(func)('a')
+        self.assert_true('%s.func' % __name__ in stats.STATS.snapshot())
+
+    def test_request_numbers_are_tracked_separately(self):
+        get_cached_object(Category, pk=self.category.pk)
+        stats.STATS.start_request()
+        get_cached_object(Category, pk=self.category.pk)
+        data = stats.STATS.end_request()
+        self.assert_equals((1, 0), (data[utils.KEY_FORMAT_OBJECT]['hits'], data[utils.KEY_FORMAT_OBJECT]['misses']))
+
+    def test_flush_adds_numbers_to_backend(self):
+        get_cached_object(Category, pk=self.category.pk)
+        stats.STATS.flush()
+        get_cached_object(Category, pk=self.category.pk)
+        stats.STATS.flush()
+        row = stats.get_backend_stats()[utils.KEY_FORMAT_OBJECT]
+        self.assert_equals((1, 1), (row['hits'], row['misses']))
+        self.assert_equals({}, stats.STATS.snapshot())
+
+    def test_reset_backend_stats(self):
+        get_cached_object(Category, pk=self.category.pk)
+        stats.STATS.flush()
+        stats.reset_backend_stats()
+        self.assert_equals({}, stats.get_backend_stats())
+
+class TestInvalidatorStats(UnitTestCase):
+    def setUp(self):
+        super(TestInvalidatorStats, self).setUp()
+        self.stats = stats.InvalidatorStats(partition=1)
+
+    def test_lags_are_bucketed(self):
+        for lag in (0.001, 0.05, 0.05, 100):
+            self.stats.record('del', lag, 0.001, 2)
+        self.assert_equals([1, 2, 0, 0, 0, 1], self.stats.lags)
+
+    def test_numbers_are_kept_per_type(self):
+        self.stats.record('del', 0.5, 0.01, 3)
+        self.stats.record('del', 1.5, 0.03, 1)
+        self.stats.record('dependents', None, 0.01, 1)
+        row = self.stats.snapshot()['types']['del']
+        self.assert_equals((2, 4, 2, 0.03, 1.5), (row['messages'], row['deleted'], row['lagged'], row['max_time'], row['max_lag']))
+        self.assert_equals(0, self.stats.snapshot()['types']['dependents']['lagged'])
+
+    def test_format(self):
+        self.stats.record('del', 0.5, 0.01, 3)
+        lines = stats.format_invalidator_stats([self.stats.snapshot()])
+        self.assert_true(lines[0].startswith('invalidator[1] del messages=1 deleted=3 keys_per_message=3.00'))
+        self.assert_true(lines[1].startswith('invalidator[1] lag '))
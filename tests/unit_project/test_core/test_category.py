@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 from djangosanetesting import DatabaseTestCase
 
+from django.core import serializers
 from django.core.urlresolvers import reverse
 
-from ella.core.models import Category
+from ella.core.models import Category, CategoryClosure
 
 from unit_project.test_core import create_basic_categories
 
@@ -60,3 +61,56 @@ class TestCategory(DatabaseTestCase):
         url = reverse('category_detail', args=(self.category_nested.tree_path, ))
         self.assert_equals(url, self.category_nested.get_absolute_url())
 
+
+class TestCategoryClosure(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestCategoryClosure, self).setUp()
+        create_basic_categories(self)
+
+    def get_links(self, category):
+        return sorted(CategoryClosure.objects.filter(descendant=category).values_list('ancestor', 'depth'))
+
+    def test_category_is_linked_to_itself_and_ancestors(self):
+        self.assert_equals(
+            [(self.category.pk, 2), (self.category_nested.pk, 1), (self.category_nested_second.pk, 0)],
+            self.get_links(self.category_nested_second)
+        )
+
+    def test_resaving_keeps_links(self):
+        self.category_nested.save()
+        self.assert_equals(6, CategoryClosure.objects.count())
+
+    def test_moved_subtree_is_relinked(self):
+        other = Category.objects.create(
+            title=u"other category",
+            tree_parent=self.category,
+            site_id=self.site_id,
+            slug=u"other-category",
+        )
+        self.category_nested_second.tree_parent = other
+        self.category_nested_second.save()
+        self.assert_equals(
+            [(self.category.pk, 2), (self.category_nested_second.pk, 0), (other.pk, 1)],
+            self.get_links(self.category_nested_second)
+        )
+        self.assert_equals(0, CategoryClosure.objects.filter(ancestor=self.category_nested, depth__gt=0).count())
+
+    def test_links_are_deleted_with_the_category(self):
+        self.category_nested.delete()
+        self.assert_equals([(self.category.pk, self.category.pk)], list(CategoryClosure.objects.values_list('ancestor', 'descendant')))
+
+    def test_fixtures_are_linked_in_any_order(self):
+        data = [
+            {'model': 'core.category', 'pk': 1001, 'fields': {'title': u'raw child', 'slug': u'raw-child', 'tree_parent': 1000, 'tree_path': u'raw-parent/raw-child', 'description': u'', 'site': self.site_id}},
+            {'model': 'core.category', 'pk': 1000, 'fields': {'title': u'raw parent', 'slug': u'raw-parent', 'tree_parent': self.category.pk, 'tree_path': u'raw-parent', 'description': u'', 'site': self.site_id}},
+        ]
+        for obj in serializers.deserialize('python', data):
+            obj.save()
+        self.assert_equals([(self.category.pk, 2), (1000, 1), (1001, 0)], self.get_links(1001))
+
+    def test_rebuild_recreates_the_closure(self):
+        links = sorted(CategoryClosure.objects.values_list('ancestor', 'descendant', 'depth'))
+        CategoryClosure.objects.all().delete()
+        CategoryClosure.objects.rebuild()
+        self.assert_equals(links, sorted(CategoryClosure.objects.values_list('ancestor', 'descendant', 'depth')))
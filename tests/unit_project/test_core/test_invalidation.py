@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+import os
+import errno
+import pickle
+import shutil
+import socket
+import tempfile
+
+from djangosanetesting import UnitTestCase
+
+from django.db import transaction
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import signals
+from django.conf import settings
+
+from ella.core.cache import utils, replication
+from ella.core.cache.utils import get_cached_object
+from ella.core.cache.invalidate import CACHE_DELETER
+from ella.core.cache.transports import UnixSocketTransport
+from ella.core.middleware import InvalidationBatchMiddleware, TRANSACTION_MIDDLEWARE
+from ella.core.management.commands import cacheinvalidator, replayinvalidations
+from ella.core.models import Category
+
+from unit_project.test_core import InProcessTestCase
+
+
+class TestInProcessTransport(InProcessTestCase):
+    def test_saved_object_is_invalidated(self):
+        get_cached_object(Category, pk=self.category.pk)
+        Category.objects.filter(pk=self.category.pk).update(title=u'changed')
+        Category.objects.get(pk=self.category.pk).save()
+        self.assert_equals(u'changed', get_cached_object(Category, pk=self.category.pk).title)
+
+    def test_invalidated_keys_are_reported_back(self):
+        keys = []
+        CACHE_DELETER.add_invalidation_listener(keys.append)
+        try:
+            get_cached_object(Category, pk=self.category.pk)
+            self.category.save()
+        finally:
+            CACHE_DELETER.invalidation_listeners.remove(keys.append)
+        self.assert_equals([utils._get_key(utils.KEY_FORMAT_OBJECT, Category, {'pk': self.category.pk})], keys)
+
+    def test_enclosing_fragments_are_invalidated(self):
+        for key in ('inner', 'box', 'page'):
+            self.cache.set(key, key)
+        CACHE_DELETER.register_pk(self.category, 'inner')
+        CACHE_DELETER.register_dependency('inner', 'box')
+        CACHE_DELETER.register_dependency('box', 'page')
+        self.category.save()
+        self.assert_equals({}, self.cache.get_many(['inner', 'box', 'page']))
+
+    def test_changed_instance_is_sent_as_descriptor(self):
+        messages = []
+        self.transport.send = lambda headers, body: messages.append((headers, body))
+        self.category.save()
+        descriptor = pickle.loads(messages[0][1])
+        self.assert_equals((str(Category), str(self.category.pk), self.category.slug), (descriptor.model, descriptor.pk, descriptor.slug))
+        self.assert_true(len(messages[0][1]) < len(pickle.dumps(self.category)))
+
+    def test_changed_fields_are_reported(self):
+        signals.post_init.connect(CACHE_DELETER.remember_values)
+        try:
+            category = Category.objects.get(pk=self.category.pk)
+            category.title = u'changed'
+            self.assert_equals(set(['title']), CACHE_DELETER.get_changed(category))
+            self.assert_equals(set(), CACHE_DELETER.get_changed(category))
+        finally:
+            signals.post_init.disconnect(CACHE_DELETER.remember_values)
+
+    def test_key_depending_on_unchanged_fields_is_kept(self):
+        signals.post_init.connect(CACHE_DELETER.remember_values)
+        try:
+            self.cache.set('k', 'k')
+            CACHE_DELETER.register_test(Category, 'id:%s' % self.category.pk, 'k', ['slug'])
+            category = Category.objects.get(pk=self.category.pk)
+            category.title = u'changed'
+            category.save()
+            self.assert_equals('k', self.cache.get('k'))
+            category.slug = u'changed'
+            category.save()
+            self.assert_equals(None, self.cache.get('k'))
+        finally:
+            signals.post_init.disconnect(CACHE_DELETER.remember_values)
+
+    def test_missing_object_is_kept_missing_on_unrelated_change(self):
+        signals.post_init.connect(CACHE_DELETER.remember_values)
+        try:
+            self.assert_raises(Category.DoesNotExist, get_cached_object, Category, slug=u'missing')
+            key = utils._get_key(utils.KEY_FORMAT_OBJECT, Category, {'slug': u'missing'})
+            category = Category.objects.get(pk=self.category.pk)
+            category.title = u'changed'
+            category.save()
+            self.assert_true(replication.get(self.cache, key) is not None)
+            category.slug = u'missing'
+            category.save()
+            self.assert_equals(None, replication.get(self.cache, key))
+        finally:
+            signals.post_init.disconnect(CACHE_DELETER.remember_values)
+
+    def test_lag_and_deleted_keys_are_measured(self):
+        get_cached_object(Category, pk=self.category.pk)
+        self.category.save()
+        row = self.transport.invalidator.stats.snapshot()['types']['del']
+        self.assert_equals((1, 1, 1), (row['messages'], row['deleted'], row['lagged']))
+        self.assert_true(row['max_lag'] >= 0)
+
+    def test_recorded_messages_can_be_replayed(self):
+        path = tempfile.mktemp()
+        try:
+            self.transport.invalidator.message_log = cacheinvalidator.MessageLog(path)
+            get_cached_object(Category, pk=self.category.pk)
+            self.category.save()
+            self.transport.invalidator.message_log.close()
+            self.transport.invalidator.message_log = None
+
+            invalidator = replayinvalidations.ReplayInvalidator()
+            for received, headers, body in cacheinvalidator.read_message_log(path):
+                invalidator.on_message(headers, body, received)
+            self.assert_equals(1, invalidator.deleted)
+            self.assert_equals(['del', 'pk'], sorted(invalidator.stats.data.keys()))
+        finally:
+            os.unlink(path)
+
+    def test_messages_are_sent_at_the_end_of_batch(self):
+        CACHE_DELETER.start_batch()
+        get_cached_object(Category, pk=self.category.pk)
+        self.assert_equals(0, len(self.transport.invalidator._register.get_model(str(Category))))
+        CACHE_DELETER.send_batch()
+        self.assert_equals(1, len(self.transport.invalidator._register.get_model(str(Category))))
+
+    def test_changes_saved_in_transaction_are_sent_after_it(self):
+        get_cached_object(Category, pk=self.category.pk)
+        key = utils._get_key(utils.KEY_FORMAT_OBJECT, Category, {'pk': self.category.pk})
+        CACHE_DELETER.send_after_commit = True
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            self.category.save()
+            self.assert_true(self.cache.get(key) is not None)
+        finally:
+            # the test's own transaction rolls the change back
+            transaction.set_clean()
+            transaction.leave_transaction_management()
+            CACHE_DELETER.send_after_commit = False
+        CACHE_DELETER.send_pending()
+        self.assert_equals(None, self.cache.get(key))
+
+    def test_changes_rolled_back_are_not_sent(self):
+        get_cached_object(Category, pk=self.category.pk)
+        key = utils._get_key(utils.KEY_FORMAT_OBJECT, Category, {'pk': self.category.pk})
+        CACHE_DELETER.send_after_commit = True
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            self.category.save()
+            transaction.rollback()
+        finally:
+            transaction.leave_transaction_management()
+            CACHE_DELETER.send_after_commit = False
+        CACHE_DELETER.send_pending()
+        self.assert_true(self.cache.get(key) is not None)
+
+class TestInvalidationBatchMiddleware(UnitTestCase):
+    def setUp(self):
+        super(TestInvalidationBatchMiddleware, self).setUp()
+        self.old_middleware_classes = settings.MIDDLEWARE_CLASSES
+
+    def tearDown(self):
+        settings.MIDDLEWARE_CLASSES = self.old_middleware_classes
+        super(TestInvalidationBatchMiddleware, self).tearDown()
+
+    def test_has_to_be_listed_above_transaction_middleware(self):
+        settings.MIDDLEWARE_CLASSES = (TRANSACTION_MIDDLEWARE, 'ella.core.middleware.InvalidationBatchMiddleware')
+        self.assert_raises(ImproperlyConfigured, InvalidationBatchMiddleware)
+
+    def test_listed_above_transaction_middleware_is_accepted(self):
+        settings.MIDDLEWARE_CLASSES = ('ella.core.middleware.InvalidationBatchMiddleware', TRANSACTION_MIDDLEWARE)
+        InvalidationBatchMiddleware()
+
+class FailingSocket(object):
+    def __init__(self, error):
+        self.error = error
+
+    def sendto(self, data, path):
+        raise socket.error(self.error, os.strerror(self.error))
+
+class TestUnixSocketTransport(UnitTestCase):
+    def setUp(self):
+        super(TestUnixSocketTransport, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.transport = UnixSocketTransport(os.path.join(self.dir, 'ci'), 1)
+        self.client_path = os.path.join(self.dir, 'ci.1')
+        self.client = self.transport._bind(self.client_path)
+
+    def tearDown(self):
+        self.client.close()
+        shutil.rmtree(self.dir)
+        super(TestUnixSocketTransport, self).tearDown()
+
+    def test_notification_is_received(self):
+        self.transport.notify('k')
+        self.assert_equals(({'type': 'invalidated', 'key': 'k'}, ''), self.transport._loads(self.client.recv(1024)))
+
+    def test_unsigned_message_is_rejected(self):
+        self.assert_raises(ValueError, self.transport._loads, 'x' * 20 + pickle.dumps(({'type': 'invalidated', 'key': 'k'}, '')))
+
+    def test_world_writable_directory_is_rejected(self):
+        os.chmod(self.dir, 0777)
+        self.assert_raises(ImproperlyConfigured, UnixSocketTransport, os.path.join(self.dir, 'ci'), 1)
+
+    def test_path_is_required(self):
+        self.assert_raises(ImproperlyConfigured, UnixSocketTransport, None, 1)
+
+    def test_socket_is_kept_on_transient_error(self):
+        self.transport._socket = FailingSocket(errno.EAGAIN)
+        self.transport.notify('k')
+        self.assert_true(os.path.exists(self.client_path))
+
+    def test_socket_of_gone_process_is_removed(self):
+        self.transport._socket = FailingSocket(errno.ECONNREFUSED)
+        self.transport.notify('k')
+        self.assert_false(os.path.exists(self.client_path))
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+
+from djangosanetesting import UnitTestCase
+
+from ella.core.cache.registry import Registry, JournaledRegistry, read_registry
+
+
+class Instance(object):
+    " Stand-in for a changed model instance. "
+    def __init__(self, pk, **kwargs):
+        self.pk = pk
+        self.__dict__.update(kwargs)
+
+    def _get_pk_val(self):
+        return self.pk
+
+class TestInvalidationRegistry(UnitTestCase):
+    def setUp(self):
+        super(TestInvalidationRegistry, self).setUp()
+        self.registry = Registry()
+
+    def test_pk_keys_are_matched_once(self):
+        self.registry.add_pk('m', 1, 'k')
+        self.assert_equals(set(['k']), self.registry.match('m', Instance(1)))
+        self.assert_equals(set(), self.registry.match('m', Instance(1)))
+
+    def test_test_matching_all_conditions(self):
+        self.registry.add_test('m', 'category_id:1;name:x', 'k')
+        self.assert_equals(set(), self.registry.match('m', Instance(1, category_id=1, name='y')))
+        self.assert_equals(set(['k']), self.registry.match('m', Instance(1, category_id=1, name='x')))
+
+    def test_only_indexed_candidates_are_evaluated(self):
+        for i in range(10):
+            self.registry.add_test('m', 'category_id:%d' % i, 'k%d' % i)
+        self.assert_equals(set([('k3', 'category_id:3')]), self.registry.get_model('m').candidates(Instance(1, category_id=3)))
+
+    def test_all_tests_of_invalidated_key_are_removed(self):
+        self.registry.add_test('m', 'category_id:1', 'k')
+        self.registry.add_test('m', 'category_id:2', 'k')
+        self.registry.match('m', Instance(1, category_id=1))
+        self.assert_equals(0, len(self.registry.get_model('m')))
+        self.assert_equals({}, self.registry.get_model('m').index)
+
+    def test_empty_test_matches_every_instance(self):
+        self.registry.add_test('m', '', 'k')
+        self.assert_equals(set(['k']), self.registry.match('m', Instance(1)))
+
+    def test_other_models_are_not_affected(self):
+        self.registry.add_test('m', 'category_id:1', 'k')
+        self.assert_equals(set(), self.registry.match('other', Instance(1, category_id=1)))
+
+    def test_test_is_skipped_when_its_fields_did_not_change(self):
+        self.registry.add_test('m', 'category_id:1', 'k', ['category_id', 'publish_from'])
+        self.assert_equals(set(), self.registry.match('m', Instance(1, category_id=1), set(['hits'])))
+        self.assert_equals(set(['k']), self.registry.match('m', Instance(1, category_id=1), set(['hits', 'publish_from'])))
+
+    def test_fields_default_to_the_tests_attributes(self):
+        self.registry.add_test('m', 'category_id:1', 'k')
+        self.assert_equals(set(), self.registry.match('m', Instance(1, category_id=1), set(['hits'])))
+        self.assert_equals(set(['k']), self.registry.match('m', Instance(1, category_id=1), set(['category_id'])))
+
+    def test_test_with_empty_fields_matches_any_change(self):
+        self.registry.add_test('m', 'category_id:1', 'k', [])
+        self.assert_equals(set(['k']), self.registry.match('m', Instance(1, category_id=1), set()))
+
+    def test_empty_test_matches_any_change(self):
+        self.registry.add_test('m', '', 'k')
+        self.assert_equals(set(['k']), self.registry.match('m', Instance(1), set(['hits'])))
+
+    def test_pk_keys_are_matched_regardless_of_changed_fields(self):
+        self.registry.add_pk('m', 1, 'k')
+        self.assert_equals(set(['k']), self.registry.match('m', Instance(1), set()))
+
+class TestDependencyGraph(UnitTestCase):
+    def setUp(self):
+        super(TestDependencyGraph, self).setUp()
+        self.registry = Registry()
+
+    def test_dependents_are_collected_transitively(self):
+        self.registry.add_dependency('inner', 'middle')
+        self.registry.add_dependency('middle', 'outer')
+        self.registry.add_dependency('middle', 'page')
+        self.assert_equals(set(['inner', 'middle', 'outer', 'page']), self.registry.pop_dependents(['inner']))
+        self.assert_equals({}, self.registry.dependencies)
+
+    def test_cycles_are_visited_once(self):
+        self.registry.add_dependency('a', 'b')
+        self.registry.add_dependency('b', 'a')
+        self.assert_equals(set(['a', 'b']), self.registry.pop_dependents(['a']))
+
+    def test_duplicate_dependencies_are_stored_once(self):
+        self.registry.add_dependency('a', 'b')
+        self.registry.add_dependency('a', 'b')
+        self.registry.add_dependency('a', 'a')
+        self.assert_equals({'a': set(['b'])}, self.registry.dependencies)
+
+    def test_unrelated_keys_are_kept(self):
+        self.registry.add_dependency('a', 'b')
+        self.registry.add_dependency('c', 'd')
+        self.registry.pop_dependents(['a'])
+        self.assert_equals({'c': set(['d'])}, self.registry.dependencies)
+
+class TestJournaledRegistry(UnitTestCase):
+    def setUp(self):
+        super(TestJournaledRegistry, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.registry = JournaledRegistry(self.path, shards=4, compact_after=5)
+        for i in range(20):
+            self.registry.add_test('m', 'category_id:%d' % (i % 3), 'k%d' % i)
+            self.registry.add_pk('m', i, 'p%d' % i)
+        self.registry.add_dependency('k1', 'd1')
+
+    def tearDown(self):
+        self.registry.close()
+        shutil.rmtree(self.path)
+        super(TestJournaledRegistry, self).tearDown()
+
+    def reload(self):
+        self.registry.close()
+        return JournaledRegistry(self.path, shards=4, compact_after=5)
+
+    def assert_same_state(self, registry):
+        self.assert_equals(self.registry.models['m'].tests, registry.models['m'].tests)
+        self.assert_equals(self.registry.models['m'].pks, registry.models['m'].pks)
+        self.assert_equals(self.registry.models['m'].index, registry.models['m'].index)
+        self.assert_equals(self.registry.dependencies, registry.dependencies)
+        self.assert_equals(self.registry.refreshes, registry.refreshes)
+
+    def test_state_survives_restart(self):
+        self.registry.match('m', Instance(3, category_id=1))
+        self.registry.pop_dependencies('k1')
+        registry = self.reload()
+        self.assert_same_state(registry)
+        registry.close()
+
+    def test_refreshes_survive_restart(self):
+        self.registry.add_refresh('k1', ('path', (1,), {}))
+        self.registry.add_refresh('k2', ('path', (2,), {}))
+        self.registry.pop_refresh('k2')
+        registry = self.reload()
+        self.assert_equals({'k1': ('path', (1,), {})}, registry.refreshes)
+        registry.close()
+
+    def test_compaction_keeps_state(self):
+        self.registry.add_refresh('k1', ('path', (1,), {}))
+        for shard in range(4):
+            self.registry.compact(shard)
+        self.assert_equals(0, sum(os.path.getsize(self.registry._file(shard, 'journal')) for shard in range(4)))
+        registry = self.reload()
+        self.assert_same_state(registry)
+        registry.close()
+
+    def test_read_registry_leaves_files_alone(self):
+        self.registry.add_refresh('k1', ('path', (1,), {}))
+        sizes = [os.path.getsize(self.registry._file(shard, 'journal')) for shard in range(4)]
+        registry = read_registry(self.path, 4)
+        self.assert_same_state(registry)
+        self.assert_equals(sizes, [os.path.getsize(self.registry._file(shard, 'journal')) for shard in range(4)])
+
+    def test_broken_journal_record_is_ignored(self):
+        self.registry.close()
+        filename = [self.registry._file(shard, 'journal') for shard in range(4) if os.path.getsize(self.registry._file(shard, 'journal'))][0]
+        data = open(filename, 'rb').read()
+        open(filename, 'wb').write(data[:-3])
+        registry = self.reload()
+        self.assert_equals(0, os.path.getsize(filename))
+        registry.close()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from ella.core.cache.registry import Registry
+from ella.core.cache.transports import BaseTransport, get_partition
+from ella.core.cache.invalidate import CACHE_DELETER
+from ella.core.cache.utils import is_refreshing
+from ella.core.management.commands import cacheinvalidator
+from ella.core.models import Category
+
+from unit_project.test_core import create_basic_categories, CacheTestCase
+
+
+REFRESHED = []
+
+def refresh_key(key):
+    if is_refreshing(key):
+        REFRESHED.append(key)
+
+class PartitionedTransport(BaseTransport):
+    " Delivers messages straight to the invalidator owning the partition. "
+    def __init__(self, partitions):
+        super(PartitionedTransport, self).__init__(partitions)
+        self.invalidators = [cacheinvalidator.CacheInvalidator(self, Registry(), partition) for partition in range(partitions)]
+        self.sent = [0] * partitions
+
+    def send_to(self, partition, headers, body):
+        self.sent[partition] += 1
+        self.invalidators[partition].on_message(headers, body)
+
+    def notify(self, key):
+        pass
+
+class TestPartitionedInvalidator(CacheTestCase):
+    def setUp(self):
+        super(TestPartitionedInvalidator, self).setUp()
+        create_basic_categories(self)
+        self.old_invalidator_cache = cacheinvalidator.cache
+        cacheinvalidator.cache = self.cache
+        self.transport = PartitionedTransport(2)
+        CACHE_DELETER.connect(self.transport)
+        CACHE_DELETER.send_after_commit = False
+
+    def tearDown(self):
+        CACHE_DELETER.send_after_commit = True
+        CACHE_DELETER.disconnect()
+        cacheinvalidator.cache = self.old_invalidator_cache
+        super(TestPartitionedInvalidator, self).tearDown()
+
+    def get_keys(self, partition, count):
+        " Return count keys owned by the partition. "
+        keys = []
+        i = 0
+        while len(keys) < count:
+            key = 'key%d' % i
+            if get_partition(key, 2) == partition:
+                keys.append(key)
+            i += 1
+        return keys
+
+    def test_registrations_are_owned_by_model_partition(self):
+        CACHE_DELETER.register_pk(self.category, 'k')
+        owner = get_partition(str(Category), 2)
+        self.assert_equals(1, len(self.transport.invalidators[owner]._register.get_model(str(Category))))
+        self.assert_equals(0, len(self.transport.invalidators[1 - owner]._register.get_model(str(Category))))
+
+    def test_dependencies_are_followed_across_partitions(self):
+        a, c = self.get_keys(0, 2)
+        b, d = self.get_keys(1, 2)
+        for key in (a, b, c, d):
+            self.cache.set(key, key)
+        CACHE_DELETER.register_pk(self.category, a)
+        CACHE_DELETER.register_dependency(a, b)
+        CACHE_DELETER.register_dependency(b, c)
+        CACHE_DELETER.register_dependency(c, d)
+        CACHE_DELETER.register_dependency(d, a)
+        CACHE_DELETER.propagate_signal(Category, self.category)
+        self.assert_equals({}, self.cache.get_many([a, b, c, d]))
+
+    def test_batch_is_split_by_partition(self):
+        a = self.get_keys(0, 1)[0]
+        b = self.get_keys(1, 1)[0]
+        CACHE_DELETER.start_batch()
+        CACHE_DELETER.register_dependency(a, b)
+        CACHE_DELETER.register_dependency(b, a)
+        CACHE_DELETER.send_batch()
+        self.assert_equals([1, 1], self.transport.sent)
+
+    def test_hot_key_is_regenerated_by_its_owner(self):
+        REFRESHED[:] = []
+        key = self.get_keys(1 - get_partition(str(Category), 2), 1)[0]
+        self.cache.set(key, 'hot')
+        CACHE_DELETER.register_pk(self.category, key)
+        CACHE_DELETER.register_refresh(key, 'unit_project.test_core.test_invalidator_partitions.refresh_key', (key,), {})
+        CACHE_DELETER.propagate_signal(Category, self.category)
+        self.assert_equals(('hot', [key]), (self.cache.get(key), REFRESHED))
@@ -4,9 +4,11 @@ from datetime import datetime, timedelta
 from djangosanetesting import DatabaseTestCase
 
 from ella.core.models import Listing, Category
+from ella.core import managers
 
 from unit_project.test_core import create_basic_categories, create_and_place_a_publishable, \
         create_and_place_more_publishables, list_all_placements_in_category_by_hour
+from unit_project.test_core import CacheTestCase
 
 class TestListing(DatabaseTestCase):
 
@@ -134,3 +136,64 @@ class TestListing(DatabaseTestCase):
         l = Listing.objects.get_listing(category=self.category, children=Listing.objects.ALL, offset=2, count=2)
 
         self.assert_equals(expected, l)
+
+    def test_offset_skips_repeated_placements(self):
+        Listing.objects.create(
+                placement=self.placements[0],
+                category=self.category,
+                publish_from=datetime.now() - timedelta(days=2),
+            )
+
+        l = Listing.objects.get_listing(category=self.category, children=Listing.objects.ALL, offset=2, count=2)
+
+        self.assert_equals(self.listings[:2], l)
+
+    def test_unique_placements_are_skipped(self):
+        l = Listing.objects.get_listing(category=self.category, children=Listing.objects.ALL, unique=set([self.listings[0].placement_id]))
+
+        self.assert_equals(self.listings[1:], l)
+
+class TestListingWindow(CacheTestCase):
+
+    def setUp(self):
+        super(TestListingWindow, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        create_and_place_more_publishables(self)
+        list_all_placements_in_category_by_hour(self)
+
+        self.queries = []
+        def query_listing(*args, **kwargs):
+            self.queries.append((args, kwargs))
+            return Listing.objects.__class__.query_listing(Listing.objects, *args, **kwargs)
+        Listing.objects.query_listing = query_listing
+        self.old_window_size = managers.LISTING_WINDOW_SIZE
+
+    def tearDown(self):
+        del Listing.objects.query_listing
+        managers.LISTING_WINDOW_SIZE = self.old_window_size
+        super(TestListingWindow, self).tearDown()
+
+    def test_overlapping_pages_are_sliced_from_one_window(self):
+        self.assert_equals(self.listings[:2], Listing.objects.get_listing(category=self.category, children=Listing.objects.ALL, count=2))
+        self.assert_equals(self.listings[1:], Listing.objects.get_listing(category=self.category, children=Listing.objects.ALL, count=2, offset=2))
+        self.assert_equals(1, len(self.queries))
+
+    def test_unique_is_applied_to_the_window(self):
+        Listing.objects.get_listing(category=self.category, children=Listing.objects.ALL)
+        l = Listing.objects.get_listing(category=self.category, children=Listing.objects.ALL, unique=set([self.listings[1].placement_id]))
+        self.assert_equals([self.listings[0], self.listings[2]], l)
+        self.assert_equals(1, len(self.queries))
+
+    def test_pages_beyond_the_window_are_queried(self):
+        managers.LISTING_WINDOW_SIZE = 2
+        l = Listing.objects.get_listing(category=self.category, children=Listing.objects.ALL, count=1, offset=3)
+        self.assert_equals(self.listings[2:], l)
+        self.assert_equals(1, len(self.queries))
+        self.assert_equals(3, self.queries[0][0][3])
+
+    def test_unique_exhausting_a_full_window_falls_back_to_query(self):
+        managers.LISTING_WINDOW_SIZE = 2
+        l = Listing.objects.get_listing(category=self.category, children=Listing.objects.ALL, count=2, unique=set([self.listings[0].placement_id]))
+        self.assert_equals(self.listings[1:], l)
+        self.assert_equals(2, len(self.queries))
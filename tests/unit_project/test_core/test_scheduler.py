@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+
+from django.template import Context, NodeList
+
+from ella.core import box
+from ella.core.box import Box
+from ella.core.cache import generations
+from ella.core.cache.utils import get_cached_object
+from ella.core.cache.scheduler import PublishScheduler, FakeClock
+from ella.core.models import Listing, Placement
+from ella.articles.models import Article
+
+from unit_project import template_loader
+from unit_project.test_core import create_and_place_a_publishable, InProcessTestCase
+
+
+class TestPublishScheduler(InProcessTestCase):
+    def setUp(self):
+        super(TestPublishScheduler, self).setUp()
+        create_and_place_a_publishable(self)
+        self.clock = FakeClock(datetime.now())
+        self.scheduler = PublishScheduler(self.clock, interval=600)
+        self.listing = Listing.objects.create(
+            placement=self.placement,
+            category=self.category_nested,
+            publish_from=self.clock.now() + timedelta(seconds=60),
+        )
+
+    def test_next_boundary_of_every_category(self):
+        self.assert_equals({self.category_nested.pk: self.listing.publish_from}, self.scheduler.next_boundaries())
+
+    def test_next_boundary_is_the_nearest_one(self):
+        Listing.objects.create(placement=self.placement, category=self.category, publish_from=self.clock.now() + timedelta(seconds=30))
+        self.assert_equals(self.clock.now() + timedelta(seconds=30), self.scheduler.next_boundary())
+
+    def test_sleeps_until_the_boundary(self):
+        self.scheduler.run(ticks=1)
+        self.assert_equals([60], self.clock.sleeps)
+
+    def test_nothing_expires_before_the_boundary(self):
+        self.clock.advance(30)
+        self.assert_equals(0, self.scheduler.tick())
+
+    def test_listing_generations_are_bumped_when_boundary_passes(self):
+        namespace = generations.field_namespace(Listing, 'category_id', self.category_nested.pk)
+        before = generations.get_generations([namespace])
+        self.clock.advance(60)
+        self.assert_equals(1, self.scheduler.tick())
+        self.assert_true(before != generations.get_generations([namespace]))
+
+    def test_keys_registered_for_listing_are_invalidated(self):
+        get_cached_object(Listing, pk=self.listing.pk)
+        Listing.objects.filter(pk=self.listing.pk).update(commercial=True)
+        self.clock.advance(60)
+        self.scheduler.tick()
+        self.assert_true(get_cached_object(Listing, pk=self.listing.pk).commercial)
+
+    def test_boundary_is_handled_once(self):
+        self.clock.advance(60)
+        self.scheduler.tick()
+        self.clock.advance(60)
+        self.assert_equals(0, self.scheduler.tick())
+
+class TestPublishSchedulerBoxes(InProcessTestCase):
+    def setUp(self):
+        super(TestPublishSchedulerBoxes, self).setUp()
+        create_and_place_a_publishable(self)
+        self.clock = FakeClock(datetime.now())
+        self.scheduler = PublishScheduler(self.clock, interval=600)
+        Placement.objects.create(
+            publishable=self.publishable,
+            category=self.category,
+            slug=u'second-placement',
+            publish_from=self.clock.now() + timedelta(seconds=60),
+        )
+        self.old_box_cache = box.cache
+        box.cache = self.cache
+        template_loader.templates['box/box.html'] = '{{ object.title }}'
+
+    def tearDown(self):
+        template_loader.templates = {}
+        box.cache = self.old_box_cache
+        super(TestPublishSchedulerBoxes, self).tearDown()
+
+    def render_box(self):
+        article = Article.objects.get(pk=self.publishable.pk)
+        b = Box(article, 'name', NodeList())
+        b.prepare(Context({}))
+        return b.render()
+
+    def test_article_boxes_expire_when_placement_is_published(self):
+        self.assert_equals(u'First Article', self.render_box())
+        Article.objects.filter(pk=self.publishable.pk).update(title=u'Changed Article')
+        self.assert_equals(u'First Article', self.render_box())
+        self.clock.advance(60)
+        self.scheduler.tick()
+        self.assert_equals(u'Changed Article', self.render_box())
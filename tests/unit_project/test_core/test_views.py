@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+
 from djangosanetesting import DatabaseTestCase
 
 from django.contrib.contenttypes.models import ContentType
 from django.template.defaultfilters import slugify
 from django.template import TemplateDoesNotExist
+from django.conf import settings
+from django.http import HttpRequest, Http404
 
 from ella.core.models import Listing
+from ella.core import views
+from ella.core.pagination import encode_cursor, decode_cursor
 
-from unit_project.test_core import create_basic_categories, create_and_place_a_publishable, \
+from unit_project.test_core import CacheTestCase, create_basic_categories, create_and_place_a_publishable, \
         create_and_place_more_publishables, list_all_placements_in_category_by_hour
 from unit_project import template_loader
 
@@ -69,6 +75,91 @@ class TestListContentType(ViewsTestCase):
         response = self.client.get('/2008/', {'p': 200})
         self.assert_equals(404, response.status_code)
 
+    def test_cursor_lists_older_listings(self):
+        template_loader.templates['page/listing.html'] = ''
+        response = self.client.get('/2008/', {'c': encode_cursor(self.listings[0])})
+        self.assert_equals(self.listings[1:], response.context['listings'])
+        self.assert_equals(None, response.context['next_cursor'])
+
+    def test_malformed_cursor_raises_404(self):
+        template_loader.templates['404.html'] = ''
+        response = self.client.get('/2008/', {'c': '2008-1'})
+        self.assert_equals(404, response.status_code)
+
+    def test_cursor_before_1900_lists_older_listings(self):
+        template_loader.templates['page/listing.html'] = ''
+        response = self.client.get('/2008/', {'c': '18000101000000000000-5'})
+        self.assert_equals([], response.context['listings'])
+
+    def test_cursor_of_listing_before_1900(self):
+        self.listings[0].publish_from = datetime(1850, 1, 10, 12, 30, 15, 5)
+        self.assert_equals('18500110123015000005-%d' % self.listings[0].pk, encode_cursor(self.listings[0]))
+        self.assert_equals((self.listings[0].publish_from, self.listings[0].pk), decode_cursor(encode_cursor(self.listings[0])))
+
+    def get_context(self, numbered_pages=5, priorities=False, **GET):
+        request = HttpRequest()
+        request.path = '/2008/'
+        request.GET.update(GET)
+        old_numbered_pages, views.LISTING_NUMBERED_PAGES = views.LISTING_NUMBERED_PAGES, numbered_pages
+        old_priorities, settings.USE_PRIORITIES = settings.USE_PRIORITIES, priorities
+        try:
+            return views.list_content_type.get_context(request, year='2008', paginate_by=2)
+        finally:
+            views.LISTING_NUMBERED_PAGES = old_numbered_pages
+            settings.USE_PRIORITIES = old_priorities
+
+    def test_full_cursor_page_links_to_the_next_one(self):
+        Listing.objects.create(placement=self.placement, category=self.category, publish_from=self.listings[-1].publish_from - timedelta(hours=1))
+        context = self.get_context(c=encode_cursor(self.listings[0]))
+        self.assert_equals(encode_cursor(self.listings[2]), context['next_cursor'])
+
+    def test_last_numbered_page_links_to_cursor(self):
+        context = self.get_context(numbered_pages=1)
+        self.assert_equals(encode_cursor(self.listings[1]), context['next_cursor'])
+
+    def test_last_numbered_page_does_not_link_to_cursor_with_priorities(self):
+        context = self.get_context(numbered_pages=1, priorities=True)
+        self.assert_equals(None, context['next_cursor'])
+
+    def test_pages_beyond_numbered_ones_redirect_to_cursor(self):
+        response = self.get_context(numbered_pages=1, p='2')
+        self.assert_equals(302, response.status_code)
+        self.assert_equals('/2008/?c=%s' % encode_cursor(self.listings[1]), response['Location'])
+
+    def test_pages_beyond_numbered_ones_are_numbered_with_priorities(self):
+        context = self.get_context(numbered_pages=1, priorities=True, p='2')
+        self.assert_equals(2, context['page'].number)
+
+    def test_pages_beyond_listings_raise_404(self):
+        self.assert_raises(Http404, self.get_context, numbered_pages=1, p='20')
+
+    def test_pages_beyond_redirected_ones_raise_404(self):
+        old_redirect_pages, views.LISTING_REDIRECT_PAGES = views.LISTING_REDIRECT_PAGES, 1
+        try:
+            self.assert_raises(Http404, self.get_context, numbered_pages=1, p='2')
+        finally:
+            views.LISTING_REDIRECT_PAGES = old_redirect_pages
+
+class TestCachedCursorPages(CacheTestCase):
+    def setUp(self):
+        super(TestCachedCursorPages, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        create_and_place_more_publishables(self)
+        list_all_placements_in_category_by_hour(self, category=self.category)
+        template_loader.templates['page/listing.html'] = ''
+
+    def tearDown(self):
+        template_loader.templates = {}
+        super(TestCachedCursorPages, self).tearDown()
+
+    def test_cursor_page_is_cached_until_its_listing_changes(self):
+        cursor = encode_cursor(self.listings[0])
+        self.assert_equals(self.listings[1:], self.client.get('/2008/', {'c': cursor}).context['listings'])
+        self.assert_equals(self.listings[1:], self.client.get('/2008/', {'c': cursor}).context['listings'])
+        self.listings[-1].delete()
+        self.assert_equals(self.listings[1:-1], self.client.get('/2008/', {'c': cursor}).context['listings'])
+
 class TestObjectDetailTemplateOverride(ViewsTestCase):
     def setUp(self):
         super(TestObjectDetailTemplateOverride, self).setUp()
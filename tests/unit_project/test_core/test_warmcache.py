@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from django.core.management import call_command
+
+from ella.core.cache.utils import get_cached_object
+from ella.core.management.commands import warmcache
+from ella.core.models import Category, HitCount
+
+from unit_project.test_core import create_basic_categories, create_and_place_a_publishable, CacheTestCase
+
+
+class TestWarmCache(CacheTestCase):
+    def setUp(self):
+        super(TestWarmCache, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        HitCount.objects.hit(self.placement)
+
+    def test_tasks_cover_categories_and_top_objects(self):
+        tasks = warmcache.get_tasks(10, 20, 10, [('listing', '')])
+        self.assert_equals(
+            [self.category.pk, self.category_nested.pk, self.category_nested_second.pk],
+            [args[0] for name, args in tasks if name == 'category']
+        )
+        self.assert_equals([(self.placement.pk, [('listing', '')])], [args for name, args in tasks if name == 'placement'])
+
+    def test_box_parameters_are_given_as_in_box_tag(self):
+        self.assert_equals(('listing', 'level:2\ncss_class:top'), warmcache.parse_box('listing; level:2; css_class:top'))
+        self.assert_equals(('listing', ''), warmcache.parse_box('listing'))
+
+    def test_category_objects_are_cached(self):
+        call_command('warmcache', top=0, verbosity=0)
+        Category.objects.update(title=u'changed')
+        self.assert_equals(self.category.title, get_cached_object(Category, pk=self.category.pk).title)
+        self.assert_equals(self.category_nested.title, get_cached_object(Category, tree_path=self.category_nested.tree_path, site__id=self.site_id).title)
+
+    def test_failing_task_is_reported(self):
+        self.assert_true(warmcache.run_task(('category', (1000, 10, 20))) is not None)